@@ -0,0 +1,118 @@
+"""File size and push latency with content stored once per distinct blob
+
+Each metric's content looks like lint output of --lines findings, one of
+which changes on --change-rate of the pushes, used as both its
+measure_source and diffable_content like `measure_source_is_diffable` does.
+"unique" content changes entirely on every push, which is the worst case
+for deduplication. "inline" is the size of the same database downgraded to
+store a copy of the content in every row, as it used to.
+
+    python benchmarks/blob_storage.py --metrics 5 --pushes 200 --lines 300
+"""
+
+import argparse
+import contextlib
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterator
+
+from tabulate import tabulate
+
+from tinyalert import api
+from tinyalert.db import DB
+
+INLINE_REVISION = "f2461755f373"
+
+
+def lint_outputs(lines: int, change_rate: float, seed: int) -> Iterator[str]:
+    rng = random.Random(seed)
+    findings = [
+        f"src/pkg/module_{i % 40}.py:{i}:{rng.randint(1, 80)}: "
+        f"E501 line too long ({rng.randint(89, 120)} > 88 characters)"
+        for i in range(lines)
+    ]
+    while True:
+        yield "\n".join(findings)
+        if rng.random() < change_rate:
+            i = rng.randrange(lines)
+            findings[i] = f"src/pkg/module_{i % 40}.py:{i}:1: W291 trailing whitespace"
+
+
+def unique_outputs(lines: int, seed: int) -> Iterator[str]:
+    count = 0
+    while True:
+        count += 1
+        yield "\n".join(
+            f"push {count} finding {i} of seed {seed}" for i in range(lines)
+        )
+
+
+def file_size(path: Path) -> str:
+    # Vacuumed outside of DB, which would migrate the inline copy back up
+    with contextlib.closing(sqlite3.connect(path)) as conn:
+        conn.execute("VACUUM")
+    return f"{path.stat().st_size / 1024 / 1024:.2f} MiB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--metrics", type=int, default=5)
+    parser.add_argument("--pushes", type=int, default=100)
+    parser.add_argument("--lines", type=int, default=300)
+    parser.add_argument("--change-rate", type=float, default=0.1)
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for data in ["repetitive", "unique"]:
+            db = DB(Path(tmp) / f"{data}.sqlite")
+            db.migrate()
+            outputs = [
+                (
+                    lint_outputs(args.lines, args.change_rate, seed=m)
+                    if data == "repetitive"
+                    else unique_outputs(args.lines, seed=m)
+                )
+                for m in range(args.metrics)
+            ]
+
+            latencies = []
+            for _ in range(args.pushes):
+                for m, output in enumerate(outputs):
+                    content = next(output)
+                    start = time.perf_counter()
+                    api.push(
+                        db,
+                        f"metric-{m}",
+                        value=float(len(content)),
+                        measure_source=content,
+                        diffable_content=content,
+                    )
+                    latencies.append(time.perf_counter() - start)
+
+            inline = DB(Path(tmp) / f"{data}-inline.sqlite")
+            shutil.copy(db.db_path, inline.db_path)
+            inline.run_alembic("downgrade", INLINE_REVISION)
+            rows.append(
+                {
+                    "data": data,
+                    "points": len(latencies),
+                    "push mean": f"{statistics.mean(latencies) * 1000:.2f} ms",
+                    "push p95": (
+                        f"{statistics.quantiles(latencies, n=20)[-1] * 1000:.2f} ms"
+                    ),
+                    "blobs size": file_size(db.db_path),
+                    "inline size": file_size(inline.db_path),
+                }
+            )
+
+    print(tabulate(rows, headers="keys"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""File size, push latency and report throughput per compression
+
+Every push stores lint-like output of --lines findings that differs from all
+others, so that deduplication of identical content doesn't hide the effect
+of compression.
+
+    python benchmarks/compression.py --metrics 5 --pushes 100 --lines 300
+"""
+
+import argparse
+import contextlib
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from tabulate import tabulate
+
+from tinyalert import api
+from tinyalert.db import DB
+from tinyalert.types import Compression
+
+
+def lint_output(rng: random.Random, lines: int) -> str:
+    return "\n".join(
+        f"src/pkg/module_{rng.randrange(40)}.py:{rng.randrange(1000)}:"
+        f"{rng.randint(1, 80)}: E501 line too long ({rng.randint(89, 120)} > 88 "
+        "characters)"
+        for _ in range(lines)
+    )
+
+
+def file_size(path: Path) -> str:
+    with contextlib.closing(sqlite3.connect(path)) as conn:
+        conn.execute("VACUUM")
+    return f"{path.stat().st_size / 1024 / 1024:.2f} MiB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--metrics", type=int, default=5)
+    parser.add_argument("--pushes", type=int, default=100)
+    parser.add_argument("--lines", type=int, default=300)
+    parser.add_argument("--reports", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for compression in Compression:
+            db = DB(Path(tmp) / f"{compression.value}.sqlite", compression=compression)
+            db.migrate()
+            rng = random.Random(0)
+
+            latencies = []
+            for _ in range(args.pushes):
+                for m in range(args.metrics):
+                    content = lint_output(rng, args.lines)
+                    start = time.perf_counter()
+                    api.push(
+                        db,
+                        f"metric-{m}",
+                        value=float(len(content)),
+                        measure_source=content,
+                        diffable_content=content,
+                    )
+                    latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for _ in range(args.reports):
+                api.gather_all_report_data(db)
+            report_rate = args.reports / (time.perf_counter() - start)
+
+            rows.append(
+                {
+                    "compression": compression.value,
+                    "file size": file_size(db.db_path),
+                    "push mean": f"{statistics.mean(latencies) * 1000:.2f} ms",
+                    "report/s": f"{report_rate:,.0f}",
+                }
+            )
+
+    print(tabulate(rows, headers="keys"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""File size, push latency and report throughput with delta-encoded content
+
+Every push stores lint-like diffable content of --lines findings that
+differs from the previous push of the metric by a few lines, so that no two
+contents are identical and only deltas can share what they have in common.
+Compares full copies against deltas with a keyframe every
+--keyframe-interval contents, both compressed with zlib.
+
+    python benchmarks/delta_storage.py --metrics 5 --pushes 500 --lines 300
+"""
+
+import argparse
+import contextlib
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from tabulate import tabulate
+
+from tinyalert import api
+from tinyalert.db import DB
+from tinyalert.types import Compression
+
+
+def lint_outputs(rng: random.Random, metric_count: int, lines: int):
+    findings = [
+        [f"src/pkg/module_{m}.py:{i}: E501 line too long" for i in range(lines)]
+        for m in range(metric_count)
+    ]
+    count = 0
+    while True:
+        count += 1
+        for m in range(metric_count):
+            for _ in range(rng.randint(1, 3)):
+                findings[m][
+                    rng.randrange(lines)
+                ] = f"src/pkg/module_{m}.py:{count}: W291 trailing whitespace"
+            yield m, "\n".join(findings[m])
+
+
+def file_size(path: Path) -> str:
+    with contextlib.closing(sqlite3.connect(path)) as conn:
+        conn.execute("VACUUM")
+    return f"{path.stat().st_size / 1024 / 1024:.2f} MiB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--metrics", type=int, default=5)
+    parser.add_argument("--pushes", type=int, default=200)
+    parser.add_argument("--lines", type=int, default=300)
+    parser.add_argument("--keyframe-interval", type=int, default=50)
+    parser.add_argument("--reports", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for storage, keyframe_interval in [
+            ("full", None),
+            ("delta", args.keyframe_interval),
+        ]:
+            db = DB(
+                Path(tmp) / f"{storage}.sqlite",
+                compression=Compression.zlib,
+                keyframe_interval=keyframe_interval,
+            )
+            db.migrate()
+            outputs = lint_outputs(random.Random(0), args.metrics, args.lines)
+
+            latencies = []
+            for _ in range(args.pushes * args.metrics):
+                m, content = next(outputs)
+                start = time.perf_counter()
+                api.push(db, f"metric-{m}", value=1.0, diffable_content=content)
+                latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for _ in range(args.reports):
+                api.gather_all_report_data(db)
+            report_rate = args.reports / (time.perf_counter() - start)
+
+            rows.append(
+                {
+                    "storage": storage,
+                    "file size": file_size(db.db_path),
+                    "push mean": f"{statistics.mean(latencies) * 1000:.2f} ms",
+                    "report/s": f"{report_rate:,.0f}",
+                }
+            )
+
+    print(tabulate(rows, headers="keys"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Wall time of measuring many metrics from one command's output
+
+Compares --metrics exec-raw metrics that each run a command printing their
+value against as many metrics that measure their own key in the output of
+a single command printing all the values, as JSON or as `name value`
+lines. Every command takes --latency seconds like a coverage or bundle
+analyzer would.
+
+    python benchmarks/fan_out.py --metrics 40 --latency 0.1
+"""
+
+import argparse
+import json
+import shlex
+import time
+
+from tabulate import tabulate
+
+from tinyalert import api
+from tinyalert.types import MetricConfig
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--metrics", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--jobs", type=int, default=1)
+    args = parser.parse_args()
+
+    names = [f"metric-{m}" for m in range(args.metrics)]
+    sleep = f"sleep {args.latency}"
+    json_output = shlex.quote(json.dumps({name: m for m, name in enumerate(names)}))
+    pairs_output = shlex.quote("\n".join(f"{name} {m}" for m, name in enumerate(names)))
+    configs = {
+        "raw": [
+            MetricConfig(
+                name=name,
+                measure_source=f"{sleep}; echo {m}",
+                measure_type="shell-raw",
+            )
+            for m, name in enumerate(names)
+        ],
+        "json": [
+            MetricConfig(
+                name=name,
+                measure_source=f"{sleep}; echo {json_output}",
+                measure_type="shell-json",
+            )
+            for name in names
+        ],
+        "pairs": [
+            MetricConfig(
+                name=name,
+                measure_source=f"{sleep}; echo {pairs_output}",
+                measure_type="shell-pairs",
+            )
+            for name in names
+        ],
+    }
+
+    rows = []
+    for measure_type, metrics in configs.items():
+        start = time.perf_counter()
+        measurements = api.measure_metrics(metrics, jobs=args.jobs)
+        elapsed = time.perf_counter() - start
+        assert [m.result.value for m in measurements] == list(range(args.metrics))
+        rows.append(
+            {
+                "measure type": measure_type,
+                "wall time": f"{elapsed:.2f} s",
+                "metrics/s": f"{len(metrics) / elapsed:,.0f}",
+            }
+        )
+
+    print(tabulate(rows, headers="keys"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Wall time of measuring unchanged metrics with and without the cache
+
+Each of --metrics metrics counts the lines of its own file of --lines lines,
+none of which change between measurements. "file" metrics read the file,
+and "exec" ones run a command that takes --latency seconds like a linter
+would, declaring the file as its input. The files are last modified well
+before they're measured, so that fingerprints are trusted without hashing
+the files again.
+
+    python benchmarks/measure_cache.py --metrics 80 --lines 2000 --latency 0.05
+"""
+
+import argparse
+import itertools
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from tabulate import tabulate
+
+from tinyalert import api
+from tinyalert.db import DB
+from tinyalert.types import MetricConfig
+
+
+def measure(db: DB, metrics, cache: bool) -> float:
+    start = time.perf_counter()
+    measurements = api.measure_metrics(metrics, cache_db=db if cache else None)
+    api.push_many(
+        db,
+        [
+            api.make_point(
+                m.metric.name,
+                value=m.result.value,
+                measure_source=m.result.source,
+                diffable_content=m.diffable_content,
+            )
+            for m in measurements
+        ],
+    )
+    if cache:
+        api.cache_measurements(db, measurements)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--metrics", type=int, default=80)
+    parser.add_argument("--lines", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        old = time.time_ns() - 60 * 10**9
+        paths = []
+        for m in range(args.metrics):
+            path = Path(tmp) / f"metric-{m}.txt"
+            path.write_text("".join(f"{m} finding {i}\n" for i in range(args.lines)))
+            os.utime(path, ns=(old, old))
+            paths.append(str(path))
+        metrics = {
+            "file": [
+                MetricConfig(name=f"metric-{m}", measure_source=path)
+                for m, path in enumerate(paths)
+            ],
+            "exec": [
+                MetricConfig(
+                    name=f"metric-{m}",
+                    measure_source=f"sleep {args.latency}; cat {path}",
+                    measure_type="shell-lines",
+                    inputs=[path],
+                )
+                for m, path in enumerate(paths)
+            ],
+        }
+
+        for kind, cache in itertools.product(metrics, [False, True]):
+            db = DB(Path(tmp) / f"{kind}-{cache}.sqlite")
+            db.migrate()
+            first = measure(db, metrics[kind], cache)
+            rest = [measure(db, metrics[kind], cache) for _ in range(args.runs)]
+            rows.append(
+                {
+                    "metrics": kind,
+                    "cache": cache,
+                    "first run": f"{first:.2f} s",
+                    "unchanged run": f"{statistics.median(rest):.3f} s",
+                }
+            )
+
+    print(tabulate(rows, headers="keys"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Peak memory and time of counting the lines of a long command output
+
+Measures `seq --lines` as an exec-lines metric, with the whole output kept
+and with it capped at --max-output-bytes.
+
+    python benchmarks/output_cap.py --lines 5000000 --max-output-bytes 65536
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from tabulate import tabulate
+
+from tinyalert import api
+from tinyalert.types import MeasureType
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=5_000_000)
+    parser.add_argument("--max-output-bytes", type=int, default=64 * 1024)
+    args = parser.parse_args()
+
+    rows = []
+    for max_output_bytes in [None, args.max_output_bytes]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = api.measure(
+            f"seq {args.lines}",
+            MeasureType.model_validate("exec-lines"),
+            max_output_bytes=max_output_bytes,
+        )
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert result.value == args.lines
+        rows.append(
+            {
+                "max_output_bytes": max_output_bytes,
+                "stored": f"{len(result.source) / 1024 / 1024:.2f} MiB",
+                "peak memory": f"{peak / 1024 / 1024:.2f} MiB",
+                "time": f"{elapsed:.2f} s",
+            }
+        )
+
+    print(tabulate(rows, headers="keys"))
+
+
+if __name__ == "__main__":
+    main()
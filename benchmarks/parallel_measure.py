@@ -0,0 +1,56 @@
+"""Wall time of measuring many exec metrics per --jobs
+
+Every metric runs a shell command that sleeps for --latency seconds before
+printing its value, like a linter or a bundle size script would take a
+while to. --sources distinct commands are shared among the metrics the
+way several metrics may count the output of one linter.
+
+    python benchmarks/parallel_measure.py --metrics 80 --sources 20 --latency 0.05
+"""
+
+import argparse
+import time
+
+from tabulate import tabulate
+
+from tinyalert import api
+from tinyalert.types import MetricConfig
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--metrics", type=int, default=80)
+    parser.add_argument("--sources", type=int, default=None)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    sources = args.sources or args.metrics
+    metrics = [
+        MetricConfig(
+            name=f"metric-{m}",
+            measure_source=f"sleep {args.latency}; echo {m % sources}",
+            measure_type="shell-raw",
+        )
+        for m in range(args.metrics)
+    ]
+
+    rows = []
+    for jobs in args.jobs:
+        start = time.perf_counter()
+        measurements = api.measure_metrics(metrics, jobs=jobs)
+        elapsed = time.perf_counter() - start
+        assert all(m.error is None for m in measurements)
+        rows.append(
+            {
+                "jobs": jobs,
+                "wall time": f"{elapsed:.2f} s",
+                "metrics/s": f"{len(metrics) / elapsed:,.0f}",
+            }
+        )
+
+    print(tabulate(rows, headers="keys"))
+
+
+if __name__ == "__main__":
+    main()
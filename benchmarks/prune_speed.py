@@ -0,0 +1,81 @@
+"""Time to prune all metrics, set-based versus one metric at a time
+
+"per-metric" replicates how api.prune used to load every metric's history
+and delete the points before its cutoff with DB.prune_before; "set-based"
+is the current DB.prune. Both run on copies of the same database.
+
+    python benchmarks/prune_speed.py --metrics 50 --points 200,400 --keep-last 10
+"""
+
+import argparse
+import datetime
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from tabulate import tabulate
+
+from tinyalert import api
+from tinyalert.db import DB
+
+
+def fill(db: DB, metric_count: int, points_per_metric: int) -> None:
+    start = datetime.datetime(2020, 1, 1)
+    db.add_many(
+        api.make_point(f"metric-{i % metric_count}", value=float(i)).model_copy(
+            update=dict(time=start + datetime.timedelta(minutes=i))
+        )
+        for i in range(metric_count * points_per_metric)
+    )
+
+
+def per_metric_prune(db: DB, keep_last: int) -> int:
+    pruned = 0
+    for metric_name in list(db.iter_metric_names()):
+        points = list(db.recent(metric_name, count=None))
+        if points:
+            pruned += db.prune_before(points[min(keep_last, len(points)) - 1])
+    return pruned
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--metrics", type=int, default=50)
+    parser.add_argument("--points", default="200,400")
+    parser.add_argument("--keep-last", default="10,1000")
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for points in [int(p) for p in args.points.split(",")]:
+            template = Path(tmp) / f"{points}.sqlite"
+            template_db = DB(template)
+            template_db.migrate()
+            fill(template_db, args.metrics, points)
+            for keep_last in [int(k) for k in args.keep_last.split(",")]:
+                for name, prune in (
+                    ("per-metric", lambda db: per_metric_prune(db, keep_last)),
+                    ("set-based", lambda db: db.prune(keep_last=keep_last)),
+                ):
+                    path = Path(tmp) / f"{points}-{keep_last}-{name}.sqlite"
+                    shutil.copy(template, path)
+                    db = DB(path)
+                    started = time.perf_counter()
+                    pruned = prune(db)
+                    rows.append(
+                        dict(
+                            metrics=args.metrics,
+                            points=points,
+                            keep_last=keep_last,
+                            implementation=name,
+                            pruned=pruned,
+                            time=f"{time.perf_counter() - started:.3f} s",
+                        )
+                    )
+
+    print(tabulate(rows, headers="keys"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Per-metric query cost as the total number of points grows
+
+Fills databases of increasing size with points spread over many metrics and
+times the per-metric queries that report and prune run, with and without
+the (metric_id, time, id) index.
+
+    python benchmarks/query_scaling.py --sizes 10000,100000,1000000
+"""
+
+import argparse
+import datetime
+import tempfile
+import timeit
+from pathlib import Path
+
+from sqlalchemy import text
+from tabulate import tabulate
+
+from tinyalert import api
+from tinyalert.db import DB
+
+INDEX_NAME = "ix_points_metric_id_time_id"
+
+
+def fill(db: DB, total: int, metric_count: int) -> None:
+    start = datetime.datetime(2020, 1, 1)
+    db.add_many(
+        api.make_point(f"metric-{i % metric_count}", value=float(i)).model_copy(
+            update=dict(time=start + datetime.timedelta(minutes=i))
+        )
+        for i in range(total)
+    )
+
+
+def time_queries(db: DB, metric_name: str, number: int) -> dict:
+    return dict(
+        recent=timeit.timeit(
+            lambda: list(db.recent(metric_name, count=10)), number=number
+        )
+        / number,
+        skip_latest=timeit.timeit(lambda: db.skip_latest(metric_name), number=number)
+        / number,
+        metric_names=timeit.timeit(lambda: list(db.iter_metric_names()), number=number)
+        / number,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000")
+    parser.add_argument("--metrics", type=int, default=100)
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in [int(s) for s in args.sizes.split(",")]:
+            db = DB(Path(tmp) / f"{size}.sqlite")
+            db.migrate()
+            fill(db, size, args.metrics)
+            for indexed in (True, False):
+                if not indexed:
+                    with db.session() as session:
+                        session.execute(text(f"DROP INDEX {INDEX_NAME}"))
+                        session.commit()
+                timings = time_queries(db, "metric-0", args.number)
+                rows.append(
+                    dict(
+                        points=size,
+                        indexed=indexed,
+                        **{k: f"{v * 1000:.3f} ms" for k, v in timings.items()},
+                    )
+                )
+
+    print(tabulate(rows, headers="keys"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Peak memory of report and prune on a database with large text columns
+
+Every point carries a measure_source and diffable_content of --blob-size
+bytes, like stored lint outputs. Compares loading whole histories with all
+columns against the deferred, streaming read paths that report and prune use.
+
+    python benchmarks/report_memory.py --metrics 20 --points 50 --blob-size 1000000
+"""
+
+import argparse
+import datetime
+import shutil
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+from tabulate import tabulate
+
+from tinyalert import api
+from tinyalert.db import DB
+
+
+def fill(db: DB, metric_count: int, points_per_metric: int, blob_size: int) -> None:
+    start = datetime.datetime(2020, 1, 1)
+    for i in range(points_per_metric):
+        # Vary the content so that nothing can be shared between rows
+        blob = (f"{i:08d}" * (blob_size // 8 + 1))[:blob_size]
+        db.add_many(
+            api.make_point(
+                f"metric-{m}",
+                value=float(i),
+                measure_source=blob,
+                diffable_content=blob,
+            ).model_copy(update=dict(time=start + datetime.timedelta(hours=i)))
+            for m in range(metric_count)
+        )
+
+
+def eager_report(db: DB) -> None:
+    for metric_name in db.iter_metric_names():
+        points = list(db.recent(metric_name, count=None, with_content=True))
+        [p.diffable_content for p in points[:2]]
+
+
+def deferred_report(db: DB) -> None:
+    for metric_name in db.iter_metric_names():
+        api.gather_report_data(db, metric_name)
+
+
+def batched_report(db: DB) -> None:
+    api.gather_all_report_data(db)
+
+
+def prune(db: DB) -> None:
+    api.prune(db, keep_auto=True)
+
+
+def peak_memory(func, db: DB) -> int:
+    tracemalloc.start()
+    try:
+        func(db)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--metrics", type=int, default=10)
+    parser.add_argument("--points", type=int, default=50)
+    parser.add_argument("--blob-size", type=int, default=100_000)
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        template = DB(Path(tmp) / "template.sqlite")
+        template.migrate()
+        fill(template, args.metrics, args.points, args.blob_size)
+        for name, func in [
+            ("report, full history with text columns", eager_report),
+            ("report, streamed and deferred", deferred_report),
+            ("report, batched", batched_report),
+            ("prune --keep-auto", prune),
+        ]:
+            path = Path(tmp) / f"{func.__name__}.sqlite"
+            shutil.copy(template.db_path, path)
+            peak = peak_memory(func, DB(path))
+            rows.append(dict(operation=name, peak=f"{peak / 1024 / 1024:.1f} MiB"))
+
+    print(tabulate(rows, headers="keys"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Rows per second through the ORM versus the Core read and write paths
+
+"orm" replicates how DB.add, DB.add_many and DB.recent used to go through
+ORM instances (and, for add, back through pydantic); "core" is the current
+DB implementation returning PointRecord tuples.
+
+    python benchmarks/rows_per_second.py --rows 100000
+"""
+
+import argparse
+import datetime
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import insert, select
+from tabulate import tabulate
+
+from tinyalert import api, types
+from tinyalert.db import (
+    DB,
+    Point,
+    _contents,
+    _ensure_blob_ids,
+    _ensure_metric_ids,
+    _point_row,
+    _point_values,
+)
+
+
+def orm_row(session, point):
+    values = _point_values(point)
+    metric_ids = _ensure_metric_ids(session.connection(), [point.metric_name])
+    blob_ids = _ensure_blob_ids(session.connection(), _contents([values]))
+    return _point_row(values, metric_ids, blob_ids)
+
+
+def orm_add(db: DB, points):
+    for point in points:
+        with db.session() as session:
+            db_point = Point(**orm_row(session, point))
+            session.add(db_point)
+            session.commit()
+            types.Point.model_validate(db_point)
+
+
+def core_add(db: DB, points):
+    for point in points:
+        db.add(point)
+
+
+def orm_add_many(db: DB, points):
+    with db.session() as session:
+        session.execute(insert(Point), [orm_row(session, p) for p in points])
+        session.commit()
+
+
+def core_add_many(db: DB, points):
+    db.add_many(points)
+
+
+def orm_recent(db: DB, points):
+    with db.session() as session:
+        for (point,) in session.execute(select(Point).order_by(Point.time.desc())):
+            types.Point.model_validate(point)
+
+
+def core_recent(db: DB, points):
+    for point in db.recent(count=None, with_content=True):
+        types.Point.model_validate(point)
+
+
+def rows_per_second(func, db: DB, points) -> float:
+    start = time.perf_counter()
+    func(db, points)
+    return len(points) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20_000)
+    parser.add_argument(
+        "--single-rows",
+        type=int,
+        default=500,
+        help="Number of rows for one-transaction-per-row add",
+    )
+    args = parser.parse_args()
+
+    start = datetime.datetime(2020, 1, 1)
+    points = [
+        api.make_point(
+            f"metric-{i % 100}",
+            value=float(i),
+            measure_source="source",
+            diffable_content="content",
+            tags={"branch": "main"},
+        ).model_copy(update=dict(time=start + datetime.timedelta(seconds=i)))
+        for i in range(args.rows)
+    ]
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for operation, orm, core, n in [
+            ("add", orm_add, core_add, args.single_rows),
+            ("add_many", orm_add_many, core_add_many, args.rows),
+            ("recent", orm_recent, core_recent, args.rows),
+        ]:
+            result = dict(operation=operation)
+            for name, func in (("orm", orm), ("core", core)):
+                db = DB(Path(tmp) / f"{operation}-{name}.sqlite")
+                db.migrate()
+                if operation == "recent":
+                    db.add_many(points[:n])
+                result[f"{name} rows/s"] = (
+                    f"{rows_per_second(func, db, points[:n]):,.0f}"
+                )
+            rows.append(result)
+
+    print(tabulate(rows, headers="keys"))
+
+
+if __name__ == "__main__":
+    main()
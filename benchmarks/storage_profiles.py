@@ -0,0 +1,83 @@
+"""Push and report throughput under each storage profile
+
+"push" stores one point per transaction like `tinyalert push`, "push_many"
+stores them all at once like `tinyalert measure`. The readonly and
+immutable profiles can't write, so their databases are filled with the
+default profile first.
+
+    python benchmarks/storage_profiles.py --pushes 1000 --metrics 100
+"""
+
+import argparse
+import datetime
+import tempfile
+import time
+from pathlib import Path
+
+from tabulate import tabulate
+
+from tinyalert import api
+from tinyalert.db import DB, READ_ONLY_URI_PARAMETERS
+from tinyalert.types import StorageProfile
+
+
+def make_points(count: int, metric_count: int):
+    start = datetime.datetime(2020, 1, 1)
+    return [
+        api.make_point(
+            f"metric-{i % metric_count}",
+            value=float(i),
+            diffable_content="content",
+            tags={"branch": "main"},
+        ).model_copy(update=dict(time=start + datetime.timedelta(seconds=i)))
+        for i in range(count)
+    ]
+
+
+def per_second(func, count: int) -> str:
+    start = time.perf_counter()
+    func()
+    return f"{count / (time.perf_counter() - start):,.0f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pushes", type=int, default=500)
+    parser.add_argument("--metrics", type=int, default=50)
+    parser.add_argument("--reports", type=int, default=20)
+    args = parser.parse_args()
+
+    points = make_points(args.pushes, args.metrics)
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for profile in StorageProfile:
+            writable = profile not in READ_ONLY_URI_PARAMETERS
+            fill_profile = profile if writable else StorageProfile.default
+            result = dict(profile=profile.value)
+
+            db = DB(Path(tmp) / f"{profile.value}-push.sqlite", profile=fill_profile)
+            db.migrate()
+
+            def push():
+                for point in points:
+                    db.add(point)
+
+            result["push/s"] = per_second(push, len(points)) if writable else "-"
+
+            db = DB(Path(tmp) / f"{profile.value}.sqlite", profile=fill_profile)
+            db.migrate()
+            rate = per_second(lambda: db.add_many(points), len(points))
+            result["push_many rows/s"] = rate if writable else "-"
+
+            db = DB(db.db_path, profile=profile)
+            result["report/s"] = per_second(
+                lambda: [api.gather_all_report_data(db) for _ in range(args.reports)],
+                args.reports,
+            )
+            rows.append(result)
+
+    print(tabulate(rows, headers="keys"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Store time as UTC microseconds
+
+Revision ID: 00e50b3b5265
+Revises: e856cde000af
+Create Date: 2026-10-16 18:02:37.519460
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "00e50b3b5265"
+down_revision = "e856cde000af"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Times were stored as "YYYY-MM-DD HH:MM:SS.ffffff" text in UTC
+    op.add_column("points", sa.Column("time_us", sa.Integer(), nullable=True))
+    op.execute(
+        "UPDATE points SET time_us = "
+        "CAST(strftime('%s', substr(time, 1, 19)) AS INTEGER) * 1000000 "
+        "+ CAST(substr(time, 21, 6) AS INTEGER)"
+    )
+    _swap_time_column("time_us", sa.Integer())
+
+
+def downgrade() -> None:
+    op.add_column("points", sa.Column("time_text", sa.DateTime(), nullable=True))
+    op.execute(
+        "UPDATE points SET time_text = "
+        "strftime('%Y-%m-%d %H:%M:%S', time / 1000000, 'unixepoch') "
+        "|| printf('.%06d', time % 1000000)"
+    )
+    _swap_time_column("time_text", sa.DateTime())
+
+
+def _swap_time_column(new_column: str, type_: sa.types.TypeEngine) -> None:
+    op.drop_index("ix_points_metric_id_time_id", table_name="points")
+    with op.batch_alter_table("points") as batch_op:
+        batch_op.drop_column("time")
+        batch_op.alter_column(
+            new_column, new_column_name="time", existing_type=type_, nullable=False
+        )
+    op.create_index(
+        "ix_points_metric_id_time_id",
+        "points",
+        ["metric_id", "time", "id"],
+        unique=False,
+    )
@@ -0,0 +1,29 @@
+"""Enable incremental auto_vacuum
+
+Revision ID: 962fe3917799
+Revises: e9d3ceac85a9
+Create Date: 2026-10-16 15:27:03.774590
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "962fe3917799"
+down_revision = "e9d3ceac85a9"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Changing auto_vacuum on an existing database only takes effect after a
+    # VACUUM, which can't run inside a transaction
+    with op.get_context().autocommit_block():
+        op.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        op.execute("VACUUM")
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute("PRAGMA auto_vacuum = NONE")
+        op.execute("VACUUM")
@@ -0,0 +1,90 @@
+"""Move content to blobs table
+
+Revision ID: a97dddb201cb
+Revises: f2461755f373
+Create Date: 2026-10-16 19:54:08.231746
+
+"""
+
+import hashlib
+import lzma
+import zlib
+from typing import Optional, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "a97dddb201cb"
+down_revision = "f2461755f373"
+branch_labels = None
+depends_on = None
+
+CONTENT_COLUMNS = ("measure_source", "diffable_content")
+
+
+def upgrade() -> None:
+    op.create_table(
+        "blobs",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("hash", sa.String(length=64), nullable=False),
+        sa.Column("content", sa.TEXT(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_blobs_hash", "blobs", ["hash"], unique=True)
+
+    # SHA-256 of the UTF-8 encoded content in hex
+    op.get_bind().connection.driver_connection.create_function(
+        "content_hash", 1, _content_hash, deterministic=True
+    )
+    for column in CONTENT_COLUMNS:
+        op.add_column("points", sa.Column(f"{column}_id", sa.Integer(), nullable=True))
+        op.execute(
+            "INSERT OR IGNORE INTO blobs (hash, content) "
+            f"SELECT content_hash({column}), {column} FROM points "
+            f"WHERE {column} IS NOT NULL"
+        )
+        op.execute(
+            f"UPDATE points SET {column}_id = (SELECT id FROM blobs "
+            f"WHERE hash = content_hash(points.{column})) "
+            f"WHERE {column} IS NOT NULL"
+        )
+    with op.batch_alter_table("points") as batch_op:
+        for column in CONTENT_COLUMNS:
+            batch_op.create_foreign_key(
+                f"fk_points_{column}_id_blobs", "blobs", [f"{column}_id"], ["id"]
+            )
+            batch_op.drop_column(column)
+
+
+def downgrade() -> None:
+    # Content may have been compressed since
+    op.get_bind().connection.driver_connection.create_function(
+        "content_text", 1, _content_text, deterministic=True
+    )
+    for column in CONTENT_COLUMNS:
+        op.add_column("points", sa.Column(column, sa.TEXT(), nullable=True))
+        op.execute(
+            f"UPDATE points SET {column} = (SELECT content_text(content) "
+            f"FROM blobs WHERE blobs.id = points.{column}_id)"
+        )
+    with op.batch_alter_table("points") as batch_op:
+        for column in CONTENT_COLUMNS:
+            batch_op.drop_constraint(f"fk_points_{column}_id_blobs", type_="foreignkey")
+            batch_op.drop_column(f"{column}_id")
+    op.drop_index("ix_blobs_hash", table_name="blobs")
+    op.drop_table("blobs")
+
+
+def _content_hash(content: Optional[str]) -> Optional[str]:
+    if content is None:
+        return None
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _content_text(content: Optional[Union[str, bytes]]) -> Optional[str]:
+    if isinstance(content, bytes):
+        if content.startswith(b"\xfd7zXZ\x00"):
+            return lzma.decompress(content).decode()
+        return zlib.decompress(content).decode()
+    return content
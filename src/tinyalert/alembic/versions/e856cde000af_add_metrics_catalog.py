@@ -0,0 +1,107 @@
+"""Add metrics catalog
+
+Revision ID: e856cde000af
+Revises: 3b41c0fe5e71
+Create Date: 2026-10-16 17:21:09.843116
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e856cde000af"
+down_revision = "3b41c0fe5e71"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "metrics",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("name", sa.String(length=255), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_metrics_name", "metrics", ["name"], unique=True)
+    op.execute(
+        "INSERT INTO metrics (name) "
+        "SELECT DISTINCT metric_name FROM points ORDER BY metric_name"
+    )
+
+    op.add_column("points", sa.Column("metric_id", sa.Integer(), nullable=True))
+    op.execute(
+        "UPDATE points SET metric_id = "
+        "(SELECT id FROM metrics WHERE metrics.name = points.metric_name)"
+    )
+    op.drop_index("ix_points_metric_name_time_id", table_name="points")
+    with op.batch_alter_table("points") as batch_op:
+        batch_op.alter_column("metric_id", existing_type=sa.Integer(), nullable=False)
+        batch_op.create_foreign_key(
+            "fk_points_metric_id_metrics", "metrics", ["metric_id"], ["id"]
+        )
+        batch_op.drop_column("metric_name")
+    op.create_index(
+        "ix_points_metric_id_time_id",
+        "points",
+        ["metric_id", "time", "id"],
+        unique=False,
+    )
+
+    op.rename_table("metric_heads", "_metric_heads_old")
+    op.create_table(
+        "metric_heads",
+        sa.Column("metric_id", sa.Integer(), nullable=False),
+        sa.Column("latest_id", sa.Integer(), nullable=False),
+        sa.Column("previous_id", sa.Integer(), nullable=True),
+        sa.Column("latest_values", sa.JSON(), nullable=False),
+        sa.ForeignKeyConstraint(["metric_id"], ["metrics.id"]),
+        sa.PrimaryKeyConstraint("metric_id"),
+    )
+    op.execute(
+        "INSERT INTO metric_heads (metric_id, latest_id, previous_id, latest_values) "
+        "SELECT metrics.id, latest_id, previous_id, latest_values "
+        "FROM _metric_heads_old JOIN metrics ON metrics.name = metric_name"
+    )
+    op.drop_table("_metric_heads_old")
+
+
+def downgrade() -> None:
+    op.rename_table("metric_heads", "_metric_heads_new")
+    op.create_table(
+        "metric_heads",
+        sa.Column("metric_name", sa.String(length=255), nullable=False),
+        sa.Column("latest_id", sa.Integer(), nullable=False),
+        sa.Column("previous_id", sa.Integer(), nullable=True),
+        sa.Column("latest_values", sa.JSON(), nullable=False),
+        sa.PrimaryKeyConstraint("metric_name"),
+    )
+    op.execute(
+        "INSERT INTO metric_heads (metric_name, latest_id, previous_id, latest_values) "
+        "SELECT metrics.name, latest_id, previous_id, latest_values "
+        "FROM _metric_heads_new JOIN metrics ON metrics.id = metric_id"
+    )
+    op.drop_table("_metric_heads_new")
+
+    op.add_column(
+        "points", sa.Column("metric_name", sa.String(length=255), nullable=True)
+    )
+    op.execute(
+        "UPDATE points SET metric_name = "
+        "(SELECT name FROM metrics WHERE metrics.id = points.metric_id)"
+    )
+    op.drop_index("ix_points_metric_id_time_id", table_name="points")
+    with op.batch_alter_table("points") as batch_op:
+        batch_op.alter_column(
+            "metric_name", existing_type=sa.String(length=255), nullable=False
+        )
+        batch_op.drop_constraint("fk_points_metric_id_metrics", type_="foreignkey")
+        batch_op.drop_column("metric_id")
+    op.create_index(
+        "ix_points_metric_name_time_id",
+        "points",
+        ["metric_name", "time", "id"],
+        unique=False,
+    )
+    op.drop_index("ix_metrics_name", table_name="metrics")
+    op.drop_table("metrics")
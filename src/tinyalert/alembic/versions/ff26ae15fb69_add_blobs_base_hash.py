@@ -0,0 +1,81 @@
+"""Add blobs.base_hash
+
+Revision ID: ff26ae15fb69
+Revises: a97dddb201cb
+Create Date: 2026-10-16 20:41:52.604118
+
+"""
+
+import json
+import lzma
+import zlib
+from typing import Dict
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "ff26ae15fb69"
+down_revision = "a97dddb201cb"
+branch_labels = None
+depends_on = None
+
+DELTA_MAGIC = b"\x00delta\x00"
+
+
+def upgrade() -> None:
+    op.add_column("blobs", sa.Column("base_hash", sa.String(length=64), nullable=True))
+    op.create_index("ix_blobs_base_hash", "blobs", ["base_hash"], unique=False)
+
+
+def downgrade() -> None:
+    # Deltas get stored in full, as text, since their base may not be
+    # referred to by any point anymore
+    conn = op.get_bind()
+    blobs = dict(
+        conn.execute(
+            sa.text(
+                "SELECT hash, content FROM blobs WHERE hash IN "
+                "(SELECT base_hash FROM blobs) OR base_hash IS NOT NULL"
+            )
+        ).all()
+    )
+    resolved: Dict[str, str] = {}
+
+    def resolve(content_hash: str) -> str:
+        if content_hash not in resolved:
+            content = blobs[content_hash]
+            if isinstance(content, bytes) and content.startswith(DELTA_MAGIC):
+                base_hash, delta = json.loads(
+                    zlib.decompress(content[len(DELTA_MAGIC) :])
+                )
+                base_lines = resolve(base_hash).splitlines(keepends=True)
+                content = "".join(
+                    (
+                        line_op
+                        if isinstance(line_op, str)
+                        else "".join(base_lines[line_op[0] : line_op[1]])
+                    )
+                    for line_op in delta
+                )
+            elif isinstance(content, bytes):
+                # Compressed, which keyframes stay as in the table
+                content = _decompress(content)
+            resolved[content_hash] = content
+        return resolved[content_hash]
+
+    for content_hash, content in blobs.items():
+        if isinstance(content, bytes) and content.startswith(DELTA_MAGIC):
+            conn.execute(
+                sa.text("UPDATE blobs SET content = :content WHERE hash = :hash"),
+                dict(content=resolve(content_hash), hash=content_hash),
+            )
+    op.drop_index("ix_blobs_base_hash", table_name="blobs")
+    with op.batch_alter_table("blobs") as batch_op:
+        batch_op.drop_column("base_hash")
+
+
+def _decompress(content: bytes) -> str:
+    if content.startswith(b"\xfd7zXZ\x00"):
+        return lzma.decompress(content).decode()
+    return zlib.decompress(content).decode()
@@ -1,19 +1,51 @@
 import datetime
+import functools
+import glob
+import hashlib
+import itertools
+import json
+import os
+import re
 import shlex
+import signal
 import subprocess
-from pathlib import Path
-from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    TextIO,
+    Tuple,
+    Union,
+)
 
-from .db import DB
+from .db import (
+    DB,
+    DEFAULT_CHUNK_SIZE,
+    HEAD_VALUE_COUNT,
+    Head,
+    InputFingerprint,
+    MeasureCacheEntry,
+)
 from .db import Point as DBPoint
 from .types import (
     EvalType,
     GenerationMatchStatus,
     MeasureResult,
     MeasureType,
+    MetricConfig,
+    MetricMeasurement,
     Point,
     ReportData,
     SourceType,
+    VacuumMode,
 )
 
 
@@ -33,7 +65,47 @@ def push(
     generation: int = 0,
     tags: Dict[str, Any] = None,
 ) -> Point:
-    p = Point(
+    p = make_point(
+        metric_name,
+        value=value,
+        absolute_max=absolute_max,
+        absolute_min=absolute_min,
+        relative_max=relative_max,
+        relative_min=relative_min,
+        measure_source=measure_source,
+        diffable_content=diffable_content,
+        url=url,
+        skipped=skipped,
+        epoch=epoch,
+        generation=generation,
+        tags=tags,
+    )
+    db.add(p)
+    return p
+
+
+def push_many(
+    db: DB, points: Iterable[Point], chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> int:
+    return db.add_many(points, chunk_size=chunk_size)
+
+
+def make_point(
+    metric_name: str,
+    value: Optional[float] = None,
+    absolute_max: Optional[float] = None,
+    absolute_min: Optional[float] = None,
+    relative_max: Optional[float] = None,
+    relative_min: Optional[float] = None,
+    measure_source: Optional[str] = None,
+    diffable_content: Optional[str] = None,
+    url: Optional[str] = None,
+    skipped: bool = False,
+    epoch: int = 0,
+    generation: int = 0,
+    tags: Dict[str, Any] = None,
+) -> Point:
+    return Point(
         metric_name=metric_name,
         time=datetime.datetime.now(datetime.timezone.utc),
         metric_value=value,
@@ -49,38 +121,471 @@ def push(
         generation=generation,
         tags=tags or {},
     )
-    return db.add(p)
 
 
-def measure(source: str, method: MeasureType) -> MeasureResult:
-    source_content = eval_source(source, method.source_type)
-    if method.eval_type == EvalType.lines:
-        return MeasureResult(
-            value=len(source_content.splitlines()), source=source_content
+OUTPUT_CHUNK_SIZE = 64 * 1024
+
+# What str.splitlines() splits on. Text streams already translate "\r" and
+# "\r\n" to "\n", so "\r\n" doesn't get split across chunks.
+_LINE_BREAK = re.compile("\r\n|[\n\r\x0b\x0c\x1c-\x1e\x85\u2028\u2029]")
+
+# Fields of a MetricConfig that its measurement depends on
+MEASUREMENT_FIELDS = {
+    "measure_source",
+    "measure_type",
+    "measure_key",
+    "diffable_source",
+    "diffable_type",
+    "measure_source_is_diffable",
+    "max_output_bytes",
+    "inputs",
+}
+
+
+def measure(
+    source: str,
+    method: MeasureType,
+    timeout: Optional[float] = None,
+    max_output_bytes: Optional[int] = None,
+    key: Optional[str] = None,
+) -> MeasureResult:
+    output = _eval_source(source, method.source_type, timeout, max_output_bytes)
+    return _measure_output(source, method, output, max_output_bytes, key, _parse)
+
+
+def measure_metrics(
+    metrics: List[MetricConfig], jobs: int = 1, cache_db: Optional[DB] = None
+) -> List[MetricMeasurement]:
+    # With cache_db, metrics whose config and input files are the same as
+    # when they were last measured reuse that measurement. See
+    # cache_measurements().
+    keys = _cache_keys(cache_db, metrics) if cache_db is not None else {}
+    cached = cache_db.cached_measurements(keys) if keys else {}
+    measured = iter(
+        _measure_all([metric for metric in metrics if metric.name not in cached], jobs)
+    )
+    measurements = []
+    for metric in metrics:
+        if metric.name in cached:
+            entry = cached[metric.name]
+            measurements.append(
+                MetricMeasurement(
+                    metric=metric,
+                    result=MeasureResult(
+                        value=entry.value, source=entry.measure_source
+                    ),
+                    diffable_content=entry.diffable_content,
+                    cached=True,
+                    cache_key=entry.key,
+                )
+            )
+        else:
+            measurements.append(
+                next(measured).model_copy(update=dict(cache_key=keys.get(metric.name)))
+            )
+    return measurements
+
+
+def cache_measurements(db: DB, measurements: List[MetricMeasurement]) -> int:
+    return db.cache_measurements(
+        MeasureCacheEntry(
+            metric_name=m.metric.name,
+            key=m.cache_key,
+            value=m.result.value,
+            measure_source=m.result.source,
+            diffable_content=m.diffable_content,
+        )
+        for m in measurements
+        if m.cache_key is not None and m.error is None and not m.cached
+    )
+
+
+def _measure_all(metrics: List[MetricConfig], jobs: int) -> List[MetricMeasurement]:
+    # Metrics that share a source share a single evaluation and parse of it
+    memo = _SourceMemo()
+    measure = functools.partial(
+        _measure_metric, evaluate=memo.eval_source, parse=memo.parse
+    )
+    # Sources mostly wait on subprocesses, so threads are enough to overlap them
+    if jobs <= 1 or len(metrics) <= 1:
+        return [measure(metric) for metric in metrics]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(measure, metrics))
+
+
+def _measure_metric(
+    metric: MetricConfig,
+    evaluate: Callable[..., "_SourceOutput"],
+    parse: Callable[["_SourceOutput", EvalType], Any],
+) -> MetricMeasurement:
+    try:
+        output = evaluate(
+            metric.measure_source,
+            metric.measure_type.source_type,
+            metric.timeout,
+            metric.max_output_bytes,
+        )
+        result = _measure_output(
+            metric.measure_source,
+            metric.measure_type,
+            output,
+            metric.max_output_bytes,
+            metric.measure_key or metric.name,
+            parse,
         )
+        diffable_content = None
+        if metric.diffable_source:
+            diffable_content = evaluate(
+                metric.diffable_source,
+                metric.diffable_type,
+                metric.timeout,
+                metric.max_output_bytes,
+            ).content
+        elif metric.measure_source_is_diffable:
+            diffable_content = result.source
+    except Exception as e:
+        return MetricMeasurement(metric=metric, error=str(e) or type(e).__name__)
+    return MetricMeasurement(
+        metric=metric, result=result, diffable_content=diffable_content
+    )
+
+
+def _measure_output(
+    source: str,
+    method: MeasureType,
+    output: "_SourceOutput",
+    max_output_bytes: Optional[int],
+    key: Optional[str],
+    parse: Callable[["_SourceOutput", EvalType], Any],
+) -> MeasureResult:
+    if method.eval_type == EvalType.lines:
+        return MeasureResult(value=output.line_count, source=output.content)
+    if output.truncated:
+        raise Exception(f"Output of {source} is longer than {max_output_bytes} bytes")
     if method.eval_type == EvalType.raw:
-        return MeasureResult(value=float(source_content.strip()), source=source_content)
+        return MeasureResult(value=float(output.content.strip()), source=output.content)
+    if method.eval_type in (EvalType.json, EvalType.pairs):
+        if key is None:
+            raise Exception(f"No key to measure in output of {source}")
+        data = parse(output, method.eval_type)
+        if method.eval_type == EvalType.json:
+            value = _json_value(data, key)
+        else:
+            value = data.get(key)
+        if value is None:
+            raise Exception(f"No value for {key} in output of {source}")
+        return MeasureResult(value=float(value), source=output.content)
     raise Exception(f"Unknown measurement method: {method}")
 
 
-def eval_source(source: str, method: SourceType) -> str:
+def _json_value(data: Any, key: str) -> Any:
+    # Value of a key of an object, or of a dotted path through nested
+    # objects. Keys that have dots themselves take precedence.
+    if not isinstance(data, dict):
+        return None
+    if key in data:
+        return data[key]
+    head, dot, rest = key.partition(".")
+    if not dot:
+        return None
+    return _json_value(data.get(head), rest)
+
+
+def _parse(output: "_SourceOutput", method: EvalType) -> Any:
+    if method == EvalType.json:
+        return json.loads(output.content)
+    if method == EvalType.pairs:
+        return _parse_pairs(output.content)
+    raise Exception(f"Unknown parse method: {method}")
+
+
+def _parse_pairs(content: str) -> Dict[str, str]:
+    # Values of lines that read "key value", where the key is everything up
+    # to the last whitespace. The first of lines with the same key wins.
+    values: Dict[str, str] = {}
+    for line in content.splitlines():
+        fields = line.rsplit(None, 1)
+        if len(fields) == 2:
+            values.setdefault(fields[0].strip(), fields[1])
+    return values
+
+
+class _SourceMemo:
+    # Outputs of the sources evaluated so far, and what they parsed to, so
+    # that each source runs and parses once however many metrics of a run
+    # share it, concurrently or not. Failures are remembered too. Outputs
+    # differ by timeout and max_output_bytes, so those are part of the key.
+    # Everything is dropped with the memo at the end of the run.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._results: Dict[Tuple[Any, ...], Future] = {}
+
+    def eval_source(
+        self,
+        source: str,
+        method: SourceType,
+        timeout: Optional[float],
+        max_output_bytes: Optional[int],
+    ) -> "_SourceOutput":
+        return self._once(
+            ("eval", source, method, timeout, max_output_bytes),
+            lambda: _eval_source(source, method, timeout, max_output_bytes),
+        )
+
+    def parse(self, output: "_SourceOutput", method: EvalType) -> Any:
+        # Outputs are held in _results, so their ids aren't reused meanwhile
+        return self._once(("parse", id(output), method), lambda: _parse(output, method))
+
+    def _once(self, key: Tuple[Any, ...], compute: Callable[[], Any]) -> Any:
+        with self._lock:
+            result = self._results.get(key)
+            is_first = result is None
+            if is_first:
+                result = self._results[key] = Future()
+        if is_first:
+            try:
+                result.set_result(compute())
+            except Exception as e:
+                result.set_exception(e)
+        return result.result()
+
+
+def _cache_keys(db: DB, metrics: List[MetricConfig]) -> Dict[str, str]:
+    # Keys of the metrics whose input files are all known and readable
+    input_paths = {
+        metric.name: paths
+        for metric in metrics
+        for paths in [_input_paths(metric)]
+        if paths is not None
+    }
+    hashes = _input_hashes(db, set(itertools.chain(*input_paths.values())))
+    return {
+        metric.name: hashlib.sha256(
+            json.dumps(
+                [
+                    _measurement_config(metric),
+                    {path: hashes[path] for path in input_paths[metric.name]},
+                ],
+                sort_keys=True,
+            ).encode()
+        ).hexdigest()
+        for metric in metrics
+        if metric.name in input_paths
+        and all(path in hashes for path in input_paths[metric.name])
+    }
+
+
+def _measurement_config(metric: MetricConfig) -> Dict[str, Any]:
+    config = metric.model_dump(mode="json", include=MEASUREMENT_FIELDS)
+    if metric.measure_type.eval_type in (EvalType.json, EvalType.pairs):
+        # The name is looked up when no key is given, so a rename changes it
+        config["measure_key"] = metric.measure_key or metric.name
+    return config
+
+
+def _input_paths(metric: MetricConfig) -> Optional[List[str]]:
+    # Files that the measurement of the metric depends on, or None if that
+    # isn't known because it runs a command with no declared inputs
+    sources = [(metric.measure_source, metric.measure_type.source_type)]
+    if metric.diffable_source:
+        sources.append((metric.diffable_source, metric.diffable_type))
+    paths = [source for source, method in sources if method == SourceType.file_]
+    if len(paths) < len(sources) and not metric.inputs:
+        return None
+    for pattern in metric.inputs:
+        paths += sorted(
+            path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path)
+        )
+    return paths
+
+
+def _input_hashes(db: DB, paths: Iterable[str]) -> Dict[str, str]:
+    # SHA-256 of the files at the given paths, hashing only the ones whose
+    # fingerprint changed since they were last hashed. Files that can't be
+    # read are left out.
+    checked_at = time.time_ns()
+    stats = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        stats[path] = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    # Fingerprints are stored by absolute path, which the same file may be
+    # given more than one relative path for
+    known = db.input_hashes(
+        {abs_path: (mtime_ns, size) for abs_path, mtime_ns, size in stats.values()}
+    )
+    fingerprints = {}
+    for abs_path, mtime_ns, size in stats.values():
+        if abs_path in known or abs_path in fingerprints:
+            continue
+        try:
+            file_hash = _file_hash(abs_path)
+        except OSError:
+            continue
+        fingerprints[abs_path] = InputFingerprint(
+            abs_path, mtime_ns, size, file_hash, checked_at
+        )
+        known[abs_path] = file_hash
+    db.update_input_files(fingerprints.values())
+    return {
+        path: known[abs_path]
+        for path, (abs_path, _, _) in stats.items()
+        if abs_path in known
+    }
+
+
+def _file_hash(path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(OUTPUT_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def eval_source(
+    source: str,
+    method: SourceType,
+    timeout: Optional[float] = None,
+    max_output_bytes: Optional[int] = None,
+) -> str:
+    return _eval_source(source, method, timeout, max_output_bytes).content
+
+
+class _SourceOutput(NamedTuple):
+    # Truncated to max_output_bytes, while line_count is of the whole output
+    content: str
+    line_count: int
+    truncated: bool
+
+
+def _eval_source(
+    source: str,
+    method: SourceType,
+    timeout: Optional[float],
+    max_output_bytes: Optional[int],
+) -> _SourceOutput:
     if method == SourceType.exec_:
-        return subprocess.check_output(shlex.split(source), text=True).strip()
+        return _run_command(shlex.split(source), False, timeout, max_output_bytes)
     if method == SourceType.shell:
-        return subprocess.check_output(source, shell=True, text=True).strip()
+        return _run_command(source, True, timeout, max_output_bytes)
     if method == SourceType.file_:
-        return Path(source).read_text()
+        with open(source) as f:
+            return _read_output(f, False, max_output_bytes)
     raise Exception(f"Unknown source type: {method}")
 
 
-def skip_latest(db: DB, metric_name: str):
-    db.skip_latest(metric_name)
+def _run_command(
+    args: Union[str, List[str]],
+    shell: bool,
+    timeout: Optional[float],
+    max_output_bytes: Optional[int],
+) -> _SourceOutput:
+    timed_out = threading.Event()
+    with subprocess.Popen(
+        args, shell=shell, stdout=subprocess.PIPE, text=True, start_new_session=True
+    ) as process:
+
+        def kill_on_timeout():
+            timed_out.set()
+            _kill(process)
+
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, kill_on_timeout)
+            timer.start()
+        try:
+            output = _read_output(process.stdout, True, max_output_bytes)
+            returncode = process.wait()
+        except BaseException:
+            # Don't leave the command running when interrupted
+            _kill(process)
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(args, timeout)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, args)
+    return output
+
+
+def _kill(process: subprocess.Popen):
+    if not hasattr(os, "killpg"):
+        process.kill()
+        return
+    # The command runs in a session of its own, so that this also kills
+    # whatever a shell has started
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _read_output(
+    stream: TextIO, strip: bool, max_output_bytes: Optional[int]
+) -> _SourceOutput:
+    # Lines are counted as the output streams in, so that no more than
+    # max_output_bytes of it is held in memory. Counts are the same as
+    # len(content.splitlines()) of the whole (stripped) output.
+    kept: List[str] = []
+    kept_bytes = 0
+    truncated = False
+    line_count = 0
+    # Line breaks after the last non-whitespace character, which only
+    # separate lines in stripped output if more text follows
+    trailing_newlines = 0
+    has_text = False
+    last_char = ""
+    for chunk in iter(lambda: stream.read(OUTPUT_CHUNK_SIZE), ""):
+        last_char = chunk[-1]
+        text_end = len(chunk.rstrip())
+        if not strip:
+            line_count += _count_line_breaks(chunk, 0, len(chunk))
+        elif text_end:
+            text_start = 0 if has_text else len(chunk) - len(chunk.lstrip())
+            line_count += trailing_newlines + _count_line_breaks(
+                chunk, text_start, text_end
+            )
+            trailing_newlines = _count_line_breaks(chunk, text_end, len(chunk))
+            has_text = True
+        elif has_text:
+            trailing_newlines += _count_line_breaks(chunk, 0, len(chunk))
+
+        if truncated:
+            continue
+        if max_output_bytes is None:
+            kept.append(chunk)
+            continue
+        encoded = chunk.encode()
+        if kept_bytes + len(encoded) > max_output_bytes:
+            encoded = encoded[: max_output_bytes - kept_bytes]
+            truncated = True
+        kept_bytes += len(encoded)
+        kept.append(encoded.decode(errors="ignore"))
+
+    content = "".join(kept)
+    if strip:
+        return _SourceOutput(content.strip(), line_count + has_text, truncated)
+    return _SourceOutput(
+        content,
+        line_count + bool(last_char and not _LINE_BREAK.match(last_char)),
+        truncated,
+    )
+
 
+def _count_line_breaks(chunk: str, start: int, end: int) -> int:
+    return sum(1 for _ in _LINE_BREAK.finditer(chunk, start, end))
 
-def combine(dest_db: DB, src_dbs: List[DB]):
-    for src_db in src_dbs:
-        for p in src_db.iter_all():
-            dest_db.add(Point.model_validate(p))
+
+def skip_latest(db: DB, metric_name: str, tags: Optional[Dict[str, Any]] = None):
+    db.skip_latest(metric_name, tags=tags)
+
+
+def combine(dest_db: DB, src_dbs: List[DB]) -> int:
+    return sum(dest_db.copy_from(src_db) for src_db in src_dbs)
 
 
 def prune(
@@ -88,110 +593,129 @@ def prune(
     keep_last: Optional[int] = None,
     keep_within: Optional[datetime.timedelta] = None,
     keep_auto: bool = False,
+    vacuum: VacuumMode = VacuumMode.full,
+    vacuum_pages: Optional[int] = None,
 ) -> int:
-    total_pruned = 0
-    for metric_name in db.iter_metric_names():
-        points = list(db.recent(metric_name, count=None))
-
-        auto_prune_before = _prune_point_auto(points)
-        prune_candidates = list(
-            filter(
-                None,
-                (
-                    _prune_point_last(points, keep_last),
-                    _prune_point_within(points, auto_prune_before, keep_within),
-                    auto_prune_before if keep_auto else None,
-                ),
-            )
-        )
-
-        if not prune_candidates:
-            continue
-
-        # Take the oldest point
-        prune_before = sorted(prune_candidates, key=lambda p: (p.time, p.id))[0]
-        total_pruned += db.prune_before(prune_before)
+    total_pruned = db.prune(
+        keep_last=keep_last, keep_within=keep_within, keep_auto=keep_auto
+    )
 
     if total_pruned > 0:
-        db.vacuum()
+        if vacuum == VacuumMode.full:
+            db.vacuum()
+        elif vacuum == VacuumMode.incremental:
+            db.incremental_vacuum(vacuum_pages)
 
     return total_pruned
 
 
-def _prune_point_last(
-    points: List[DBPoint], keep_last: Optional[int]
-) -> Optional[DBPoint]:
-    assert keep_last is None or keep_last > 0
-    if not points:
-        return
-    if keep_last is None:
-        return
-    if len(points) < keep_last:
-        return points[-1]
-    return points[keep_last - 1]
-
-
-def _prune_point_within(
-    points: List[DBPoint],
-    auto_prune_before: Optional[DBPoint],
-    keep_within: Optional[datetime.timedelta],
-) -> Optional[DBPoint]:
-    assert keep_within is None or keep_within.total_seconds() > 0
-    assert points
-    if keep_within is None:
-        return
-    if len(points) == 1:
-        return points[0]
-    anchor_point = auto_prune_before or points[0]
-    keep_within_abs = anchor_point.time - keep_within
-    prune_before = points[1]
-    for p in points[2:]:
-        if p.time < keep_within_abs:
-            break
-        prune_before = p
-    return prune_before
+def rename(db: DB, from_name: str, to_name: str) -> int:
+    return db.rename(from_name, to_name)
 
 
-def _prune_point_auto(points: List[DBPoint]) -> Optional[DBPoint]:
-    if not points:
-        return
-    if len(points) == 1:
-        return points[0]
+def recent(
+    db: DB,
+    count: int = 10,
+    tags: Optional[Dict[str, Any]] = None,
+    with_content: bool = False,
+) -> Iterator[Point]:
+    assert count > 0, "count must be greater than 0"
+    for p in db.recent(count=count, tags=tags, with_content=with_content):
+        yield Point.model_validate(p)
 
-    current_epoch_points = list(_iter_current_epoch_points(points))
-    eligible_points = _iter_alert_eligible_points(current_epoch_points)
-    latest, previous, _ = _report_points(eligible_points)
 
-    if latest and not latest.skipped:
-        return latest
-    elif previous:
-        return previous
-    return current_epoch_points[-1] if current_epoch_points else None
+def gather_report_data(
+    db: DB,
+    metric_name: str,
+    head_generation: Optional[int] = None,
+    tags: Optional[Dict[str, Any]] = None,
+) -> ReportData:
+    if tags:
+        # Heads are only kept for the unfiltered history
+        return _gather_report_data_from_history(db, metric_name, head_generation, tags)
+    heads = list(db.heads(metric_name))
+    if not heads:
+        return ReportData(metric_name=metric_name)
+    return _head_report_data(heads[0], head_generation)
 
 
-def rename(db: DB, from_name: str, to_name: str) -> int:
-    return db.rename(from_name, to_name)
+def gather_all_report_data(
+    db: DB,
+    head_generation: Optional[int] = None,
+    tags: Optional[Dict[str, Any]] = None,
+) -> Dict[str, ReportData]:
+    if tags:
+        reports = {}
+        for metric_name in db.iter_metric_names():
+            report = _gather_report_data_from_history(
+                db, metric_name, head_generation, tags
+            )
+            if report.latest_values:
+                reports[metric_name] = report
+        return reports
+    return {
+        head.metric_name: _head_report_data(head, head_generation)
+        for head in db.heads()
+    }
 
 
-def recent(db: DB, count: int = 10) -> Iterator[Point]:
-    assert count > 0, "count must be greater than 0"
-    for p in db.recent(count=count):
-        yield Point.model_validate(p)
+def rebuild_heads(db: DB) -> int:
+    return db.rebuild_heads()
 
 
-def gather_report_data(
-    db: DB, metric_name: str, head_generation: Optional[int] = None
+def check_heads(db: DB) -> List[str]:
+    # Names of the metrics whose head doesn't match what their history says
+    reports = gather_all_report_data(db)
+    metric_names = sorted(set(reports.keys()) | set(db.iter_metric_names()))
+    return [
+        metric_name
+        for metric_name in metric_names
+        if reports.get(metric_name) != _gather_report_data_from_history(db, metric_name)
+    ]
+
+
+def _gather_report_data_from_history(
+    db: DB,
+    metric_name: str,
+    head_generation: Optional[int] = None,
+    tags: Optional[Dict[str, Any]] = None,
 ) -> ReportData:
-    data = ReportData(metric_name=metric_name)
-    points = list(db.recent(metric_name, count=None))
+    with db.history(metric_name, tags=tags) as points:
+        if not points:
+            return ReportData(metric_name=metric_name)
+
+        eligible_points = _iter_alert_eligible_points(points, head_generation)
+        latest, previous, generation_status = _report_points(eligible_points)
+        recent_points = list(itertools.islice(points, HEAD_VALUE_COUNT))
+        return _build_report_data(
+            metric_name,
+            [p.metric_value for p in reversed(recent_points)],
+            latest,
+            previous,
+            generation_status,
+        )
 
-    if not points:
-        return data
 
-    data.latest_values = [p.metric_value for p in reversed(points[:10])]
+def _head_report_data(head: Head, head_generation: Optional[int]) -> ReportData:
+    return _build_report_data(
+        head.metric_name,
+        head.latest_values,
+        head.latest,
+        head.previous,
+        _generation_status(head.latest, head_generation),
+    )
+
+
+def _build_report_data(
+    metric_name: str,
+    latest_values: List[Optional[float]],
+    latest: Optional[DBPoint],
+    previous: Optional[DBPoint],
+    generation_status: Optional[GenerationMatchStatus],
+) -> ReportData:
+    data = ReportData(metric_name=metric_name)
+    data.latest_values = latest_values
 
-    eligible_points = _iter_alert_eligible_points(points, head_generation)
-    latest, previous, generation_status = _report_points(eligible_points)
     if generation_status:
         data.generation_status = generation_status
     if latest:
@@ -220,7 +744,7 @@ def _report_points(
     return (latest, previous, generation_status)
 
 
-def _iter_current_epoch_points(all_points: Sequence[DBPoint]) -> Iterator[DBPoint]:
+def _iter_current_epoch_points(all_points: Iterable[DBPoint]) -> Iterator[DBPoint]:
     active_epoch = None
     for i, p in enumerate(all_points):
         if i == 0:
@@ -231,21 +755,26 @@ def _iter_current_epoch_points(all_points: Sequence[DBPoint]) -> Iterator[DBPoin
 
 
 def _iter_alert_eligible_points(
-    all_points: Sequence[DBPoint],
+    all_points: Iterable[DBPoint],
     head_generation: Optional[int] = None,
     check_epoch: bool = True,
 ) -> Iterator[Tuple[DBPoint, GenerationMatchStatus]]:
-    generation_status = (
-        GenerationMatchStatus.NONE_SPECIFIED
-        if head_generation is None
-        else GenerationMatchStatus.NONE_MATCHED
-    )
+    generation_status = None
     for i, p in enumerate(_iter_current_epoch_points(all_points)):
         if i == 0:
-            if head_generation is not None and p.generation == head_generation:
-                generation_status = GenerationMatchStatus.MATCHED
+            generation_status = _generation_status(p, head_generation)
             yield p, generation_status
             continue
         if p.skipped:
             continue
         yield p, generation_status
+
+
+def _generation_status(
+    latest: DBPoint, head_generation: Optional[int]
+) -> GenerationMatchStatus:
+    if head_generation is None:
+        return GenerationMatchStatus.NONE_SPECIFIED
+    if latest.generation == head_generation:
+        return GenerationMatchStatus.MATCHED
+    return GenerationMatchStatus.NONE_MATCHED
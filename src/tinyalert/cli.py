@@ -1,7 +1,7 @@
 import json
 import sys
 from pathlib import Path
-from typing import Any, List, Optional
+from typing import Any, Dict, List, Optional
 
 import click
 import tomli
@@ -9,7 +9,7 @@ import tomli
 from . import api, db
 from .cli_helpers import Duration
 from .reporters import DiffReporter, ListReporter, StatusReporter, TableReporter
-from .types import Config
+from .types import Compression, Config, StorageProfile, VacuumMode
 
 ENVVAR_PREFIX = "TINYALERT_"
 
@@ -21,7 +21,40 @@ class JSONType(click.ParamType):
         return json.loads(value)
 
 
-@click.group()
+class CLIGroup(click.Group):
+    def invoke(self, ctx: click.Context):
+        try:
+            return self._invoke(ctx)
+        except db.ReadOnlyDatabaseError as e:
+            raise click.ClickException(str(e)) from e
+
+    def _invoke(self, ctx: click.Context):
+        if not ctx.params["in_memory"]:
+            return super().invoke(ctx)
+        # Wraps the subcommand itself, since resources registered on the
+        # context are closed without the exception. ctx.exit() is the command
+        # finishing with an exit code of its choosing, so its changes are kept.
+        ctx.obj = _open_db(ctx.params)
+        finished = None
+        with ctx.obj.in_memory():
+            try:
+                return super().invoke(ctx)
+            except click.exceptions.Exit as e:
+                finished = e
+        raise finished
+
+
+def _open_db(params: Dict[str, Any]) -> db.DB:
+    return db.DB(
+        params["db_path"],
+        profile=StorageProfile(params["db_profile"]),
+        compression=params["compression"] and Compression(params["compression"]),
+        compression_threshold=params["compression_threshold"],
+        keyframe_interval=params["keyframe_interval"],
+    )
+
+
+@click.group(cls=CLIGroup)
 @click.option(
     "--db",
     "db_path",
@@ -30,9 +63,73 @@ class JSONType(click.ParamType):
     type=click.Path(exists=False),
     show_default=True,
 )
+@click.option(
+    "--db-profile",
+    type=click.Choice([profile.value for profile in StorageProfile]),
+    default=StorageProfile.default.value,
+    help=(
+        "How the database trades durability for speed. "
+        "'durable' syncs every commit to disk and 'ci-fast' never syncs. "
+        "'readonly' opens the database read-only without creating or migrating "
+        "it, and 'immutable' also skips locking for a file nothing writes to"
+    ),
+    envvar=ENVVAR_PREFIX + "DB_PROFILE",
+    show_default=True,
+)
+@click.option(
+    "--in-memory",
+    is_flag=True,
+    help=(
+        "Work on a copy of the database in memory, and replace the database "
+        "file with it once the command finishes"
+    ),
+    envvar=ENVVAR_PREFIX + "IN_MEMORY",
+)
+@click.option(
+    "--compression",
+    type=click.Choice([compression.value for compression in Compression]),
+    default=None,
+    help=(
+        "How to compress measure sources and diffable contents that get stored. "
+        "Saved in the database for later runs that don't give one. Stored "
+        "contents are read however they were compressed  [default: the "
+        "database's, else none]"
+    ),
+    envvar=ENVVAR_PREFIX + "COMPRESSION",
+)
+@click.option(
+    "--compression-threshold",
+    type=click.IntRange(min=0),
+    default=None,
+    help=(
+        "Size in bytes from which contents get compressed. Saved in the "
+        "database like --compression  [default: the database's, else "
+        f"{db.DEFAULT_COMPRESSION_THRESHOLD}]"
+    ),
+    envvar=ENVVAR_PREFIX + "COMPRESSION_THRESHOLD",
+)
+@click.option(
+    "--keyframe-interval",
+    type=click.IntRange(min=1),
+    default=None,
+    help=(
+        "Store diffable contents as line deltas against the next content of "
+        "the metric, with a full copy for every this many contents"
+    ),
+    envvar=ENVVAR_PREFIX + "KEYFRAME_INTERVAL",
+)
 @click.pass_context
-def cli(ctx, db_path):
-    ctx.obj = db.DB(db_path)
+def cli(
+    ctx,
+    db_path,
+    db_profile,
+    in_memory,
+    compression,
+    compression_threshold,
+    keyframe_interval,
+):
+    if ctx.obj is None:
+        ctx.obj = _open_db(ctx.params)
 
 
 @cli.command()
@@ -165,6 +262,25 @@ def split_values(ctx, param, value):
     help="Key-value pair to store as a tag. Value is evaluated as JSON",
     envvar=ENVVAR_PREFIX + "JSON_TAGS",
 )
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of metrics to measure concurrently",
+    envvar=ENVVAR_PREFIX + "JOBS",
+    show_default=True,
+)
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    help=(
+        "Reuse the last measurement of metrics whose config and input files "
+        "haven't changed since"
+    ),
+    envvar=ENVVAR_PREFIX + "CACHE",
+    show_default=True,
+)
 @click.pass_context
 def measure(
     ctx: click.Context,
@@ -174,6 +290,8 @@ def measure(
     url: Optional[str],
     tags: list[tuple[str, str]],
     json_tags: list[tuple[str, Any]],
+    jobs: int,
+    cache: bool,
 ):
     raw = tomli.loads(Path(config_path).read_text())
     config = Config.model_validate(raw)
@@ -187,31 +305,48 @@ def measure(
         )
         ctx.exit(1)
     metrics_to_measure = metric_configs_by_name.keys() if metrics is None else metrics
-    for metric_name in metrics_to_measure:
-        metric = metric_configs_by_name[metric_name]
-        result = api.measure(metric.measure_source, metric.measure_type)
-        diffable_content = None
-        if metric.diffable_source:
-            diffable_content = api.eval_source(
-                metric.diffable_source, metric.diffable_type
+    measurements = api.measure_metrics(
+        [metric_configs_by_name[metric_name] for metric_name in metrics_to_measure],
+        jobs=jobs,
+        cache_db=ctx.obj if cache else None,
+    )
+    points = []
+    failed = False
+    for measurement in measurements:
+        metric = measurement.metric
+        if measurement.error is not None:
+            click.echo(
+                f"Failed to measure {metric.name}: {measurement.error}", err=True
+            )
+            failed = True
+            continue
+        points.append(
+            api.make_point(
+                metric.name,
+                value=measurement.result.value,
+                absolute_max=metric.absolute_max,
+                absolute_min=metric.absolute_min,
+                relative_max=metric.relative_max,
+                relative_min=metric.relative_min,
+                measure_source=measurement.result.source,
+                diffable_content=measurement.diffable_content,
+                url=url,
+                epoch=metric.epoch,
+                generation=generation,
+                tags=dict(tags + json_tags),
             )
-        elif metric.measure_source_is_diffable:
-            diffable_content = result.source
-        api.push(
-            ctx.obj,
-            metric.name,
-            value=result.value,
-            absolute_max=metric.absolute_max,
-            absolute_min=metric.absolute_min,
-            relative_max=metric.relative_max,
-            relative_min=metric.relative_min,
-            measure_source=result.source,
-            diffable_content=diffable_content,
-            url=url,
-            epoch=metric.epoch,
-            generation=generation,
-            tags=dict(tags + json_tags),
         )
+    api.push_many(ctx.obj, points)
+    if cache:
+        api.cache_measurements(ctx.obj, measurements)
+        click.echo(
+            "{} of {} metrics served from cache".format(
+                sum(m.cached for m in measurements), len(measurements)
+            ),
+            err=True,
+        )
+    if failed:
+        ctx.exit(1)
 
 
 @cli.command()
@@ -228,9 +363,18 @@ def combine(ctx, src_db_pattern):
 
 @cli.command()
 @click.option("--json", "output_format", flag_value="json")
+@click.option(
+    "--tag",
+    "tags",
+    type=(str, str),
+    multiple=True,
+    help="Only show points with this tag. Can be given more than once",
+)
 @click.pass_context
-def recent(ctx, output_format):
-    for p in api.recent(ctx.obj):
+def recent(ctx, output_format, tags):
+    # Only the JSON output has measure_source and diffable_content
+    with_content = output_format == "json"
+    for p in api.recent(ctx.obj, tags=dict(tags), with_content=with_content):
         if output_format == "json":
             print(p.model_dump_json())
         else:
@@ -256,18 +400,31 @@ def recent(ctx, output_format):
     ),
     show_default=True,
 )
+@click.option(
+    "--tag",
+    "tags",
+    type=(str, str),
+    multiple=True,
+    help="Only report on points with this tag. Can be given more than once",
+)
 @click.pass_context
-def report(ctx, generation, output_format, mute):
+def report(ctx, generation, output_format, mute, tags):
+    if mute and ctx.obj.read_only:
+        raise click.UsageError(
+            f"--mute marks points as skipped, which the read-only "
+            f"'{ctx.obj.profile.value}' profile can't do"
+        )
     reports = {}
     list_reporter = ListReporter()
     table_reporter = TableReporter()
     diff_reporter = DiffReporter()
     status_reporter = StatusReporter()
 
-    for metric_name in ctx.obj.iter_metric_names():
-        report_data = api.gather_report_data(ctx.obj, metric_name, generation)
+    for metric_name, report_data in api.gather_all_report_data(
+        ctx.obj, generation, tags=dict(tags)
+    ).items():
         if mute and report_data.violates_limits:
-            api.skip_latest(ctx.obj, metric_name)
+            api.skip_latest(ctx.obj, metric_name, tags=dict(tags))
         reports[metric_name] = report_data
         table_reporter.add(report_data)
         list_reporter.add(report_data)
@@ -329,14 +486,36 @@ def report(ctx, generation, output_format, mute):
         "Previous epoch gets pruned"
     ),
 )
+@click.option(
+    "--vacuum",
+    type=click.Choice([mode.value for mode in VacuumMode]),
+    default=VacuumMode.full.value,
+    help=(
+        "How to reclaim disk space after pruning. "
+        "'full' rewrites the whole database file, 'incremental' only releases "
+        "free pages and 'none' leaves the file as is"
+    ),
+    show_default=True,
+)
+@click.option(
+    "--vacuum-pages",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Maximum number of pages to release with --vacuum=incremental",
+)
 @click.pass_context
-def prune(ctx, keep_last, keep_within, keep_auto):
+def prune(ctx, keep_last, keep_within, keep_auto, vacuum, vacuum_pages):
     if keep_last is None and keep_within is None and not keep_auto:
         raise click.UsageError(
             "Must specify at least one of --keep-last, --keep-within or --keep-auto"
         )
     count = api.prune(
-        ctx.obj, keep_last=keep_last, keep_within=keep_within, keep_auto=keep_auto
+        ctx.obj,
+        keep_last=keep_last,
+        keep_within=keep_within,
+        keep_auto=keep_auto,
+        vacuum=VacuumMode(vacuum),
+        vacuum_pages=vacuum_pages,
     )
     click.echo(f"Pruned {count} points in total")
 
@@ -350,6 +529,26 @@ def rename(ctx, from_name, to_name):
     click.echo(f"Renamed {count} points from {from_name} to {to_name}")
 
 
+@cli.command()
+@click.option(
+    "--check",
+    is_flag=True,
+    help="Only check that each metric's head matches its history",
+)
+@click.pass_context
+def rebuild_heads(ctx, check):
+    if check:
+        mismatched = api.check_heads(ctx.obj)
+        for metric_name in mismatched:
+            click.echo(f"Head of {metric_name} doesn't match its history", err=True)
+        if mismatched:
+            ctx.exit(1)
+        click.echo("All heads match their history")
+        return
+    count = api.rebuild_heads(ctx.obj)
+    click.echo(f"Rebuilt heads of {count} metrics")
+
+
 @cli.command(
     context_settings=dict(
         ignore_unknown_options=True,
@@ -1,136 +1,1071 @@
 import contextlib
 import datetime
+import difflib
+import functools
+import hashlib
+import itertools
+import json
+import lzma
+import os
+import sqlite3
+import zlib
 from argparse import Namespace
 from pathlib import Path
-from typing import Generator, Optional, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
+from urllib.parse import quote, urlencode
 
 import alembic.config
-from sqlalchemy import create_engine, delete, select, text, update
-from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column
-from sqlalchemy.types import JSON, TEXT, String
+import alembic.script
+from sqlalchemy import (
+    Column,
+    ColumnElement,
+    Connection,
+    ForeignKey,
+    Index,
+    Integer,
+    MetaData,
+    Select,
+    Subquery,
+    Table,
+    and_,
+    case,
+    cast,
+    create_engine,
+    delete,
+    event,
+    func,
+    insert,
+    literal,
+    null,
+    or_,
+    select,
+    text,
+    union,
+    update,
+)
+from sqlalchemy.orm import (
+    DeclarativeBase,
+    Mapped,
+    Session,
+    aliased,
+    column_property,
+    defer,
+    mapped_column,
+)
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.interfaces import ORMOption
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.types import JSON, TEXT, LargeBinary, String, TypeDecorator
 
 from . import types
 
+# Revision of the latest Alembic migration. Checked against the revision
+# stamped in the database so that up-to-date databases skip Alembic entirely.
+HEAD_REVISION = "7b35556890eb"
+
+# Number of rows sent to the database per executemany() call on bulk writes.
+DEFAULT_CHUNK_SIZE = 500
+
+# Number of rows fetched from the database at a time when streaming history.
+DEFAULT_FETCH_SIZE = 100
+
+# Number of most recent values kept per metric in metric_heads.
+HEAD_VALUE_COUNT = 10
+
+# Size in bytes from which content gets compressed, if compression is enabled.
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+
+# Files modified this close to when they were fingerprinted may have changed
+# again since without a change in mtime, so they get hashed regardless
+RACY_WINDOW_NS = 2 * 10**9
+
+# Connection pragmas of each storage profile:
+# - durable: write-ahead log, fsynced on every commit so that committed points
+#   survive a crash or power loss
+# - ci-fast: no fsyncs and the rollback journal kept in memory. A crash can
+#   corrupt the file, which is fine for one restored from a CI cache.
+# - readonly: rejects writes, with a bigger page cache and memory-mapped reads
+# - immutable: same as readonly for a file that nothing writes to while it's
+#   open, such as one restored from a CI cache
+PROFILE_PRAGMAS: Dict[types.StorageProfile, Dict[str, Union[str, int]]] = {
+    types.StorageProfile.default: {},
+    types.StorageProfile.durable: {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+    },
+    types.StorageProfile.ci_fast: {
+        "journal_mode": "MEMORY",
+        "synchronous": "OFF",
+        "temp_store": "MEMORY",
+        "cache_size": -64 * 1024,
+    },
+    types.StorageProfile.readonly: {
+        "query_only": "ON",
+        "cache_size": -64 * 1024,
+        "mmap_size": 256 * 1024 * 1024,
+    },
+    types.StorageProfile.immutable: {
+        "query_only": "ON",
+        "cache_size": -64 * 1024,
+        "mmap_size": 256 * 1024 * 1024,
+    },
+}
+
+# SQLite URI parameters of the profiles that open the file read-only. These
+# are neither migrated nor created. immutable=1 also skips file locking, so
+# any number of processes can read the file without contending for locks.
+READ_ONLY_URI_PARAMETERS: Dict[types.StorageProfile, Dict[str, str]] = {
+    types.StorageProfile.readonly: {"mode": "ro"},
+    types.StorageProfile.immutable: {"mode": "ro", "immutable": "1"},
+}
+
+T = TypeVar("T")
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+_XZ_MAGIC = b"\xfd7zXZ\x00"
+
+_DELTA_MAGIC = b"\x00delta\x00"
+
+
+class UTCMicroseconds(TypeDecorator):
+    # Datetimes stored as integer microseconds since the Unix epoch in UTC,
+    # so that they sort and compare as plain integers. Naive datetimes are
+    # taken to be in UTC, and are returned that way.
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(
+        self, value: Optional[datetime.datetime], dialect
+    ) -> Optional[int]:
+        if value is None:
+            return None
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return _microseconds(value - _EPOCH)
+
+    def process_result_value(
+        self, value: Optional[int], dialect
+    ) -> Optional[datetime.datetime]:
+        if value is None:
+            return None
+        return _EPOCH + datetime.timedelta(microseconds=value)
+
+    def coerce_compared_value(self, op, value):
+        # Offsetting by a number of microseconds
+        if isinstance(value, int):
+            return self.impl_instance
+        return super().coerce_compared_value(op, value)
+
+
+class _Delta(NamedTuple):
+    # Content stored as the lines that differ from the content with the hash
+    # base_hash. ops are, in order, [start, end) ranges of base lines to copy
+    # and strings of lines to insert.
+    base_hash: str
+    ops: List[Union[List[int], str]]
+
+    @classmethod
+    def between(cls, base_hash: str, base: str, content: str) -> "_Delta":
+        base_lines = base.splitlines(keepends=True)
+        lines = content.splitlines(keepends=True)
+        ops: List[Union[List[int], str]] = []
+        matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                ops.append([i1, i2])
+            elif tag != "delete":
+                ops.append("".join(lines[j1:j2]))
+        return cls(base_hash, ops)
+
+    @classmethod
+    def decode(cls, value: bytes) -> "_Delta":
+        return cls(*json.loads(zlib.decompress(value[len(_DELTA_MAGIC) :])))
+
+    def encode(self) -> bytes:
+        return _DELTA_MAGIC + zlib.compress(
+            json.dumps(list(self), separators=(",", ":")).encode()
+        )
+
+    def apply(self, base: str) -> str:
+        base_lines = base.splitlines(keepends=True)
+        return "".join(
+            op if isinstance(op, str) else "".join(base_lines[op[0] : op[1]])
+            for op in self.ops
+        )
+
+
+class _Keyframe(NamedTuple):
+    # Content stored in full, which gets stored as a delta against the next
+    # content of its metric
+    hash: str
+    content: str
+    # Number of blobs that are deltas against it, directly or not, plus one
+    group_size: int
+
+
+class CompressibleText(TypeDecorator):
+    # Text that is stored as is, compressed with zlib or lzma as a BLOB, see
+    # _encode_content(), or as a delta, see _Delta. It gets decompressed when
+    # it's loaded, but deltas need to be applied with _resolve_content().
+    impl = TEXT
+    cache_ok = True
+
+    def process_result_value(
+        self, value: Optional[Union[str, bytes]], dialect
+    ) -> Optional[Union[str, _Delta]]:
+        if isinstance(value, bytes):
+            if value.startswith(_DELTA_MAGIC):
+                return _Delta.decode(value)
+            if value.startswith(_XZ_MAGIC):
+                return lzma.decompress(value).decode()
+            return zlib.decompress(value).decode()
+        return value
+
 
 class Base(DeclarativeBase):
     pass
 
 
+class Metric(Base):
+    __tablename__ = "metrics"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(String(255))
+
+    __table_args__ = (Index("ix_metrics_name", "name", unique=True),)
+
+
+class Blob(Base):
+    # Content shared by the points that have it, stored once per distinct
+    # content. hash is the SHA-256 of the UTF-8 encoded content in hex.
+    __tablename__ = "blobs"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    hash: Mapped[str] = mapped_column(String(64))
+    content: Mapped[str] = mapped_column(CompressibleText)
+    # Hash of the blob that content is a delta against, if it is one. Bases
+    # are kept as long as deltas against them are, see _delete_points() and
+    # DB.copy_from().
+    base_hash: Mapped[Optional[str]] = mapped_column(String(64))
+
+    __table_args__ = (
+        Index("ix_blobs_hash", "hash", unique=True),
+        Index("ix_blobs_base_hash", "base_hash"),
+    )
+
+
+def _blob_content(blob_id: ColumnElement[Optional[int]]) -> ColumnElement[str]:
+    return (
+        select(Blob.content)
+        .where(Blob.id == blob_id)
+        .correlate_except(Blob)
+        .scalar_subquery()
+    )
+
+
 class Point(Base):
     __tablename__ = "points"
     id: Mapped[int] = mapped_column(primary_key=True)
-    time: Mapped[datetime.datetime] = mapped_column()
-    metric_name: Mapped[str] = mapped_column(String(255))
+    time: Mapped[datetime.datetime] = mapped_column(UTCMicroseconds)
+    metric_id: Mapped[int] = mapped_column(ForeignKey("metrics.id"))
+    # Read-only; filter on metric_id to make use of the index
+    metric_name: Mapped[str] = column_property(
+        select(Metric.name)
+        .where(Metric.id == metric_id)
+        .correlate_except(Metric)
+        .scalar_subquery()
+    )
     metric_value: Mapped[Optional[float]] = mapped_column()
     absolute_max: Mapped[Optional[float]] = mapped_column()
     absolute_min: Mapped[Optional[float]] = mapped_column()
     relative_max: Mapped[Optional[float]] = mapped_column()
     relative_min: Mapped[Optional[float]] = mapped_column()
     skipped: Mapped[bool] = mapped_column(server_default="0")
-    measure_source: Mapped[Optional[str]] = mapped_column(TEXT)
-    diffable_content: Mapped[Optional[str]] = mapped_column(TEXT)
+    measure_source_id: Mapped[Optional[int]] = mapped_column(ForeignKey("blobs.id"))
+    diffable_content_id: Mapped[Optional[int]] = mapped_column(ForeignKey("blobs.id"))
+    # Read-only
+    measure_source: Mapped[Optional[str]] = column_property(
+        _blob_content(measure_source_id)
+    )
+    diffable_content: Mapped[Optional[str]] = column_property(
+        _blob_content(diffable_content_id)
+    )
     url: Mapped[Optional[str]] = mapped_column()
     epoch: Mapped[int] = mapped_column(server_default="0")
     generation: Mapped[int] = mapped_column(server_default="0")
     tags: Mapped[str] = mapped_column(JSON, server_default="{}")
 
+    __table_args__ = (
+        # Serves every per-metric lookup ordered by recency
+        Index("ix_points_metric_id_time_id", "metric_id", "time", "id"),
+    )
+
+
+@event.listens_for(Point, "load")
+@event.listens_for(Point, "refresh")
+def _resolve_point_deltas(point: Point, context, attrs=None) -> None:
+    # Applies the deltas of content as it's loaded, deferred or not
+    for key in ("measure_source", "diffable_content"):
+        value = point.__dict__.get(key)
+        if isinstance(value, _Delta):
+            set_committed_value(
+                point, key, _resolve_content(context.session.connection(), value)
+            )
+
+
+class PointTag(Base):
+    # Copy of each point's tags, indexed for filtering. Values are stored as
+    # text, see _tag_value().
+    __tablename__ = "point_tags"
+    point_id: Mapped[int] = mapped_column(ForeignKey("points.id"), primary_key=True)
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    value: Mapped[str] = mapped_column(TEXT)
+
+    __table_args__ = (
+        Index("ix_point_tags_key_value_point_id", "key", "value", "point_id"),
+    )
+
+
+class MetricHead(Base):
+    # What report needs from each metric, kept up to date by every write so
+    # that reports don't depend on the length of the history
+    __tablename__ = "metric_heads"
+    metric_id: Mapped[int] = mapped_column(ForeignKey("metrics.id"), primary_key=True)
+    latest_id: Mapped[int] = mapped_column()
+    # Previous alert-eligible point, if any
+    previous_id: Mapped[Optional[int]] = mapped_column()
+    # Values of the most recent points, oldest first
+    latest_values: Mapped[List[Optional[float]]] = mapped_column(JSON)
+
+
+class Setting(Base):
+    # Settings of the database itself that apply to every run, as JSON
+    # values. Missing ones take their defaults, see DB.__init__().
+    __tablename__ = "settings"
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    value: Mapped[Any] = mapped_column(JSON)
+
+
+class InputFile(Base):
+    # Fingerprint of a file that metrics are measured from, so that measure
+    # only hashes it again once it has changed. checked_at is time.time_ns()
+    # as of the stat, see DB.input_hashes().
+    __tablename__ = "input_files"
+    path: Mapped[str] = mapped_column(TEXT, primary_key=True)
+    mtime_ns: Mapped[int] = mapped_column()
+    size: Mapped[int] = mapped_column()
+    hash: Mapped[str] = mapped_column(String(64))
+    checked_at: Mapped[int] = mapped_column()
+
+
+class CachedMeasurement(Base):
+    # Latest measurement of each metric, reused for as long as key, the hash
+    # of what it was measured from, stays the same
+    __tablename__ = "measure_cache"
+    metric_id: Mapped[int] = mapped_column(ForeignKey("metrics.id"), primary_key=True)
+    key: Mapped[str] = mapped_column(String(64))
+    value: Mapped[float] = mapped_column()
+    measure_source_id: Mapped[Optional[int]] = mapped_column(ForeignKey("blobs.id"))
+    diffable_content_id: Mapped[Optional[int]] = mapped_column(ForeignKey("blobs.id"))
+
+
+# Id of the oldest point to keep of each metric, filled in by DB.prune for the
+# duration of the delete
+_prune_cutoffs = Table(
+    "prune_cutoffs",
+    MetaData(),
+    Column("metric_id", Integer, primary_key=True),
+    Column("id", Integer, nullable=False),
+    prefixes=["TEMPORARY"],
+)
+
+
+class PointRecord(NamedTuple):
+    """Plain, read-only copy of a row in the points table
+
+    Used on hot paths instead of ORM instances, which are much more costly
+    to create and track.
+    """
+
+    id: int
+    time: datetime.datetime
+    metric_name: str
+    metric_value: Optional[float]
+    absolute_max: Optional[float]
+    absolute_min: Optional[float]
+    relative_max: Optional[float]
+    relative_min: Optional[float]
+    measure_source: Optional[str]
+    diffable_content: Optional[str]
+    url: Optional[str]
+    skipped: bool
+    epoch: int
+    generation: int
+    tags: Dict[str, Any]
+
+
+class InputFingerprint(NamedTuple):
+    path: str
+    mtime_ns: int
+    size: int
+    hash: str
+    checked_at: int
+
+
+class MeasureCacheEntry(NamedTuple):
+    metric_name: str
+    key: str
+    value: float
+    measure_source: Optional[str]
+    diffable_content: Optional[str]
+
+
+class Head(NamedTuple):
+    metric_name: str
+    latest_values: List[Optional[float]]
+    latest: Point
+    previous: Optional[Point]
+
+
+class ReadOnlyDatabaseError(Exception):
+    # The database can't be used as is, and a read-only profile can't create
+    # or migrate it
+    pass
+
 
 class DB:
-    def __init__(self, db_path: Union[Path, str], verbose: bool = False):
-        self.engine = create_engine(f"sqlite:///{db_path}", echo=verbose)
+    def __init__(
+        self,
+        db_path: Union[Path, str],
+        verbose: bool = False,
+        profile: types.StorageProfile = types.StorageProfile.default,
+        compression: Optional[types.Compression] = None,
+        compression_threshold: Optional[int] = None,
+        keyframe_interval: Optional[int] = None,
+    ):
+        self.engine = create_engine(_engine_url(db_path, profile), echo=verbose)
         self.db_path = Path(db_path)
+        self.profile = profile
+        self.read_only = profile in READ_ONLY_URI_PARAMETERS
+        # Settings stored in the database, which the ones given here replace
+        # when it's first opened for writing
+        self._setting_overrides = {
+            key: value
+            for key, value in [
+                ("compression", compression and types.Compression(compression).value),
+                ("compression_threshold", compression_threshold),
+            ]
+            if value is not None
+        }
+        self._settings: Optional[Dict[str, Any]] = None
+        # Opts into storing diffable content as a delta against the next
+        # diffable content of the metric, with a full copy for every this many
+        assert keyframe_interval is None or keyframe_interval > 0
+        self.keyframe_interval = keyframe_interval
         self._migrated = False
+        event.listen(
+            self.engine,
+            "connect",
+            functools.partial(_set_pragmas, PROFILE_PRAGMAS[profile]),
+        )
 
-    def add(self, point: types.Point):
-        with self.session() as session:
-            db_point = Point(
-                time=point.time,
-                metric_name=point.metric_name,
-                metric_value=point.metric_value,
-                absolute_max=point.absolute_max,
-                absolute_min=point.absolute_min,
-                relative_max=point.relative_max,
-                relative_min=point.relative_min,
-                measure_source=point.measure_source,
-                diffable_content=point.diffable_content,
-                url=point.url,
-                skipped=point.skipped,
-                epoch=point.epoch,
-                generation=point.generation,
-                tags=point.tags,
-            )
-            session.add(db_point)
-            session.commit()
-            return types.Point.model_validate(db_point)
-
-    def skip_latest(self, metric_name: str):
-        to_update = (
-            select(Point.id)
-            .filter_by(metric_name=metric_name)
-            .order_by(Point.time.desc(), Point.id.desc())
-            .limit(1)
+    @property
+    def compression(self) -> types.Compression:
+        return types.Compression(
+            self._setting("compression", types.Compression.none.value)
         )
+
+    @property
+    def compression_threshold(self) -> int:
+        return self._setting("compression_threshold", DEFAULT_COMPRESSION_THRESHOLD)
+
+    def add(self, point: types.Point) -> "PointRecord":
+        values = _point_values(point)
+        with self.connection() as conn:
+            metric_ids = _ensure_metric_ids(conn, [point.metric_name])
+            blob_ids = self._ensure_blob_ids(conn, [values], metric_ids, {})
+            result = conn.execute(
+                insert(Point.__table__), _point_row(values, metric_ids, blob_ids)
+            )
+            _add_tags(conn, [(result.inserted_primary_key[0], point.tags)])
+            _refresh_heads(conn, metric_ids.values())
+            conn.commit()
+        return PointRecord(id=result.inserted_primary_key[0], **values)
+
+    def add_many(
+        self, points: Iterable[types.Point], chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> int:
+        assert chunk_size > 0, "chunk_size must be greater than 0"
+        count = 0
+        metric_ids: Dict[str, int] = {}
+        keyframes: Dict[int, Optional[_Keyframe]] = {}
+        with self.connection() as conn:
+            for chunk in _chunked((_point_values(p) for p in points), chunk_size):
+                metric_ids.update(
+                    _ensure_metric_ids(
+                        conn,
+                        {values["metric_name"] for values in chunk} - metric_ids.keys(),
+                    )
+                )
+                blob_ids = self._ensure_blob_ids(conn, chunk, metric_ids, keyframes)
+                point_ids = conn.execute(
+                    insert(Point.__table__).returning(
+                        Point.id, sort_by_parameter_order=True
+                    ),
+                    [_point_row(values, metric_ids, blob_ids) for values in chunk],
+                ).scalars()
+                _add_tags(conn, zip(point_ids, (values["tags"] for values in chunk)))
+                count += len(chunk)
+            _refresh_heads(conn, metric_ids.values())
+            conn.commit()
+        return count
+
+    def skip_latest(self, metric_name: str, tags: Optional[Dict[str, Any]] = None):
+        with self.connection() as conn:
+            metric_id = _metric_id(conn, metric_name)
+            if metric_id is None:
+                return
+            to_update = (
+                select(Point.id)
+                .filter_by(metric_id=metric_id)
+                .where(*_tag_filters(Point.id, tags))
+                .order_by(Point.time.desc(), Point.id.desc())
+                .limit(1)
+            )
+            conn.execute(
+                update(Point.__table__)
+                .values(skipped=True)
+                .where(Point.id.in_(to_update.scalar_subquery()))
+            )
+            _refresh_heads(conn, [metric_id])
+            conn.commit()
+
+    def recent(
+        self,
+        metric_name: Optional[str] = None,
+        count: Optional[int] = 10,
+        tags: Optional[Dict[str, Any]] = None,
+        with_content: bool = False,
+    ) -> Generator["PointRecord", None, None]:
+        # measure_source and diffable_content are None unless with_content
+        query = _recent_query(metric_name, count, tags, with_content)
+        with self.connection() as conn:
+            for row in conn.execute(query):
+                yield _point_record(conn, row)
+
+    def history(
+        self,
+        metric_name: str,
+        fetch_size: int = DEFAULT_FETCH_SIZE,
+        tags: Optional[Dict[str, Any]] = None,
+    ) -> "History":
+        # Text columns are loaded on first access, i.e. only for the points
+        # whose content is actually used, so access them before closing.
         query = (
-            update(Point)
-            .values(skipped=True)
-            .where(Point.id.in_(to_update.scalar_subquery()))
+            select(Point)
+            .options(*_defer_content())
+            .join(Metric, Metric.id == Point.metric_id)
+            .where(Metric.name == metric_name)
+            .where(*_tag_filters(Point.id, tags))
+            .order_by(Point.time.desc(), Point.id.desc())
+            .execution_options(yield_per=fetch_size)
         )
-        with self.session() as session:
-            session.execute(query)
-            session.commit()
+        stack = contextlib.ExitStack()
+        session = stack.enter_context(self.session())
+        return History(iter(session.scalars(query)), stack.close)
 
-    def recent(
-        self, metric_name: Optional[str] = None, count: Optional[int] = 10
-    ) -> Generator[Point, None, None]:
-        query = select(Point)
+    def rename(self, old_metric_name: str, new_metric_name: str) -> int:
+        metrics = Metric.__table__
+        points = Point.__table__
+        with self.connection() as conn:
+            old_id = _metric_id(conn, old_metric_name)
+            if old_id is None:
+                return 0
+            count = conn.execute(
+                select(func.count()).where(points.c.metric_id == old_id)
+            ).scalar()
+            new_id = _metric_id(conn, new_metric_name)
+            if new_id is None:
+                conn.execute(
+                    update(metrics)
+                    .values(name=new_metric_name)
+                    .where(metrics.c.id == old_id)
+                )
+            else:
+                # Merging into an existing metric
+                conn.execute(
+                    update(points)
+                    .values(metric_id=new_id)
+                    .where(points.c.metric_id == old_id)
+                )
+                _refresh_heads(conn, [old_id, new_id])
+            conn.commit()
+        return count
+
+    def iter_all(self) -> Generator["PointRecord", None, None]:
+        query = select(*_record_columns()).join(
+            Metric.__table__, Metric.id == Point.metric_id
+        )
+        with self.connection() as conn:
+            for row in conn.execute(query):
+                yield _point_record(conn, row)
+
+    def iter_metric_names(self) -> Generator[str, None, None]:
+        # The catalog is small, so read it all up front rather than keep the
+        # database locked while callers write to it
+        with self.connection() as conn:
+            metric_names = (
+                conn.execute(select(Metric.name).order_by(Metric.name)).scalars().all()
+            )
+        yield from metric_names
+
+    def heads(self, metric_name: Optional[str] = None) -> Generator[Head, None, None]:
+        latest = aliased(Point, name="latest")
+        previous = aliased(Point, name="previous")
+        query = (
+            select(Metric.name, MetricHead.latest_values, latest, previous)
+            .join(Metric, Metric.id == MetricHead.metric_id)
+            .join(latest, latest.id == MetricHead.latest_id)
+            .outerjoin(previous, previous.id == MetricHead.previous_id)
+            .options(defer(latest.measure_source), defer(previous.measure_source))
+            .order_by(Metric.name)
+        )
         if metric_name is not None:
-            query = query.filter_by(metric_name=metric_name)
-        query = query.order_by(Point.time.desc(), Point.id.desc())
-        if count is not None:
-            query = query.limit(count)
+            query = query.where(Metric.name == metric_name)
         with self.session() as session:
             for row in session.execute(query):
-                yield row[0]
+                yield Head._make(row)
 
-    def rename(self, old_metric_name: str, new_metric_name: str) -> int:
+    def rebuild_heads(self) -> int:
+        # Recomputes every head from scratch in a single pass over the points
+        heads = MetricHead.__table__
+        points = Point.__table__
+        ranks = _report_ranks()
         query = (
-            update(Point)
-            .values(metric_name=new_metric_name)
-            .where(Point.metric_name == old_metric_name)
+            select(
+                ranks.c.metric_id,
+                ranks.c.id,
+                ranks.c.rank,
+                ranks.c.is_previous,
+                points.c.metric_value,
+            )
+            .join(points, points.c.id == ranks.c.id)
+            .where(or_(ranks.c.rank <= HEAD_VALUE_COUNT, ranks.c.is_previous))
+            .order_by(ranks.c.metric_id, ranks.c.rank)
         )
-        count = 0
-        with self.session() as session:
-            count = session.execute(query).rowcount
-            session.commit()
-        return count
+        with self.connection() as conn:
+            # Deleting first starts the write transaction, so that the points
+            # can't change between reading them and writing the heads
+            conn.execute(delete(heads))
+            rows = []
+            for metric_id, report_ranks in itertools.groupby(
+                conn.execute(query), key=lambda r: r.metric_id
+            ):
+                head = dict(metric_id=metric_id, previous_id=None)
+                latest_values = []
+                for r in report_ranks:
+                    if r.rank == 1:
+                        head["latest_id"] = r.id
+                    if r.rank <= HEAD_VALUE_COUNT:
+                        latest_values.insert(0, r.metric_value)
+                    if r.is_previous:
+                        head["previous_id"] = r.id
+                rows.append(dict(head, latest_values=latest_values))
+            if rows:
+                conn.execute(insert(heads), rows)
+            conn.commit()
+        return len(rows)
 
-    def iter_all(self) -> Generator[Point, None, None]:
-        query = select(Point)
-        with self.session() as session:
-            for row in session.execute(query):
-                yield row[0]
+    def input_hashes(self, stats: Dict[str, Tuple[int, int]]) -> Dict[str, str]:
+        # Hashes of the files at the given paths that still have the given
+        # (mtime_ns, size) they were fingerprinted with. The ones that don't,
+        # or may have changed since regardless, are left out.
+        input_files = InputFile.__table__
+        rows = []
+        with self.connection() as conn:
+            for paths in _chunked(stats, DEFAULT_CHUNK_SIZE):
+                rows += conn.execute(
+                    select(input_files).where(input_files.c.path.in_(paths))
+                ).all()
+        return {
+            row.path: row.hash
+            for row in rows
+            if stats[row.path] == (row.mtime_ns, row.size)
+            and row.mtime_ns + RACY_WINDOW_NS < row.checked_at
+        }
 
-    def iter_metric_names(self) -> Generator[str, None, None]:
-        with self.session() as session:
-            metric_names_query = select(Point.metric_name.distinct())
-            for metric_name in session.execute(metric_names_query):
-                yield metric_name[0]
+    def update_input_files(self, fingerprints: Iterable[InputFingerprint]) -> None:
+        rows = [fingerprint._asdict() for fingerprint in fingerprints]
+        if not rows:
+            return
+        with self.connection() as conn:
+            conn.execute(insert(InputFile.__table__).prefix_with("OR REPLACE"), rows)
+            conn.commit()
+
+    def cached_measurements(self, keys: Dict[str, str]) -> Dict[str, MeasureCacheEntry]:
+        # Cached measurements of the given metrics that have the given keys
+        cache = CachedMeasurement.__table__
+        metrics = Metric.__table__
+        if not keys:
+            return {}
+        query = (
+            select(
+                metrics.c.name,
+                cache.c.key,
+                cache.c.value,
+                _blob_content(cache.c.measure_source_id),
+                _blob_content(cache.c.diffable_content_id),
+            )
+            .join(metrics, metrics.c.id == cache.c.metric_id)
+            .where(
+                metrics.c.name.in_(list(keys)),
+                cache.c.key.in_(set(keys.values())),
+            )
+        )
+        with self.connection() as conn:
+            return {
+                name: MeasureCacheEntry(
+                    metric_name=name,
+                    key=key,
+                    value=value,
+                    measure_source=_resolve_content(conn, measure_source),
+                    diffable_content=_resolve_content(conn, diffable_content),
+                )
+                for name, key, value, measure_source, diffable_content in conn.execute(
+                    query
+                )
+                if keys[name] == key
+            }
+
+    def cache_measurements(self, entries: Iterable[MeasureCacheEntry]) -> int:
+        # Replaces the cached measurements of the given metrics. Metrics that
+        # have no points are skipped.
+        entries = list(entries)
+        with self.connection() as conn:
+            metric_ids = dict(
+                conn.execute(
+                    select(Metric.name, Metric.id).where(
+                        Metric.name.in_({entry.metric_name for entry in entries})
+                    )
+                ).all()
+            )
+            entries = [entry for entry in entries if entry.metric_name in metric_ids]
+            if not entries:
+                return 0
+            blob_ids = _ensure_blob_ids(
+                conn,
+                {
+                    content
+                    for entry in entries
+                    for content in (entry.measure_source, entry.diffable_content)
+                    if content is not None
+                },
+                compression=self.compression,
+                compression_threshold=self.compression_threshold,
+            )
+            conn.execute(
+                insert(CachedMeasurement.__table__).prefix_with("OR REPLACE"),
+                [
+                    dict(
+                        metric_id=metric_ids[entry.metric_name],
+                        key=entry.key,
+                        value=entry.value,
+                        measure_source_id=blob_ids.get(entry.measure_source),
+                        diffable_content_id=blob_ids.get(entry.diffable_content),
+                    )
+                    for entry in entries
+                ],
+            )
+            conn.commit()
+        return len(entries)
+
+    def prune(
+        self,
+        keep_last: Optional[int] = None,
+        keep_within: Optional[datetime.timedelta] = None,
+        keep_auto: bool = False,
+    ) -> int:
+        # For every metric, each keep_* option picks a point to keep:
+        # - keep_last: the keep_last-th most recent point
+        # - keep_auto: the latest point if it's not skipped, otherwise the
+        #   previous non-skipped point in the current epoch, otherwise the
+        #   oldest point of the current epoch
+        # - keep_within: the oldest point recorded within keep_within of the
+        #   keep_auto point, and at least the second most recent point
+        # Points older than the oldest pick are deleted, for all metrics in a
+        # single statement. The id of each metric's oldest pick is worked out
+        # once into _prune_cutoffs, which the delete looks points up in.
+        # Ranked once for the summary and the cutoffs that refer back to it
+        ranked = _ranked_points().cte("ranked")
+        summary = (
+            select(
+                ranked.c.metric_id,
+                func.count().label("count"),
+                func.max(case((ranked.c.rank == 1, ranked.c.skipped))).label(
+                    "latest_skipped"
+                ),
+                # First non-skipped point after the latest one in its epoch
+                func.min(
+                    case(
+                        (
+                            and_(
+                                ranked.c.epoch_changes == 0,
+                                ranked.c.rank > 1,
+                                ranked.c.skipped.is_(False),
+                            ),
+                            ranked.c.rank,
+                        )
+                    )
+                ).label("previous_rank"),
+                func.max(case((ranked.c.epoch_changes == 0, ranked.c.rank))).label(
+                    "epoch_start_rank"
+                ),
+            )
+            .group_by(ranked.c.metric_id)
+            .subquery()
+        )
+        auto_rank = case(
+            (summary.c.latest_skipped == 0, 1),
+            else_=func.coalesce(summary.c.previous_rank, summary.c.epoch_start_rank),
+        )
+        candidate_ranks = []
+        if keep_last is not None:
+            candidate_ranks.append(func.min(keep_last, summary.c.count))
+        if keep_auto:
+            candidate_ranks.append(auto_rank)
+        if keep_within is not None:
+            anchor = ranked.alias("anchor")
+            within = ranked.alias("within")
+            # Points are ranked newest first, so the ones recorded within
+            # keep_within of the anchor are the leading ranks
+            within_count = (
+                select(func.count())
+                .select_from(anchor)
+                .join(
+                    within,
+                    and_(
+                        within.c.metric_id == anchor.c.metric_id,
+                        within.c.time >= anchor.c.time - _microseconds(keep_within),
+                    ),
+                )
+                .where(anchor.c.metric_id == summary.c.metric_id)
+                .where(anchor.c.rank == auto_rank)
+                .scalar_subquery()
+            )
+            candidate_ranks.append(
+                case(
+                    (summary.c.count == 1, 1),
+                    else_=func.max(2, within_count),
+                )
+            )
+        if not candidate_ranks:
+            return 0
+
+        # The oldest candidate is the one ranked last
+        cutoff_rank = (
+            func.max(*candidate_ranks)
+            if len(candidate_ranks) > 1
+            else candidate_ranks[0]
+        )
+        cutoffs = (
+            select(ranked.c.metric_id, ranked.c.id)
+            .join(summary, ranked.c.metric_id == summary.c.metric_id)
+            .where(ranked.c.rank == cutoff_rank)
+        )
+        points = Point.__table__
+        before_cutoff = points.c.id < (
+            select(_prune_cutoffs.c.id)
+            .where(_prune_cutoffs.c.metric_id == points.c.metric_id)
+            .scalar_subquery()
+        )
+        with self.connection() as conn:
+            _prune_cutoffs.create(conn)
+            try:
+                conn.execute(
+                    insert(_prune_cutoffs).from_select(["metric_id", "id"], cutoffs)
+                )
+                count = _delete_points(
+                    conn, before_cutoff, self.compression, self.compression_threshold
+                )
+            finally:
+                _prune_cutoffs.drop(conn)
+            if count:
+                metric_ids = conn.execute(select(MetricHead.metric_id)).scalars().all()
+                _refresh_heads(conn, metric_ids)
+            conn.commit()
+        return count
 
     def prune_before(self, point: Point) -> int:
-        count = 0
-        with self.session() as session:
-            count = session.execute(
-                delete(Point)
-                .where(Point.metric_name == point.metric_name)
-                .where(Point.id < point.id)
-            ).rowcount
-            session.commit()
+        with self.connection() as conn:
+            metric_id = _metric_id(conn, point.metric_name)
+            count = _delete_points(
+                conn,
+                and_(Point.metric_id == metric_id, Point.id < point.id),
+                self.compression,
+                self.compression_threshold,
+            )
+            _refresh_heads(conn, [metric_id])
+            conn.commit()
+        return count
+
+    def copy_from(self, src: "DB") -> int:
+        # Rows are copied within SQLite so they never pass through Python.
+        # Sources at an older revision only lack columns added since then,
+        # which fall back to their server defaults, or still store metric
+        # names, content and times as text in the points table.
+        revision = src.current_revision()
+        if revision is None:
+            return 0
+        if revision not in _known_revisions():
+            raise Exception(
+                f"Unknown schema revision {revision} in {src.db_path}: "
+                "it may have been written by a newer version of tinyalert"
+            )
+        with self.connection() as conn:
+            conn.execute(
+                text("ATTACH DATABASE :path AS src"), dict(path=str(src.db_path))
+            )
+            try:
+                conn.connection.driver_connection.create_function(
+                    "content_hash", 1, _content_hash, deterministic=True
+                )
+                src_columns = {
+                    row[1]: row[2]
+                    for row in conn.execute(text("PRAGMA src.table_info(points)"))
+                }
+                src_blob_columns = {
+                    row[1] for row in conn.execute(text("PRAGMA src.table_info(blobs)"))
+                }
+                src_points = _src_points_sql(src_columns, src_blob_columns)
+                columns = [
+                    column.name
+                    for column in Point.__table__.columns
+                    if column.name
+                    not in (
+                        "id",
+                        "metric_id",
+                        "measure_source_id",
+                        "diffable_content_id",
+                    )
+                    and column.name in src_columns
+                ]
+                conn.execute(
+                    text(
+                        "INSERT OR IGNORE INTO main.metrics (name) "
+                        f"SELECT DISTINCT metric_name FROM {src_points}"
+                    )
+                )
+                conn.execute(
+                    text(
+                        "INSERT OR IGNORE INTO main.blobs (hash, content, base_hash) "
+                        "SELECT measure_source_hash, measure_source, "
+                        "measure_source_base_hash "
+                        f"FROM {src_points} WHERE measure_source IS NOT NULL "
+                        "UNION SELECT diffable_content_hash, diffable_content, "
+                        "diffable_content_base_hash "
+                        f"FROM {src_points} WHERE diffable_content IS NOT NULL"
+                    )
+                )
+                if "base_hash" in src_blob_columns:
+                    # Deltas need their bases, which only cached measurements
+                    # may refer to, and so on down to a keyframe
+                    conn.execute(
+                        text(
+                            "WITH RECURSIVE bases (hash) AS ("
+                            f"SELECT measure_source_base_hash FROM {src_points} "
+                            "UNION SELECT diffable_content_base_hash "
+                            f"FROM {src_points} "
+                            "UNION SELECT b.base_hash FROM src.blobs AS b "
+                            "JOIN bases ON b.hash = bases.hash) "
+                            "INSERT OR IGNORE INTO main.blobs "
+                            "(hash, content, base_hash) "
+                            "SELECT hash, content, base_hash FROM src.blobs "
+                            "WHERE hash IN (SELECT hash FROM bases)"
+                        )
+                    )
+                values = [
+                    (
+                        _text_time_us("s.time")
+                        if column == "time" and src_columns["time"] != "INTEGER"
+                        else f"s.{column}"
+                    )
+                    for column in columns
+                ]
+                count = conn.execute(
+                    text(
+                        f"INSERT INTO main.points ({', '.join(columns)}, "
+                        "metric_id, measure_source_id, diffable_content_id) "
+                        f"SELECT {', '.join(values)}, m.id, ms.id, dc.id "
+                        f"FROM {src_points} AS s "
+                        "JOIN main.metrics AS m ON m.name = s.metric_name "
+                        "LEFT JOIN main.blobs AS ms ON ms.hash = s.measure_source_hash "
+                        "LEFT JOIN main.blobs AS dc "
+                        "ON dc.hash = s.diffable_content_hash "
+                        "ORDER BY s.id"
+                    )
+                ).rowcount
+                # Rows inserted by a single statement get consecutive ids
+                last_id = conn.execute(text("SELECT last_insert_rowid()")).scalar()
+                conn.execute(
+                    text(
+                        "INSERT INTO main.point_tags (point_id, key, value) "
+                        f"SELECT p.id, tag.key, {_TAG_VALUE_SQL} "
+                        "FROM main.points AS p, json_each(p.tags) AS tag "
+                        "WHERE p.id > :first_id AND p.id <= :last_id"
+                    ),
+                    dict(first_id=last_id - count, last_id=last_id),
+                )
+                metric_ids = (
+                    conn.execute(
+                        text(
+                            "SELECT id FROM main.metrics WHERE name IN "
+                            f"(SELECT metric_name FROM {src_points})"
+                        )
+                    )
+                    .scalars()
+                    .all()
+                )
+                _refresh_heads(conn, metric_ids)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.execute(text("DETACH DATABASE src"))
         return count
 
     def migrate(self):
         self._ensure_dir()
         self.run_alembic("upgrade", "head")
 
+    def current_revision(self) -> Optional[str]:
+        with self.engine.connect() as conn:
+            has_version_table = conn.execute(
+                text(
+                    "SELECT 1 FROM sqlite_master "
+                    "WHERE type = 'table' AND name = 'alembic_version'"
+                )
+            ).scalar()
+            if not has_version_table:
+                return None
+            return conn.execute(
+                text("SELECT version_num FROM alembic_version")
+            ).scalar()
+
     def run_alembic(self, *args):
         AlembicCLI(db_url=self.engine.url).main(argv=args)
 
@@ -138,19 +1073,802 @@ class DB:
         with self.session() as session:
             session.execute(text("VACUUM"))
 
+    def incremental_vacuum(self, pages: Optional[int] = None):
+        # Releases up to the given number of free pages back to the file
+        # system, or all of them, without rewriting the whole database.
+        with self.connection() as conn:
+            free_pages = conn.execute(text("PRAGMA freelist_count")).scalar()
+            # The pysqlite driver only steps a statement that doesn't return
+            # rows once, and the pragma releases a page per step
+            for _ in range(free_pages if pages is None else min(pages, free_pages)):
+                conn.execute(text("PRAGMA incremental_vacuum"))
+            conn.commit()
+
+    @contextlib.contextmanager
+    def in_memory(self) -> Generator["DB", None, None]:
+        # Works on a copy of the database held in memory, and writes it back
+        # to the file when the block exits without an exception. The copy is
+        # written to a temp file that then replaces the database, so that the
+        # database is never left half written.
+        if self.read_only:
+            raise Exception(
+                f"Can't work on {self.db_path} in memory with the read-only "
+                f"'{self.profile.value}' profile"
+            )
+        self._ensure_migrated()
+        file_engine = self.engine
+        memory_engine = create_engine(
+            "sqlite://",
+            echo=file_engine.echo,
+            poolclass=StaticPool,
+            connect_args={"check_same_thread": False},
+        )
+        with contextlib.closing(memory_engine.raw_connection()) as memory:
+            with contextlib.closing(sqlite3.connect(self.db_path)) as src:
+                src.backup(memory.driver_connection)
+        file_engine.dispose()
+
+        self.engine = memory_engine
+        try:
+            yield self
+            file_engine.dispose()
+            with contextlib.closing(memory_engine.raw_connection()) as memory:
+                _write_back(memory.driver_connection, self.db_path)
+        finally:
+            self.engine = file_engine
+            memory_engine.dispose()
+
     @contextlib.contextmanager
     def session(self) -> Generator[Session, None, None]:
+        self._ensure_migrated()
+        with Session(self.engine) as session:
+            yield session
+
+    @contextlib.contextmanager
+    def connection(self) -> Generator[Connection, None, None]:
+        self._ensure_migrated()
+        with self.engine.connect() as conn:
+            yield conn
+
+    def _ensure_migrated(self) -> None:
+        if self.read_only:
+            self._ensure_current()
+            return
         self._ensure_dir()
         if not self._migrated:
-            self.migrate()
+            if self.current_revision() != HEAD_REVISION:
+                self.migrate()
+            self._load_settings()
+            self._migrated = True
+
+    def _setting(self, key: str, default: Any) -> Any:
+        if self._settings is None:
+            # Loaded along with the migration check, before any connection
+            # that reading them could interfere with is open
+            self._ensure_migrated()
+        return self._settings.get(key, default)
+
+    def _load_settings(self) -> None:
+        settings = Setting.__table__
+        with self.engine.connect() as conn:
+            self._settings = dict(
+                conn.execute(select(settings.c.key, settings.c.value)).all()
+            )
+            changed = {
+                key: value
+                for key, value in self._setting_overrides.items()
+                if self._settings.get(key) != value
+            }
+            if changed and not self.read_only:
+                conn.execute(
+                    insert(settings).prefix_with("OR REPLACE"),
+                    [dict(key=key, value=value) for key, value in changed.items()],
+                )
+                conn.commit()
+        self._settings.update(self._setting_overrides)
+
+    def _ensure_blob_ids(
+        self,
+        conn: Connection,
+        values: List[Dict[str, Any]],
+        metric_ids: Dict[str, int],
+        keyframes: Dict[int, Optional[_Keyframe]],
+    ) -> Dict[str, int]:
+        # Ids of the blobs with the contents of the given _point_values(),
+        # adding the ones not stored yet. keyframes carries the last diffable
+        # content of each metric from one call to the next.
+        blob_ids = {}
+        if self.keyframe_interval is not None:
+            # Before other contents, so that identical measure sources refer
+            # to the delta too
+            blob_ids = _ensure_delta_blob_ids(
+                conn,
+                [
+                    (metric_ids[v["metric_name"]], v["diffable_content"])
+                    for v in values
+                    if v["diffable_content"] is not None
+                ],
+                keyframes,
+                self.keyframe_interval,
+                self.compression,
+                self.compression_threshold,
+            )
+        blob_ids.update(
+            _ensure_blob_ids(
+                conn,
+                _contents(values) - blob_ids.keys(),
+                compression=self.compression,
+                compression_threshold=self.compression_threshold,
+            )
+        )
+        return blob_ids
+
+    def _ensure_current(self) -> None:
+        if not self._migrated:
+            if not self.db_path.exists():
+                raise ReadOnlyDatabaseError(f"Database {self.db_path} doesn't exist")
+            revision = self.current_revision()
+            if revision != HEAD_REVISION:
+                raise ReadOnlyDatabaseError(
+                    f"Database {self.db_path} is at revision {revision} and "
+                    f"can't be migrated to {HEAD_REVISION} when opened read-only"
+                )
+            self._load_settings()
             self._migrated = True
-        with Session(self.engine) as session:
-            yield session
 
     def _ensure_dir(self) -> None:
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
 
 
+def _engine_url(db_path: Union[Path, str], profile: types.StorageProfile) -> str:
+    uri_parameters = READ_ONLY_URI_PARAMETERS.get(profile)
+    if uri_parameters is None:
+        return f"sqlite:///{db_path}"
+    query = urlencode(dict(uri_parameters, uri="true"))
+    return f"sqlite:///file:{quote(str(db_path))}?{query}"
+
+
+def _write_back(src: sqlite3.Connection, db_path: Path) -> None:
+    temp_path = db_path.with_name(f".{db_path.name}.{os.getpid()}.tmp")
+    temp_path.unlink(missing_ok=True)
+    try:
+        with contextlib.closing(sqlite3.connect(temp_path)) as dest:
+            src.backup(dest)
+        os.replace(temp_path, db_path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def _set_pragmas(pragmas: Dict[str, Union[str, int]], dbapi_connection, _) -> None:
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+@functools.lru_cache(maxsize=None)
+def _known_revisions() -> FrozenSet[str]:
+    script = alembic.script.ScriptDirectory(str(Path(__file__).parent / "alembic"))
+    return frozenset(s.revision for s in script.walk_revisions())
+
+
+class History:
+    """Points of a metric, newest first, read from the database on demand
+
+    Can be iterated over more than once; points that were already read are
+    replayed from memory. The underlying session stays open (and may keep the
+    database locked for writes) until the history is closed.
+    """
+
+    def __init__(self, points: Iterator[Point], close: Callable[[], None]):
+        self._points = points
+        self._close = close
+        self._read: List[Point] = []
+        self._exhausted = False
+
+    def __iter__(self) -> Iterator[Point]:
+        i = 0
+        while True:
+            if i < len(self._read):
+                yield self._read[i]
+            elif self._exhausted:
+                return
+            else:
+                point = next(self._points, None)
+                if point is None:
+                    self._exhausted = True
+                    return
+                self._read.append(point)
+                yield point
+            i += 1
+
+    def __bool__(self) -> bool:
+        return next(iter(self), None) is not None
+
+    def close(self) -> None:
+        self._close()
+
+    def __enter__(self) -> "History":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def _ranked_points() -> Select:
+    # Every point with its 1-based rank within its metric, newest first, and
+    # the number of times the epoch changed between the latest point and it.
+    # The orderings are unique, so ROWS frames give the same results as the
+    # default RANGE frames, without comparing each row to its peers.
+    order = (Point.time.desc(), Point.id.desc())
+    ranked = select(
+        Point.id,
+        Point.metric_id,
+        Point.time,
+        Point.skipped,
+        Point.epoch,
+        func.row_number()
+        .over(partition_by=Point.metric_id, order_by=order)
+        .label("rank"),
+        func.first_value(Point.epoch)
+        .over(partition_by=Point.metric_id, order_by=order, rows=(None, 0))
+        .label("latest_epoch"),
+    ).subquery()
+    return select(
+        ranked,
+        func.sum(case((ranked.c.epoch != ranked.c.latest_epoch, 1), else_=0))
+        .over(partition_by=ranked.c.metric_id, order_by=ranked.c.rank, rows=(None, 0))
+        .label("epoch_changes"),
+    )
+
+
+def _report_ranks() -> Subquery:
+    # Every point with its rank and whether it's the previous alert-eligible
+    # point of its metric, i.e. the first non-skipped point after the latest
+    # one without leaving its epoch
+    in_latest_epoch = _ranked_points().subquery()
+    is_eligible = and_(
+        in_latest_epoch.c.epoch_changes == 0,
+        or_(in_latest_epoch.c.rank == 1, in_latest_epoch.c.skipped.is_(False)),
+    )
+    eligible = select(
+        in_latest_epoch.c.id,
+        in_latest_epoch.c.metric_id,
+        in_latest_epoch.c.rank,
+        is_eligible.label("is_eligible"),
+        func.sum(case((is_eligible, 1), else_=0))
+        .over(
+            partition_by=in_latest_epoch.c.metric_id,
+            order_by=in_latest_epoch.c.rank,
+        )
+        .label("eligible_rank"),
+    ).subquery()
+    return select(
+        eligible.c.id,
+        eligible.c.metric_id,
+        eligible.c.rank,
+        and_(eligible.c.is_eligible, eligible.c.eligible_rank == 2).label(
+            "is_previous"
+        ),
+    ).subquery()
+
+
+def _refresh_heads(conn: Connection, metric_ids: Iterable[int]) -> None:
+    # Recomputes the heads of the given metrics from their most recent points,
+    # reading only as far back as the previous alert-eligible point
+    heads = MetricHead.__table__
+    points = Point.__table__
+    order = (points.c.time.desc(), points.c.id.desc())
+    for metric_id in set(metric_ids):
+        conn.execute(delete(heads).where(heads.c.metric_id == metric_id))
+        recent = conn.execute(
+            select(points.c.id, points.c.time, points.c.metric_value, points.c.epoch)
+            .where(points.c.metric_id == metric_id)
+            .order_by(*order)
+            .limit(HEAD_VALUE_COUNT)
+        ).all()
+        if not recent:
+            # The metric's last points are gone
+            conn.execute(
+                delete(CachedMeasurement.__table__).where(
+                    CachedMeasurement.metric_id == metric_id
+                )
+            )
+            conn.execute(delete(Metric.__table__).where(Metric.id == metric_id))
+            continue
+        latest = recent[0]
+        # Skipped points in the latest epoch are passed over, so the first
+        # point that isn't is either the previous one or in another epoch
+        candidate = conn.execute(
+            select(points.c.id, points.c.epoch)
+            .where(points.c.metric_id == metric_id)
+            .where(
+                or_(
+                    points.c.time < latest.time,
+                    and_(points.c.time == latest.time, points.c.id < latest.id),
+                )
+            )
+            .where(or_(points.c.skipped.is_(False), points.c.epoch != latest.epoch))
+            .order_by(*order)
+            .limit(1)
+        ).first()
+        conn.execute(
+            insert(heads),
+            dict(
+                metric_id=metric_id,
+                latest_id=latest.id,
+                previous_id=(
+                    candidate.id
+                    if candidate is not None and candidate.epoch == latest.epoch
+                    else None
+                ),
+                latest_values=[r.metric_value for r in reversed(recent)],
+            ),
+        )
+
+
+def _tag_value(value: Any) -> str:
+    # Tags are filtered on as strings; other JSON values are compared in
+    # their compact JSON form. Matches _TAG_VALUE_SQL.
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, separators=(",", ":"))
+
+
+# Text value of a tag from json_each(), like _tag_value()
+_TAG_VALUE_SQL = (
+    "CASE tag.type WHEN 'text' THEN tag.value "
+    "WHEN 'true' THEN 'true' WHEN 'false' THEN 'false' WHEN 'null' THEN 'null' "
+    "WHEN 'object' THEN tag.value WHEN 'array' THEN tag.value "
+    "ELSE json_quote(tag.value) END"
+)
+
+
+def _tag_filters(
+    point_id: ColumnElement, tags: Optional[Dict[str, Any]]
+) -> List[ColumnElement]:
+    point_tags = PointTag.__table__
+    # Matching ids are read off the (key, value, point_id) index
+    return [
+        point_id.in_(
+            select(point_tags.c.point_id)
+            .where(point_tags.c.key == key)
+            .where(point_tags.c.value == _tag_value(value))
+        )
+        for key, value in (tags or {}).items()
+    ]
+
+
+def _add_tags(conn: Connection, tagged_points: Iterable[Tuple[int, Dict]]) -> None:
+    rows = [
+        dict(point_id=point_id, key=key, value=_tag_value(value))
+        for point_id, tags in tagged_points
+        for key, value in tags.items()
+    ]
+    if rows:
+        conn.execute(insert(PointTag.__table__), rows)
+
+
+def _delete_points(
+    conn: Connection,
+    where: ColumnElement[bool],
+    compression: types.Compression = types.Compression.none,
+    compression_threshold: int = DEFAULT_COMPRESSION_THRESHOLD,
+) -> int:
+    # Deletes the matching points along with their tags, and the blobs that
+    # neither a point nor a cached measurement refers to anymore. Deltas
+    # against those get stored in full.
+    points = Point.__table__
+    point_tags = PointTag.__table__
+    blobs = Blob.__table__
+    cache = CachedMeasurement.__table__
+    conn.execute(
+        delete(point_tags).where(
+            point_tags.c.point_id.in_(select(points.c.id).where(where))
+        )
+    )
+    count = conn.execute(delete(points).where(where)).rowcount
+    if not count:
+        return count
+    referenced = union(
+        *(
+            select(column).where(column.is_not(None))
+            for column in (
+                points.c.measure_source_id,
+                points.c.diffable_content_id,
+                cache.c.measure_source_id,
+                cache.c.diffable_content_id,
+            )
+        )
+    )
+    referenced_blobs = aliased(blobs)
+    orphaned_deltas = conn.execute(
+        select(blobs.c.id, blobs.c.content).where(
+            blobs.c.id.in_(referenced),
+            blobs.c.base_hash.not_in(
+                select(referenced_blobs.c.hash).where(
+                    referenced_blobs.c.id.in_(referenced)
+                )
+            ),
+        )
+    ).all()
+    for blob_id, delta in orphaned_deltas:
+        content = _encode_content(
+            _resolve_content(conn, delta), compression, compression_threshold
+        )
+        conn.execute(
+            update(blobs)
+            .values(content=content, base_hash=None)
+            .where(blobs.c.id == blob_id)
+        )
+    conn.execute(delete(blobs).where(blobs.c.id.not_in(referenced)))
+    return count
+
+
+def _metric_id(conn: Connection, metric_name: str) -> Optional[int]:
+    return conn.execute(select(Metric.id).where(Metric.name == metric_name)).scalar()
+
+
+def _ensure_metric_ids(conn: Connection, metric_names: Iterable[str]) -> Dict[str, int]:
+    # Ids of the given metrics, adding the ones not in the catalog yet
+    metrics = Metric.__table__
+    metric_names = set(metric_names)
+    if not metric_names:
+        return {}
+    query = select(metrics.c.name, metrics.c.id).where(metrics.c.name.in_(metric_names))
+    metric_ids = dict(conn.execute(query).all())
+    missing = metric_names - metric_ids.keys()
+    if missing:
+        conn.execute(insert(metrics), [dict(name=name) for name in sorted(missing)])
+        metric_ids = dict(conn.execute(query).all())
+    return metric_ids
+
+
+def _src_points_sql(src_columns: Dict[str, str], src_blob_columns: Set[str]) -> str:
+    # Points of the attached src database with metric names and content
+    # alongside the hash of the content and of the base of deltas, whichever
+    # revision it's at. Needs the content_hash() SQL function for sources that
+    # store content as text. Deltas are copied as is, see DB.copy_from() for
+    # their bases.
+    selected = ["p.*"]
+    joins = []
+    if "metric_name" not in src_columns:
+        selected.append("m.name AS metric_name")
+        joins.append("JOIN src.metrics AS m ON m.id = p.metric_id")
+    for column in ("measure_source", "diffable_content"):
+        if f"{column}_id" in src_columns:
+            selected += [
+                f"{column}.content AS {column}",
+                f"{column}.hash AS {column}_hash",
+                (
+                    f"{column}.base_hash AS {column}_base_hash"
+                    if "base_hash" in src_blob_columns
+                    else f"NULL AS {column}_base_hash"
+                ),
+            ]
+            joins.append(
+                f"LEFT JOIN src.blobs AS {column} ON {column}.id = p.{column}_id"
+            )
+        elif column in src_columns:
+            selected += [
+                f"content_hash(p.{column}) AS {column}_hash",
+                f"NULL AS {column}_base_hash",
+            ]
+        else:
+            selected += [
+                f"NULL AS {column}",
+                f"NULL AS {column}_hash",
+                f"NULL AS {column}_base_hash",
+            ]
+    return f"(SELECT {', '.join(selected)} FROM src.points AS p {' '.join(joins)})"
+
+
+def _content_hash(content: Optional[str]) -> Optional[str]:
+    if content is None:
+        return None
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _contents(values: Iterable[Dict[str, Any]]) -> Set[str]:
+    # Blob contents of the given _point_values()
+    return {
+        content
+        for point_values in values
+        for content in (
+            point_values["measure_source"],
+            point_values["diffable_content"],
+        )
+        if content is not None
+    }
+
+
+def _ensure_blob_ids(
+    conn: Connection,
+    contents: Iterable[str],
+    compression: types.Compression = types.Compression.none,
+    compression_threshold: int = DEFAULT_COMPRESSION_THRESHOLD,
+) -> Dict[str, int]:
+    # Ids of the blobs with the given contents, adding the ones not stored yet.
+    # Content that's already stored is reused however it was compressed.
+    blobs = Blob.__table__
+    hashes = {_content_hash(content): content for content in contents}
+    if not hashes:
+        return {}
+    query = select(blobs.c.hash, blobs.c.id).where(blobs.c.hash.in_(list(hashes)))
+    blob_ids = dict(conn.execute(query).all())
+    missing = hashes.keys() - blob_ids.keys()
+    if missing:
+        conn.execute(
+            insert(blobs),
+            [
+                dict(
+                    hash=hash,
+                    content=_encode_content(
+                        hashes[hash], compression, compression_threshold
+                    ),
+                )
+                for hash in sorted(missing)
+            ],
+        )
+        blob_ids = dict(conn.execute(query).all())
+    return {hashes[hash]: blob_id for hash, blob_id in blob_ids.items()}
+
+
+def _ensure_delta_blob_ids(
+    conn: Connection,
+    contents: Iterable[Tuple[int, str]],
+    keyframes: Dict[int, Optional[_Keyframe]],
+    keyframe_interval: int,
+    compression: types.Compression,
+    compression_threshold: int,
+) -> Dict[str, int]:
+    # Ids of the blobs with the given diffable contents of the given metric
+    # ids, in the order they're pushed. New contents are stored in full, and
+    # the previous content of the metric becomes a delta against them unless
+    # keyframe_interval blobs already depend on it. The latest content then
+    # reads as fast as it gets, and the ones before it take a delta each.
+    # Deltas are only ever against newer blobs, so they can't form a cycle.
+    blobs = Blob.__table__
+    blob_ids: Dict[str, int] = {}
+    for metric_id, content in contents:
+        if metric_id not in keyframes:
+            keyframes[metric_id] = _latest_keyframe(conn, metric_id)
+        previous = keyframes[metric_id]
+        content_hash = _content_hash(content)
+        blob_id = conn.execute(
+            select(blobs.c.id).where(blobs.c.hash == content_hash)
+        ).scalar()
+        if blob_id is not None:
+            # Stored before, and may already be a delta
+            blob_ids[content] = blob_id
+            keyframes[metric_id] = _keyframe(conn, content_hash, content)
+            continue
+
+        blob_ids[content] = conn.execute(
+            insert(blobs).values(
+                hash=content_hash,
+                content=_encode_content(content, compression, compression_threshold),
+            )
+        ).inserted_primary_key[0]
+        group_size = 1
+        if previous is not None and previous.group_size < keyframe_interval:
+            delta = _Delta.between(content_hash, content, previous.content).encode()
+            stored_size = conn.execute(
+                select(func.length(cast(blobs.c.content, LargeBinary))).where(
+                    blobs.c.hash == previous.hash
+                )
+            ).scalar()
+            if len(delta) < stored_size:
+                conn.execute(
+                    update(blobs)
+                    .values(content=delta, base_hash=content_hash)
+                    .where(blobs.c.hash == previous.hash)
+                )
+                group_size += previous.group_size
+        keyframes[metric_id] = _Keyframe(content_hash, content, group_size)
+    return blob_ids
+
+
+def _latest_keyframe(conn: Connection, metric_id: int) -> Optional[_Keyframe]:
+    # Diffable content of the latest point of the metric, if it's stored in full
+    blobs = Blob.__table__
+    points = Point.__table__
+    heads = MetricHead.__table__
+    row = conn.execute(
+        select(blobs.c.hash, blobs.c.content)
+        .join(points, points.c.diffable_content_id == blobs.c.id)
+        .join(heads, heads.c.latest_id == points.c.id)
+        .where(heads.c.metric_id == metric_id)
+    ).first()
+    if row is None or isinstance(row.content, _Delta):
+        return None
+    return _keyframe(conn, row.hash, row.content)
+
+
+def _keyframe(conn: Connection, content_hash: str, content: str) -> Optional[_Keyframe]:
+    blobs = Blob.__table__
+    group = (
+        select(blobs.c.hash, blobs.c.base_hash)
+        .where(blobs.c.hash == content_hash)
+        .cte("grp", recursive=True)
+    )
+    group = group.union_all(
+        select(blobs.c.hash, blobs.c.base_hash).where(blobs.c.base_hash == group.c.hash)
+    )
+    rows = conn.execute(select(group.c.base_hash)).scalars().all()
+    if rows[0] is not None:
+        return None
+    return _Keyframe(content_hash, content, len(rows))
+
+
+def _delta_chain(conn: Connection, content_hash: str) -> List[Any]:
+    # Content of the blob with the given hash and those it's a delta against,
+    # starting from the keyframe
+    blobs = Blob.__table__
+    chain = (
+        select(blobs.c.id, blobs.c.base_hash, literal(0).label("depth"))
+        .where(blobs.c.hash == content_hash)
+        .cte("chain", recursive=True)
+    )
+    chain = chain.union_all(
+        select(blobs.c.id, blobs.c.base_hash, chain.c.depth + 1).where(
+            blobs.c.hash == chain.c.base_hash
+        )
+    )
+    return (
+        conn.execute(
+            select(blobs.c.content)
+            .join(chain, chain.c.id == blobs.c.id)
+            .order_by(chain.c.depth.desc())
+        )
+        .scalars()
+        .all()
+    )
+
+
+def _apply_deltas(chain: List[Any]) -> str:
+    content = chain[0]
+    if isinstance(content, _Delta):
+        raise Exception(f"Base {content.base_hash} of delta-encoded content is missing")
+    for delta in chain[1:]:
+        content = delta.apply(content)
+    return content
+
+
+def _resolve_content(conn: Connection, content: Any) -> Any:
+    # Content as text, applying deltas against the blobs they're based on
+    if isinstance(content, _Delta):
+        return _apply_deltas(_delta_chain(conn, content.base_hash) + [content])
+    return content
+
+
+def _point_record(conn: Connection, row) -> PointRecord:
+    record = PointRecord._make(row)
+    if isinstance(record.measure_source, _Delta) or isinstance(
+        record.diffable_content, _Delta
+    ):
+        record = record._replace(
+            measure_source=_resolve_content(conn, record.measure_source),
+            diffable_content=_resolve_content(conn, record.diffable_content),
+        )
+    return record
+
+
+def _encode_content(
+    content: str, compression: types.Compression, threshold: int
+) -> Union[str, bytes]:
+    # Compressed bytes if that's enabled and makes it smaller, else the text
+    if compression == types.Compression.none:
+        return content
+    encoded = content.encode()
+    if len(encoded) < threshold:
+        return content
+    if compression == types.Compression.zlib:
+        compressed = zlib.compress(encoded)
+    else:
+        compressed = lzma.compress(encoded)
+    return compressed if len(compressed) < len(encoded) else content
+
+
+def _text_time_us(column: str) -> str:
+    # SQL converting a DateTime stored as "YYYY-MM-DD HH:MM:SS.ffffff" text,
+    # as it was before UTCMicroseconds, to microseconds since the epoch
+    return (
+        f"CAST(strftime('%s', substr({column}, 1, 19)) AS INTEGER) * 1000000 "
+        f"+ CAST(substr({column}, 21, 6) AS INTEGER)"
+    )
+
+
+def _microseconds(delta: datetime.timedelta) -> int:
+    return delta // datetime.timedelta(microseconds=1)
+
+
+def _defer_content() -> List[ORMOption]:
+    return [defer(Point.measure_source), defer(Point.diffable_content)]
+
+
+def _point_values(point: types.Point) -> Dict[str, Any]:
+    return dict(
+        time=point.time,
+        metric_name=point.metric_name,
+        metric_value=point.metric_value,
+        absolute_max=point.absolute_max,
+        absolute_min=point.absolute_min,
+        relative_max=point.relative_max,
+        relative_min=point.relative_min,
+        measure_source=point.measure_source,
+        diffable_content=point.diffable_content,
+        url=point.url,
+        skipped=point.skipped,
+        epoch=point.epoch,
+        generation=point.generation,
+        tags=point.tags,
+    )
+
+
+def _recent_query(
+    metric_name: Optional[str],
+    count: Optional[int],
+    tags: Optional[Dict[str, Any]] = None,
+    with_content: bool = True,
+) -> Select:
+    points = Point.__table__
+    metrics = Metric.__table__
+    query = (
+        select(*_record_columns(with_content))
+        .join(metrics, metrics.c.id == points.c.metric_id)
+        .where(*_tag_filters(points.c.id, tags))
+    )
+    if metric_name is not None:
+        query = query.where(metrics.c.name == metric_name)
+    query = query.order_by(points.c.time.desc(), points.c.id.desc())
+    if count is not None:
+        query = query.limit(count)
+    return query
+
+
+def _point_row(
+    values: Dict[str, Any], metric_ids: Dict[str, int], blob_ids: Dict[str, int]
+) -> Dict[str, Any]:
+    # Row to insert into the points table for the given _point_values()
+    row = dict(values, metric_id=metric_ids[values["metric_name"]])
+    for column in ("measure_source", "diffable_content"):
+        content = row.pop(column)
+        row[f"{column}_id"] = None if content is None else blob_ids[content]
+    del row["metric_name"]
+    return row
+
+
+def _record_columns(with_content: bool = True) -> List[ColumnElement]:
+    # Columns of a PointRecord, for a query joining points with metrics.
+    # Without content, measure_source and diffable_content are NULL.
+    points = Point.__table__
+    columns = dict(
+        metric_name=Metric.name,
+        measure_source=(
+            _blob_content(points.c.measure_source_id) if with_content else null()
+        ),
+        diffable_content=(
+            _blob_content(points.c.diffable_content_id) if with_content else null()
+        ),
+    )
+    return [
+        columns[field].label(field) if field in columns else points.c[field]
+        for field in PointRecord._fields
+    ]
+
+
+def _chunked(items: Iterable[T], size: int) -> Generator[List[T], None, None]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 class AlembicCLI(alembic.config.CommandLine):
     def __init__(self, db_url: str):
         super().__init__()
@@ -34,6 +34,30 @@ class SourceType(str, enum.Enum):
 class EvalType(str, enum.Enum):
     lines = "lines"
     raw = "raw"
+    # The value under a metric's measure_key in output that has many, so
+    # that one source can be measured for any number of metrics
+    json = "json"
+    pairs = "pairs"
+
+
+class VacuumMode(str, enum.Enum):
+    full = "full"
+    incremental = "incremental"
+    none = "none"
+
+
+class StorageProfile(str, enum.Enum):
+    default = "default"
+    durable = "durable"
+    ci_fast = "ci-fast"
+    readonly = "readonly"
+    immutable = "immutable"
+
+
+class Compression(str, enum.Enum):
+    none = "none"
+    zlib = "zlib"
+    lzma = "lzma"
 
 
 class MeasureType(BaseModel):
@@ -57,6 +81,9 @@ class MetricConfig(BaseModel):
             source_type=SourceType.file_, eval_type=EvalType.lines
         )
     )
+    # Name of the value to measure in json or pairs output. Defaults to the
+    # name of the metric.
+    measure_key: Optional[str] = None
     diffable_source: str = None
     diffable_type: SourceType = SourceType.file_
     measure_source_is_diffable: bool = True
@@ -66,6 +93,11 @@ class MetricConfig(BaseModel):
     relative_min: Optional[float] = None
     url: Optional[str] = None
     epoch: int = 0
+    timeout: Optional[float] = Field(default=None, gt=0)
+    max_output_bytes: Optional[int] = Field(default=None, ge=0)
+    # Glob patterns of the files that exec and shell sources depend on, which
+    # makes their measurements cacheable like those of file sources
+    inputs: List[str] = Field(default_factory=list)
 
 
 class Config(BaseModel):
@@ -84,6 +116,15 @@ class MeasureResult(BaseModel):
     source: str
 
 
+class MetricMeasurement(BaseModel):
+    metric: MetricConfig
+    result: Optional[MeasureResult] = None
+    diffable_content: Optional[str] = None
+    error: Optional[str] = None
+    cached: bool = False
+    cache_key: Optional[str] = None
+
+
 class MetricDiff(BaseModel):
     metric_name: str
     diff: str
@@ -1,12 +1,27 @@
+import os
+import random
+import shutil
+import subprocess
+import time
 from datetime import timedelta
 from pathlib import Path
+from typing import Optional
 
 import pytest
 import tomli
+from sqlalchemy import text
 
 from tinyalert import api
+from tinyalert import db as db_module
 from tinyalert.cli_helpers import Duration
-from tinyalert.types import GenerationMatchStatus, MeasureType
+from tinyalert.db import DB, History
+from tinyalert.types import (
+    GenerationMatchStatus,
+    MeasureType,
+    MetricConfig,
+    Point,
+    VacuumMode,
+)
 
 
 def test_push_with_all_fields(db):
@@ -38,6 +53,30 @@ def test_push_with_all_fields(db):
     assert p.tags == {"foo": 1}
 
 
+@pytest.mark.parametrize("chunk_size", [1, 2, 500])
+def test_push_many(db, chunk_size):
+    points = [
+        api.make_point("errors", value=1, tags={"foo": 1}),
+        api.make_point("warnings", value=2, measure_source="source"),
+        api.make_point("errors", value=3, skipped=True, epoch=1),
+    ]
+
+    count = api.push_many(db, points, chunk_size=chunk_size)
+
+    assert count == 3
+    recents = [
+        Point.model_validate(p) for p in reversed(list(db.recent(with_content=True)))
+    ]
+    assert [p.model_dump(exclude={"time"}) for p in recents] == [
+        p.model_dump(exclude={"time"}) for p in points
+    ]
+
+
+def test_push_many_with_no_points(db):
+    assert api.push_many(db, []) == 0
+    assert list(db.recent()) == []
+
+
 @pytest.mark.parametrize(
     "source,method,expected",
     [
@@ -73,6 +112,288 @@ def test_eval_source(monkeypatch, tmp_path, source, method, expected):
     assert api.eval_source(source, method) == expected
 
 
+@pytest.mark.parametrize(
+    "source,method",
+    [
+        ("lines.txt", "file-lines"),
+        ("cat lines.txt", "exec-lines"),
+        ("cat lines.txt | cat", "shell-lines"),
+    ],
+)
+def test_measure_max_output_bytes(monkeypatch, tmp_path, source, method):
+    tmp_path.joinpath("lines.txt").write_text("".join(f"{i}\n" for i in range(50_000)))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(api, "OUTPUT_CHUNK_SIZE", 1000)
+
+    result = api.measure(source, MeasureType.model_validate(method), max_output_bytes=9)
+    assert result.value == 50_000
+    assert result.source.strip() == "0\n1\n2\n3\n4"
+
+
+@pytest.mark.parametrize(
+    "source,method,expected",
+    [
+        ("lines.txt", "file-lines", 6),
+        ("cat lines.txt", "exec-lines", 4),
+        ("cat lines.txt | cat", "shell-lines", 4),
+    ],
+)
+def test_measure_counts_lines_like_splitlines(
+    monkeypatch, tmp_path, source, method, expected
+):
+    content = "\u2028a\fb\nc\u2028d\n\x85"
+    tmp_path.joinpath("lines.txt").write_text(content, encoding="utf-8")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PYTHONIOENCODING", "utf-8")
+    monkeypatch.setattr(api, "OUTPUT_CHUNK_SIZE", 3)
+
+    result = api.measure(source, MeasureType.model_validate(method))
+    assert result.value == expected
+
+
+def test_measure_raw_longer_than_max_output_bytes():
+    with pytest.raises(Exception, match="longer than 2 bytes"):
+        api.measure(
+            "echo 100", MeasureType.model_validate("exec-raw"), max_output_bytes=2
+        )
+
+
+def test_measure_timeout():
+    # The shell's children are killed too, or reading would wait on them
+    with pytest.raises(subprocess.TimeoutExpired):
+        api.measure(
+            "sleep 30 | cat; echo 1",
+            MeasureType.model_validate("shell-raw"),
+            timeout=0.2,
+        )
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_measure_metrics(monkeypatch, tmp_path, jobs):
+    tmp_path.joinpath("test.md").write_text("a\nb")
+    monkeypatch.chdir(tmp_path)
+    metrics = [
+        # Slowest first, so that finishing order differs from config order
+        MetricConfig(
+            name="slow", measure_source="sleep 0.2; echo 3", measure_type="shell-raw"
+        ),
+        MetricConfig(name="broken", measure_source="exit 1", measure_type="shell-raw"),
+        MetricConfig(
+            name="file",
+            measure_source="test.md",
+            diffable_source="echo diff",
+            diffable_type="shell",
+        ),
+    ]
+
+    measurements = api.measure_metrics(metrics, jobs=jobs)
+
+    assert [m.metric.name for m in measurements] == ["slow", "broken", "file"]
+    assert measurements[0].result.value == 3
+    assert measurements[0].diffable_content == "3"
+    assert measurements[1].result is None
+    assert "exit status 1" in measurements[1].error
+    assert measurements[2].result.value == 2
+    assert measurements[2].diffable_content == "diff"
+    assert measurements[2].error is None
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_measure_metrics_evaluates_shared_sources_once(monkeypatch, tmp_path, jobs):
+    monkeypatch.chdir(tmp_path)
+    counted = "echo >> counted.log; sleep 0.1; printf 'a\\nb\\nc'"
+    failing = "echo >> failing.log; exit 1"
+    metrics = [
+        MetricConfig(name="lines", measure_source=counted, measure_type="shell-lines"),
+        MetricConfig(name="other", measure_source="echo 1", measure_type="shell-raw"),
+        MetricConfig(
+            name="diffed",
+            measure_source="echo 2",
+            measure_type="shell-raw",
+            diffable_source=counted,
+            diffable_type="shell",
+        ),
+        MetricConfig(name="broken", measure_source=failing, measure_type="shell-raw"),
+        MetricConfig(name="broken2", measure_source=failing, measure_type="shell-raw"),
+        # Output differs by max_output_bytes, so this one's evaluated again
+        MetricConfig(
+            name="capped",
+            measure_source=counted,
+            measure_type="shell-lines",
+            max_output_bytes=1,
+        ),
+    ]
+
+    measurements = api.measure_metrics(metrics, jobs=jobs)
+
+    assert [m.result.value if m.result else None for m in measurements] == [
+        3,
+        1,
+        2,
+        None,
+        None,
+        3,
+    ]
+    assert measurements[2].diffable_content == "a\nb\nc"
+    assert measurements[3].error == measurements[4].error
+    assert measurements[5].result.source == "a"
+    assert len(tmp_path.joinpath("counted.log").read_text().splitlines()) == 2
+    assert len(tmp_path.joinpath("failing.log").read_text().splitlines()) == 1
+
+
+@pytest.mark.parametrize(
+    "output,method,key,expected",
+    [
+        ('{"a": 1, "b": {"c": 2.5}, "b.c": 3}', "json", "a", 1),
+        ('{"a": 1, "b": {"c": 2.5}, "b.c": 3}', "json", "b.c", 3),
+        ('{"a": 1, "b": {"c": 2.5}}', "json", "b.c", 2.5),
+        ('{"a": 1, "b": {"c": 2.5}}', "json", "b.d", None),
+        ('{"a": 1, "b": {"c": 2.5}}', "json", "a.b", None),
+        ("[1, 2]", "json", "a", None),
+        ("total 10\n  lines covered 7\nlines 8", "pairs", "total", 10),
+        ("total 10\n  lines covered 7\nlines 8", "pairs", "lines covered", 7),
+        ("total 10\n  lines covered 7\nlines 8", "pairs", "lines", 8),
+        ("total 10\n  lines covered 7\nlines 8", "pairs", "covered", None),
+    ],
+)
+def test_measure_fan_out(monkeypatch, tmp_path, output, method, key, expected):
+    tmp_path.joinpath("output.txt").write_text(output)
+    monkeypatch.chdir(tmp_path)
+    measure_type = MeasureType.model_validate(f"file-{method}")
+
+    if expected is None:
+        with pytest.raises(Exception, match=f"No value for {key}"):
+            api.measure("output.txt", measure_type, key=key)
+    else:
+        result = api.measure("output.txt", measure_type, key=key)
+        assert result.value == expected
+        assert result.source == output
+
+
+def test_measure_metrics_fan_out(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    source = """echo >> calls.log; echo '{"lines": 80.5, "branches": 60}'"""
+    metrics = [
+        MetricConfig(
+            name="coverage.lines",
+            measure_source=source,
+            measure_type="shell-json",
+            measure_key="lines",
+            absolute_min=80,
+        ),
+        MetricConfig(
+            name="branches",
+            measure_source=source,
+            measure_type="shell-json",
+            absolute_min=50,
+        ),
+        MetricConfig(
+            name="functions", measure_source=source, measure_type="shell-json"
+        ),
+    ]
+
+    parsed = []
+    parse = api._parse
+
+    def counting_parse(output, method):
+        parsed.append(method)
+        return parse(output, method)
+
+    monkeypatch.setattr(api, "_parse", counting_parse)
+
+    measurements = api.measure_metrics(metrics, jobs=3)
+
+    assert [m.result.value if m.result else None for m in measurements] == [
+        80.5,
+        60,
+        None,
+    ]
+    assert measurements[2].error == f"No value for functions in output of {source}"
+    assert len(tmp_path.joinpath("calls.log").read_text().splitlines()) == 1
+    assert len(parsed) == 1
+
+    # Nothing is kept from one run to the next
+    api.measure_metrics(metrics, jobs=3)
+    assert len(tmp_path.joinpath("calls.log").read_text().splitlines()) == 2
+    assert len(parsed) == 2
+
+
+def measure_and_push(db, metrics):
+    measurements = api.measure_metrics(metrics, cache_db=db)
+    api.push_many(
+        db,
+        [
+            api.make_point(
+                m.metric.name,
+                value=m.result.value,
+                measure_source=m.result.source,
+                diffable_content=m.diffable_content,
+            )
+            for m in measurements
+        ],
+    )
+    api.cache_measurements(db, measurements)
+    return measurements
+
+
+def test_measure_metrics_cache(db, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath("foo.txt").write_text("a\nb")
+    tmp_path.joinpath("bar.txt").write_text("a\nb\nc")
+    metrics = [
+        MetricConfig(name="foo", measure_source="foo.txt"),
+        MetricConfig(
+            name="bar",
+            measure_source="cat bar.txt",
+            measure_type="exec-lines",
+            inputs=["*.txt"],
+        ),
+        MetricConfig(name="baz", measure_source="echo 1", measure_type="exec-raw"),
+    ]
+
+    measurements = measure_and_push(db, metrics)
+    assert [m.cached for m in measurements] == [False, False, False]
+    assert [m.cache_key is not None for m in measurements] == [True, True, False]
+
+    measurements = measure_and_push(db, metrics)
+    assert [m.cached for m in measurements] == [True, True, False]
+    assert [m.result.value for m in measurements] == [2, 3, 1]
+    assert [m.diffable_content for m in measurements] == ["a\nb", "a\nb\nc", "1"]
+
+    # Same size and mtime, which only hashing tells apart
+    stat = tmp_path.joinpath("foo.txt").stat()
+    tmp_path.joinpath("foo.txt").write_text("a\nc")
+    os.utime(tmp_path / "foo.txt", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    measurements = measure_and_push(db, metrics)
+    assert [m.cached for m in measurements] == [False, False, False]
+    assert measurements[0].result.source == "a\nc"
+
+    metrics[0] = MetricConfig(
+        name="foo", measure_source="foo.txt", measure_type="file-raw"
+    )
+    tmp_path.joinpath("foo.txt").write_text("10")
+    measurements = measure_and_push(db, metrics)
+    assert [m.cached for m in measurements] == [False, False, False]
+    assert measurements[0].result.value == 10
+
+
+def test_measure_metrics_cache_trusts_old_fingerprints(db, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath("foo.txt").write_text("a\nb")
+    old = time.time_ns() - 10 * 10**9
+    os.utime(tmp_path / "foo.txt", ns=(old, old))
+    metrics = [MetricConfig(name="foo", measure_source="foo.txt")]
+    measure_and_push(db, metrics)
+
+    # Changes that keep the size and mtime go unnoticed once the file has
+    # been fingerprinted well after it was last modified
+    tmp_path.joinpath("foo.txt").write_text("a\nc")
+    os.utime(tmp_path / "foo.txt", ns=(old, old))
+    [measurement] = measure_and_push(db, metrics)
+    assert measurement.cached
+    assert measurement.result.source == "a\nb"
+
+
 def test_skip_latest(db):
     api.push(db, "errors", value=1)
     api.push(db, "errors", value=7)
@@ -102,6 +423,89 @@ def test_combine_with_minimum_data(db, create_db, freezer):
     assert [p.metric_value for p in points] == [4, 7, 1]
 
 
+def test_combine_copies_all_fields(db, create_db):
+    src = create_db("coverage.db")
+    api.push(
+        src,
+        "coverage",
+        value=4,
+        absolute_max=10,
+        absolute_min=0,
+        relative_max=2,
+        relative_min=3,
+        measure_source="source",
+        diffable_content="diff",
+        url="url",
+        skipped=True,
+        epoch=1,
+        generation=2,
+        tags={"foo": "bar"},
+    )
+
+    assert api.combine(db, [src, src]) == 2
+
+    expected = Point.model_validate(next(src.recent())).model_dump()
+    assert [Point.model_validate(p).model_dump() for p in db.recent()] == [
+        expected,
+        expected,
+    ]
+
+
+def test_combine_copies_tags(db, create_db):
+    api.push(db, "errors", value=1, tags={"branch": "main"})
+    src = create_db("coverage.db")
+    api.push(src, "errors", value=2, tags={"branch": "main", "shard": 1})
+    api.push(src, "errors", value=3, tags={"branch": "dev"})
+
+    api.combine(db, [src])
+
+    assert [p.metric_value for p in db.recent(tags={"branch": "main"})] == [2, 1]
+    assert [p.metric_value for p in db.recent(tags={"shard": 1})] == [2]
+
+
+@pytest.mark.parametrize(
+    "revision,columns,values,skipped,measure_source",
+    [
+        # Initial revision, without skipped and measure_source columns
+        ("cabfb49f9f42", "diffable_content", "'diff'", False, None),
+        ("2e32d886a3b7", "skipped, measure_source", "1, 'source'", True, "source"),
+    ],
+)
+def test_combine_from_older_schema_revision(
+    db, tmp_path, revision, columns, values, skipped, measure_source
+):
+    src = DB(tmp_path / "old.db")
+    src.run_alembic("upgrade", revision)
+    with src.engine.connect() as conn:
+        conn.execute(
+            text(
+                f"INSERT INTO points (time, metric_name, metric_value, {columns}) "
+                f"VALUES ('2023-05-12 00:00:00.000000', 'errors', 3, {values})"
+            )
+        )
+        conn.commit()
+
+    assert api.combine(db, [src]) == 1
+
+    points = list(db.recent(with_content=True))
+    assert [p.metric_value for p in points] == [3]
+    assert [p.skipped for p in points] == [skipped]
+    assert [p.epoch for p in points] == [0]
+    assert [p.tags for p in points] == [{}]
+    assert [p.measure_source for p in points] == [measure_source]
+    assert src.current_revision() == revision
+
+
+def test_combine_from_unknown_schema_revision(db, create_db):
+    src = create_db("coverage.db")
+    with src.engine.connect() as conn:
+        conn.execute(text("UPDATE alembic_version SET version_num = 'ffffffffffff'"))
+        conn.commit()
+
+    with pytest.raises(Exception, match="Unknown schema revision ffffffffffff"):
+        api.combine(db, [src])
+
+
 def test_prune_with_empty_db(db):
     assert (
         api.prune(db, keep_last=0, keep_within=timedelta(seconds=0), keep_auto=True)
@@ -113,24 +517,187 @@ def test_prune_with_empty_db(db):
     )
 
 
+def reference_prune(
+    db: DB,
+    keep_last: Optional[int] = None,
+    keep_within: Optional[timedelta] = None,
+    keep_auto: bool = False,
+) -> int:
+    """Original, per-metric Python implementation of api.prune
+
+    Kept as an oracle for the set-based implementation in DB.prune.
+    """
+    total_pruned = 0
+    for metric_name in db.iter_metric_names():
+        points = list(db.recent(metric_name, count=None))
+
+        auto_prune_before = _reference_prune_point_auto(points)
+        prune_candidates = list(
+            filter(
+                None,
+                (
+                    _reference_prune_point_last(points, keep_last),
+                    _reference_prune_point_within(
+                        points, auto_prune_before, keep_within
+                    ),
+                    auto_prune_before if keep_auto else None,
+                ),
+            )
+        )
+
+        if not prune_candidates:
+            continue
+
+        # Take the oldest point
+        prune_before = sorted(prune_candidates, key=lambda p: (p.time, p.id))[0]
+        total_pruned += db.prune_before(prune_before)
+
+    return total_pruned
+
+
+def _reference_prune_point_last(points, keep_last):
+    assert keep_last is None or keep_last > 0
+    if not points:
+        return
+    if keep_last is None:
+        return
+    if len(points) < keep_last:
+        return points[-1]
+    return points[keep_last - 1]
+
+
+def _reference_prune_point_within(points, auto_prune_before, keep_within):
+    assert keep_within is None or keep_within.total_seconds() > 0
+    assert points
+    if keep_within is None:
+        return
+    if len(points) == 1:
+        return points[0]
+    anchor_point = auto_prune_before or points[0]
+    keep_within_abs = anchor_point.time - keep_within
+    prune_before = points[1]
+    for p in points[2:]:
+        if p.time < keep_within_abs:
+            break
+        prune_before = p
+    return prune_before
+
+
+def _reference_prune_point_auto(points):
+    if not points:
+        return
+    if len(points) == 1:
+        return points[0]
+
+    current_epoch_points = list(api._iter_current_epoch_points(points))
+    eligible_points = api._iter_alert_eligible_points(current_epoch_points)
+    latest, previous, _ = api._report_points(eligible_points)
+
+    if latest and not latest.skipped:
+        return latest
+    elif previous:
+        return previous
+    return current_epoch_points[-1] if current_epoch_points else None
+
+
+@pytest.mark.parametrize("prune", [api.prune, reference_prune])
 @pytest.mark.parametrize(
     "fixture_path",
     list(Path(__file__).parent.joinpath("__fixtures__").glob("api_prune_*.toml")),
 )
-def test_prune_with_fixtures(db_from_csv, fixture_path):
+def test_prune_with_fixtures(db_from_csv, fixture_path, prune):
     testcase = tomli.loads(fixture_path.read_text())
     db = db_from_csv(testcase["points"])
 
     kwargs = testcase.get("args", {})
     if "keep_within" in kwargs:
         kwargs["keep_within"] = Duration.from_string(kwargs["keep_within"])
-    deleted = api.prune(db, **kwargs)
+    deleted = prune(db, **kwargs)
     points = list(db.recent())
 
     assert deleted == testcase["result"]["return_value"]
     assert [p.metric_value for p in points] == testcase["result"]["recent_values"]
 
 
+def freelist_count(db):
+    with db.connection() as conn:
+        return conn.execute(text("PRAGMA freelist_count")).scalar()
+
+
+@pytest.fixture
+def db_with_prunable_points(db):
+    for i in range(20):
+        api.push(db, "errors", value=i, measure_source=f"{i}" + "x" * 10_000)
+    return db
+
+
+@pytest.mark.parametrize("vacuum", [VacuumMode.full, VacuumMode.incremental])
+def test_prune_releases_free_pages(db_with_prunable_points, vacuum):
+    db = db_with_prunable_points
+
+    assert api.prune(db, keep_last=1, vacuum=vacuum) == 19
+    assert freelist_count(db) == 0
+
+
+def test_prune_without_vacuum_keeps_free_pages(db_with_prunable_points):
+    db = db_with_prunable_points
+
+    assert api.prune(db, keep_last=1, vacuum=VacuumMode.none) == 19
+    assert freelist_count(db) > 0
+
+
+def test_recent_filters_by_tags(db):
+    api.push(db, "errors", value=1, tags={"branch": "main", "shard": 1})
+    api.push(db, "errors", value=2, tags={"branch": "main", "shard": 2})
+    api.push(db, "warnings", value=3, tags={"branch": "dev", "shard": 1})
+    api.push(db, "warnings", value=4, tags={"cached": True, "matrix": ["a", 1]})
+
+    def values(tags):
+        return [p.metric_value for p in api.recent(db, tags=tags)]
+
+    assert values({"branch": "main"}) == [2, 1]
+    assert values({"shard": 1}) == [3, 1]
+    assert values({"shard": "1", "branch": "dev"}) == [3]
+    assert values({"cached": True}) == values({"cached": "true"}) == [4]
+    assert values({"matrix": ["a", 1]}) == [4]
+    assert values({"branch": "release"}) == []
+    assert values({}) == [4, 3, 2, 1]
+
+
+def test_gather_report_data_filters_by_tags(db):
+    api.push(db, "errors", value=1, tags={"branch": "main"})
+    api.push(db, "errors", value=2, tags={"branch": "dev"})
+    api.push(db, "errors", value=3, tags={"branch": "main"})
+    api.push(db, "errors", value=4, tags={"branch": "dev"})
+    api.push(db, "warnings", value=5, tags={"branch": "dev"})
+
+    data = api.gather_report_data(db, "errors", tags={"branch": "main"})
+
+    assert data.latest_values == [1, 3]
+    assert data.latest_value == 3
+    assert data.previous_value == 1
+    assert list(api.gather_all_report_data(db, tags={"branch": "main"})) == ["errors"]
+
+
+def test_skip_latest_filters_by_tags(db):
+    api.push(db, "errors", value=1, tags={"branch": "main"})
+    api.push(db, "errors", value=2, tags={"branch": "dev"})
+
+    api.skip_latest(db, "errors", tags={"branch": "main"})
+
+    assert [p.skipped for p in db.recent()] == [False, True]
+
+
+def test_prune_removes_tags_of_pruned_points(db):
+    for i in range(5):
+        api.push(db, "errors", value=i, tags={"branch": "main"})
+
+    api.prune(db, keep_last=2)
+
+    with db.connection() as conn:
+        assert conn.execute(text("SELECT count(*) FROM point_tags")).scalar() == 2
+
+
 def test_rename(db):
     api.push(db, "warnings", value=10, epoch=1)
     api.push(db, "warnings", value=10, epoch=2)
@@ -144,6 +711,7 @@ def test_rename(db):
     assert len(list(db.recent("warnings", count=10))) == 0
     assert len(list(db.recent("errors", count=10))) == 2
     assert len(list(db.recent("infos", count=10))) == 2
+    assert list(db.iter_metric_names()) == ["errors", "infos"]
 
 
 def test_rename_no_points(db):
@@ -170,6 +738,7 @@ def test_rename_existing_points_with_same_destination_name(db):
 
     assert len(list(db.recent("warnings", count=10))) == 0
     assert len(list(db.recent("errors", count=10))) == 4
+    assert list(db.iter_metric_names()) == ["errors"]
 
 
 def test_recent(db):
@@ -203,7 +772,9 @@ def test_recent(db):
     assert points[0].epoch == 1
     assert points[0].tags == {}
 
-    points = list(db.recent(count=3))
+    # Content is only loaded when asked for
+    assert [p.measure_source for p in db.recent(count=3)] == [None, None]
+    points = list(db.recent(count=3, with_content=True))
 
     assert len(points) == 2
     assert points[0].metric_name == "warnings"
@@ -395,3 +966,155 @@ def test_gather_report_data_dont_alert_on_different_epoch(db):
     assert data.latest_values == [1.0, 2.0]
     assert data.latest_value == 2
     assert data.previous_value is None
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_report_data_from_heads_matches_history(db, freezer, seed):
+    rng = random.Random(seed)
+    metric_names = ["errors", "warnings", "coverage"]
+    for _ in range(rng.randint(0, 40)):
+        api.push(
+            db,
+            rng.choice(metric_names),
+            value=rng.randint(0, 5),
+            diffable_content=str(rng.random()),
+            skipped=rng.random() < 0.3,
+            epoch=rng.choice([0, 0, 0, 1, 2]),
+            generation=rng.randint(0, 2),
+        )
+        if rng.random() < 0.1:
+            api.skip_latest(db, rng.choice(metric_names))
+        if rng.random() < 0.05:
+            api.rename(db, rng.choice(metric_names), rng.choice(metric_names))
+        if rng.random() < 0.7:
+            freezer.tick()
+
+    for head_generation in (None, 0, 1, 2):
+        reports = api.gather_all_report_data(db, head_generation)
+
+        assert list(reports.keys()) == sorted(db.iter_metric_names())
+        for metric_name, report in reports.items():
+            expected = api._gather_report_data_from_history(
+                db, metric_name, head_generation
+            )
+            assert report.model_dump() == expected.model_dump()
+            assert api.gather_report_data(db, metric_name, head_generation) == report
+    assert api.check_heads(db) == []
+
+
+def test_heads_follow_prune(db, freezer):
+    for i in range(20):
+        api.push(db, "errors", value=i, skipped=i % 3 == 0)
+        api.push(db, "warnings", value=i, epoch=i // 10)
+        freezer.tick()
+
+    api.prune(db, keep_last=3)
+
+    assert api.gather_report_data(db, "errors").latest_values == [17, 18, 19]
+    assert api.check_heads(db) == []
+
+
+def test_heads_follow_combine(create_db):
+    dest_db = create_db("dest.db")
+    api.push(dest_db, "errors", value=1)
+    src_db = create_db("src.db")
+    api.push(src_db, "errors", value=2)
+    api.push(src_db, "warnings", value=3)
+
+    api.combine(dest_db, [src_db])
+
+    assert api.gather_report_data(dest_db, "errors").latest_values == [1, 2]
+    assert api.gather_report_data(dest_db, "warnings").latest_value == 3
+    assert api.check_heads(dest_db) == []
+
+
+def test_rebuild_heads(db):
+    for i in range(15):
+        api.push(db, "errors", value=i, skipped=i > 10)
+    api.push(db, "warnings", value=1)
+    expected = api.gather_all_report_data(db)
+    with db.connection() as conn:
+        conn.execute(text("UPDATE metric_heads SET latest_values = '[]'"))
+        conn.execute(
+            text(
+                "DELETE FROM metric_heads WHERE metric_id = "
+                "(SELECT id FROM metrics WHERE name = 'warnings')"
+            )
+        )
+        conn.commit()
+
+    assert api.check_heads(db) == ["errors", "warnings"]
+    assert api.rebuild_heads(db) == 2
+    assert api.gather_all_report_data(db) == expected
+    assert api.check_heads(db) == []
+
+
+@pytest.fixture
+def recorded_reads(monkeypatch):
+    reads = []
+
+    class RecordingHistory(History):
+        def __init__(self, points, close):
+            def recording_points():
+                for p in points:
+                    reads.append(p.metric_value)
+                    yield p
+
+            super().__init__(recording_points(), close)
+
+    monkeypatch.setattr(db_module, "History", RecordingHistory)
+    return reads
+
+
+def test_gather_report_data_reads_only_what_it_needs(db, recorded_reads):
+    for i in range(50):
+        api.push(db, "errors", value=i, skipped=i > 30)
+
+    data = api._gather_report_data_from_history(db, "errors")
+
+    assert data.latest_values == list(range(40, 50))
+    assert data.previous_value == 30
+    assert recorded_reads == list(range(49, 29, -1))
+
+
+def test_gather_report_data_stops_at_epoch_boundary(db, recorded_reads):
+    for i in range(50):
+        api.push(db, "errors", value=i, skipped=True, epoch=0 if i < 30 else 1)
+
+    data = api._gather_report_data_from_history(db, "errors")
+
+    assert data.previous_value is None
+    assert recorded_reads == list(range(49, 28, -1))
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_prune_matches_reference_implementation(create_db, freezer, seed):
+    rng = random.Random(seed)
+    db = create_db("tinyalert.db")
+    for _ in range(rng.randint(0, 40)):
+        api.push(
+            db,
+            rng.choice(["errors", "warnings", "coverage"]),
+            value=rng.randint(0, 5),
+            skipped=rng.random() < 0.4,
+            epoch=rng.choice([0, 0, 0, 1, 2]),
+        )
+        freezer.tick(
+            delta=rng.choice(
+                [timedelta(0), timedelta(microseconds=1), timedelta(hours=6)]
+            )
+        )
+    reference_db = create_db("reference.db")
+    shutil.copy(db.db_path, reference_db.db_path)
+    kwargs = dict(
+        keep_last=rng.choice([None, 1, 2, 5]),
+        keep_within=rng.choice(
+            [None, timedelta(hours=6), timedelta(hours=6, microseconds=1)]
+        ),
+        keep_auto=rng.random() < 0.5,
+    )
+
+    assert api.prune(db, **kwargs) == reference_prune(reference_db, **kwargs)
+    assert [p.id for p in db.recent(count=None)] == [
+        p.id for p in reference_db.recent(count=None)
+    ]
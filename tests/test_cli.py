@@ -7,10 +7,12 @@ from unittest.mock import MagicMock
 import pytest
 import tomli_w
 from click.testing import CliRunner
+from sqlalchemy import text
 
 from tinyalert import api
 from tinyalert.cli import cli
-from tinyalert.types import MetricConfig
+from tinyalert.db import DB
+from tinyalert.types import MetricConfig, VacuumMode
 
 
 @pytest.fixture
@@ -50,6 +52,171 @@ def read_recents(runner, db_path):
     return [json.loads(line) for line in recent_result.stdout.split("\n") if line]
 
 
+# --db-profile
+
+
+def test_db_profile_option(runner, monkeypatch):
+    result = runner.invoke(
+        cli,
+        ["--db", "db.sqlite", "--db-profile", "ci-fast", "push", "errors"],
+        input="1",
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output + result.stderr
+
+    monkeypatch.setenv("TINYALERT_DB_PROFILE", "readonly")
+    result = runner.invoke(cli, ["--db", "db.sqlite", "push", "errors"], input="2")
+    assert result.exit_code == 1
+    assert "readonly database" in str(result.exception)
+    assert [r["metric_value"] for r in read_recents(runner, "db.sqlite")] == [1]
+
+
+def test_report_with_immutable_profile(runner, db):
+    api.push(db, "errors", value=2, absolute_max=1)
+    args = ["--db", str(db.db_path), "--db-profile", "immutable", "report"]
+
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 1, result.output + result.stderr
+    assert "errors" in result.output
+
+    result = runner.invoke(cli, args + ["--mute"])
+    assert result.exit_code == 2
+    assert "read-only 'immutable' profile" in result.stderr
+    assert not next(db.recent()).skipped
+
+
+def test_report_with_readonly_profile_on_unusable_db(runner, temp_dir):
+    args = ["--db", "db.sqlite", "--db-profile", "readonly", "report"]
+
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 1
+    assert result.stderr == "Error: Database db.sqlite doesn't exist\n"
+
+    DB(temp_dir / "db.sqlite").run_alembic("upgrade", "962fe3917799")
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 1
+    assert "Error: Database db.sqlite is at revision 962fe3917799" in result.stderr
+    assert "Traceback" not in result.stderr
+
+
+# --in-memory
+
+
+def test_in_memory_option(runner, write_config, monkeypatch):
+    config_path = write_config(
+        [MetricConfig(name="foo", measure_source="echo 2", measure_type="shell-raw")]
+    )
+    runner.invoke(cli, ["--db", "db.sqlite", "push", "foo", "--value", "1"])
+
+    monkeypatch.setenv("TINYALERT_IN_MEMORY", "1")
+    for args in [
+        ["measure", "--config", config_path],
+        ["push", "foo", "--value", "3", "--abs-max", "2"],
+        ["report", "--mute"],
+        ["prune", "--keep-last", "2"],
+    ]:
+        result = runner.invoke(cli, ["--db", "db.sqlite"] + args)
+        assert result.exit_code == 0, result.output + result.stderr
+    monkeypatch.delenv("TINYALERT_IN_MEMORY")
+
+    recents = read_recents(runner, "db.sqlite")
+    assert [(r["metric_value"], r["skipped"]) for r in recents] == [
+        (3, True),
+        (2, False),
+    ]
+
+
+def test_in_memory_option_discards_changes_on_error(runner, write_config, monkeypatch):
+    config_path = write_config(
+        [MetricConfig(name="foo", measure_source="echo 2", measure_type="shell-raw")]
+    )
+    runner.invoke(cli, ["--db", "db.sqlite", "push", "foo", "--value", "1"])
+
+    def fail(*args):
+        raise RuntimeError("cache is broken")
+
+    monkeypatch.setattr(api, "cache_measurements", fail)
+    result = runner.invoke(
+        cli, ["--db", "db.sqlite", "--in-memory", "measure", "--config", config_path]
+    )
+    assert isinstance(result.exception, RuntimeError), result
+
+    assert [r["metric_value"] for r in read_recents(runner, "db.sqlite")] == [1]
+
+
+def test_in_memory_option_keeps_changes_on_exit(runner, write_config):
+    config_path = write_config(
+        [
+            MetricConfig(name="foo", measure_source="echo 2", measure_type="shell-raw"),
+            MetricConfig(name="bar", measure_source="false", measure_type="exec-raw"),
+        ]
+    )
+
+    result = runner.invoke(
+        cli, ["--db", "db.sqlite", "--in-memory", "measure", "--config", config_path]
+    )
+    assert result.exit_code == 1, result
+
+    assert [r["metric_value"] for r in read_recents(runner, "db.sqlite")] == [2]
+
+
+# --compression
+
+
+def test_compression_option(runner, monkeypatch):
+    monkeypatch.setenv("TINYALERT_COMPRESSION", "lzma")
+    result = runner.invoke(
+        cli,
+        ["--db", "db.sqlite", "--compression-threshold", "0"]
+        + ["push", "errors", "--value", "1", "--source", "x" * 1000],
+    )
+    assert result.exit_code == 0, result.output + result.stderr
+
+    monkeypatch.delenv("TINYALERT_COMPRESSION")
+    assert [r["measure_source"] for r in read_recents(runner, "db.sqlite")] == [
+        "x" * 1000
+    ]
+    with DB("db.sqlite").connection() as conn:
+        assert conn.execute(text("SELECT typeof(content) FROM blobs")).scalar() == (
+            "blob"
+        )
+
+    # Later runs compress the same way without being told to
+    result = runner.invoke(
+        cli,
+        ["--db", "db.sqlite", "push", "errors", "--value", "2", "--source", "y" * 1000],
+    )
+    assert result.exit_code == 0, result.output + result.stderr
+    with DB("db.sqlite").connection() as conn:
+        assert conn.execute(
+            text("SELECT typeof(content) FROM blobs ORDER BY id")
+        ).scalars().all() == ["blob", "blob"]
+
+
+# --keyframe-interval
+
+
+def test_keyframe_interval_option(runner):
+    contents = ["a\nb\n" * 100, "a\nc\n" + "a\nb\n" * 99]
+    for content in contents:
+        result = runner.invoke(
+            cli,
+            ["--db", "db.sqlite", "--keyframe-interval", "10"]
+            + ["push", "errors", "--value", "1", "--diffable", content],
+        )
+        assert result.exit_code == 0, result.output + result.stderr
+
+    recents = read_recents(runner, "db.sqlite")
+    assert [r["diffable_content"] for r in recents] == contents[::-1]
+    with DB("db.sqlite").connection() as conn:
+        assert (
+            conn.execute(
+                text("SELECT count(*) FROM blobs WHERE base_hash IS NOT NULL")
+            ).scalar()
+            == 1
+        )
+
+
 # push
 
 
@@ -275,6 +442,127 @@ def test_measure_tags(runner, temp_dir, write_config):
     assert recents[0]["tags"] == {"foo": "1", "bar": "a", "baz": "qux", "xyz": 2}
 
 
+def test_measure_jobs_reports_failures(runner, temp_dir, write_config):
+    config_path = write_config(
+        [
+            MetricConfig(name="foo", measure_source="echo 1", measure_type="exec-raw"),
+            MetricConfig(name="bar", measure_source="false", measure_type="exec-raw"),
+            MetricConfig(name="baz", measure_source="echo 3", measure_type="exec-raw"),
+        ]
+    )
+
+    result = runner.invoke(
+        cli,
+        ["--db", "db.sqlite", "measure", "--jobs", "2", "--config", config_path],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 1, result
+    assert "Failed to measure bar" in result.stderr
+
+    recents = read_recents(runner, "db.sqlite")
+    assert {p["metric_name"]: p["metric_value"] for p in recents} == {
+        "foo": 1,
+        "baz": 3,
+    }
+
+
+def test_measure_cache(runner, temp_dir, write_config):
+    config_path = write_config(
+        [
+            MetricConfig(name="foo", measure_source="foo.txt"),
+            MetricConfig(name="bar", measure_source="echo 1", measure_type="exec-raw"),
+        ]
+    )
+    temp_dir.joinpath("foo.txt").write_text("1\n2\n")
+    args = ["--db", "db.sqlite", "measure", "--config", config_path]
+
+    result = runner.invoke(cli, args, catch_exceptions=False)
+    assert result.exit_code == 0, result
+    assert "0 of 2 metrics served from cache" in result.stderr
+
+    result = runner.invoke(cli, args, catch_exceptions=False)
+    assert result.exit_code == 0, result
+    assert "1 of 2 metrics served from cache" in result.stderr
+
+    result = runner.invoke(cli, args + ["--no-cache"], catch_exceptions=False)
+    assert result.exit_code == 0, result
+    assert "served from cache" not in result.stderr
+
+    recents = read_recents(runner, "db.sqlite")
+    assert [(p["metric_name"], p["metric_value"]) for p in recents] == [
+        ("bar", 1),
+        ("foo", 2),
+    ] * 3
+
+
+def test_measure_cache_after_rename(runner, temp_dir, write_config):
+    temp_dir.joinpath("out.json").write_text('{"a": 1, "b": 2}')
+
+    def measure(name):
+        config_path = write_config(
+            [
+                MetricConfig(
+                    name=name, measure_source="out.json", measure_type="file-json"
+                )
+            ]
+        )
+        result = runner.invoke(
+            cli,
+            ["--db", "db.sqlite", "measure", "--config", config_path],
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0, result
+        return result
+
+    measure("a")
+    result = runner.invoke(cli, ["--db", "db.sqlite", "rename", "a", "b"])
+    assert result.exit_code == 0, result
+
+    # The metric's name is also the key it looks up in the output
+    result = measure("b")
+    assert "0 of 1 metrics served from cache" in result.stderr
+    recents = read_recents(runner, "db.sqlite")
+    assert [(p["metric_name"], p["metric_value"]) for p in recents] == [
+        ("b", 2),
+        ("b", 1),
+    ]
+
+
+def test_measure_fan_out(runner, temp_dir, write_config):
+    config_path = write_config(
+        [
+            MetricConfig(
+                name="bundle.main",
+                measure_source="sizes.txt",
+                measure_type="file-pairs",
+                measure_key="main.js",
+                absolute_max=100,
+            ),
+            MetricConfig(
+                name="bundle.vendor",
+                measure_source="sizes.txt",
+                measure_type="file-pairs",
+                measure_key="vendor.js",
+                relative_max=10,
+            ),
+        ]
+    )
+    temp_dir.joinpath("sizes.txt").write_text("main.js 42\nvendor.js 1337\n")
+
+    result = runner.invoke(
+        cli,
+        ["--db", "db.sqlite", "measure", "--config", config_path],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result
+
+    recents = read_recents(runner, "db.sqlite")
+    assert [
+        (p["metric_name"], p["metric_value"], p["absolute_max"], p["relative_max"])
+        for p in recents
+    ] == [("bundle.vendor", 1337, None, 10), ("bundle.main", 42, 100, None)]
+
+
 def test_measure_non_existent_metric(runner, temp_dir, write_config):
     config_path = write_config(
         [
@@ -333,7 +621,7 @@ def test_combine_works_against_empty_db(runner, create_db):
 
 
 def test_recent_works(runner, db):
-    api.push(db, "errors", value=1)
+    api.push(db, "errors", value=1, measure_source="source")
     api.push(db, "coverage", value=4)
 
     recent_result = runner.invoke(
@@ -346,6 +634,34 @@ def test_recent_works(runner, db):
     assert len(recents) == 2
     assert recents[0]["metric_name"] == "coverage"
     assert recents[1]["metric_name"] == "errors"
+    assert recents[1]["measure_source"] == "source"
+
+
+def test_recent_filters_by_tags(runner, db):
+    api.push(db, "errors", value=1, tags={"branch": "main", "runner": "linux"})
+    api.push(db, "errors", value=2, tags={"branch": "main", "runner": "macos"})
+    api.push(db, "errors", value=3, tags={"branch": "dev", "runner": "linux"})
+
+    result = runner.invoke(
+        cli,
+        [
+            "--db",
+            str(db.db_path),
+            "recent",
+            "--json",
+            "--tag",
+            "branch",
+            "main",
+            "--tag",
+            "runner",
+            "linux",
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output + result.stderr
+
+    recents = [json.loads(line) for line in result.stdout.split("\n") if line]
+    assert [r["metric_value"] for r in recents] == [1]
 
 
 # report
@@ -388,6 +704,37 @@ def test_report_exits_with_error_when_latest_value_violates_threshold(runner, db
     assert report["status"] == "alarm"
 
 
+def test_report_filters_by_tags(runner, db):
+    api.push(db, "errors", value=10, absolute_max=0, tags={"branch": "dev"})
+    api.push(db, "errors", value=0, absolute_max=0, tags={"branch": "main"})
+    api.push(db, "warnings", value=10, absolute_max=0, tags={"branch": "dev"})
+    api.push(db, "coverage", value=10, absolute_max=0)
+
+    result = runner.invoke(
+        cli,
+        ["--db", str(db.db_path), "report", "--format", "json"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 1, result.output + result.stderr
+
+    result = runner.invoke(
+        cli,
+        [
+            "--db",
+            str(db.db_path),
+            "report",
+            "--format",
+            "json",
+            "--tag",
+            "branch",
+            "main",
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output + result.stderr
+    assert list(json.loads(result.stdout)["reports"].keys()) == ["errors"]
+
+
 def test_report_returns_ok_when_non_current_generation_violates_threshold(runner, db):
     api.push(
         db, "errors", value=10, absolute_max=0, diffable_content="foo", generation=1
@@ -500,6 +847,30 @@ def test_prune_calls_api_with_expected_args(monkeypatch, runner, db):
     assert mock_prune.call_args.kwargs["keep_auto"]
 
 
+def test_prune_passes_vacuum_options(monkeypatch, runner, db):
+    mock_prune = MagicMock()
+    mock_prune.return_value = 3
+    monkeypatch.setattr(api, "prune", mock_prune)
+    result = runner.invoke(
+        cli,
+        [
+            "--db",
+            str(db.db_path),
+            "prune",
+            "--keep-auto",
+            "--vacuum",
+            "incremental",
+            "--vacuum-pages",
+            "100",
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.stdout + "\n" + result.stderr
+
+    assert mock_prune.call_args.kwargs["vacuum"] == VacuumMode.incremental
+    assert mock_prune.call_args.kwargs["vacuum_pages"] == 100
+
+
 # rename
 
 
@@ -513,6 +884,39 @@ def test_rename_command(runner, db):
     assert "Renamed 1 points" in result.stdout, result.output + result.stderr
 
 
+# rebuild-heads
+
+
+def test_rebuild_heads_command(runner, db):
+    api.push(db, "errors", value=10)
+    result = runner.invoke(
+        cli, ["--db", str(db.db_path), "rebuild-heads"], catch_exceptions=False
+    )
+    assert "Rebuilt heads of 1 metrics" in result.stdout, result.output + result.stderr
+
+    result = runner.invoke(
+        cli,
+        ["--db", str(db.db_path), "rebuild-heads", "--check"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output + result.stderr
+
+
+def test_rebuild_heads_check_fails_on_mismatch(runner, db):
+    api.push(db, "errors", value=10)
+    with db.connection() as conn:
+        conn.execute(text("DELETE FROM metric_heads"))
+        conn.commit()
+
+    result = runner.invoke(
+        cli,
+        ["--db", str(db.db_path), "rebuild-heads", "--check"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 1
+    assert "Head of errors doesn't match its history" in result.stderr
+
+
 # migrate
 
 
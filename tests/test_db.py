@@ -0,0 +1,513 @@
+import datetime
+import itertools
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+
+from tinyalert import api
+from tinyalert import db as db_module
+from tinyalert.db import DB, HEAD_REVISION, Base, PointRecord
+from tinyalert.types import Compression, StorageProfile
+
+
+def test_migrations_match_models(db):
+    with db.engine.connect() as conn:
+        diff = compare_metadata(MigrationContext.configure(conn), Base.metadata)
+
+    assert diff == []
+
+
+def test_recent_uses_metric_id_index(db):
+    api.push(db, "errors", value=1)
+    query = db_module._recent_query("errors", 10)
+    compiled = query.compile(db.engine, compile_kwargs={"literal_binds": True})
+
+    with db.connection() as conn:
+        plan = conn.execute(text(f"EXPLAIN QUERY PLAN {compiled}")).all()
+
+    details = " ".join(row[-1] for row in plan)
+    assert "ix_points_metric_id_time_id" in details
+    assert "TEMP B-TREE" not in details
+
+
+def test_head_revision_matches_latest_migration():
+    script = ScriptDirectory(str(Path(db_module.__file__).parent / "alembic"))
+
+    assert script.get_current_head() == HEAD_REVISION
+
+
+def test_current_revision(tmp_path):
+    db = DB(tmp_path / "tinyalert.db")
+    assert db.current_revision() is None
+
+    db.migrate()
+    assert db.current_revision() == HEAD_REVISION
+
+
+def test_session_skips_alembic_when_up_to_date(db, monkeypatch):
+    fresh = DB(db.db_path)
+    run_alembic = MagicMock()
+    monkeypatch.setattr(fresh, "run_alembic", run_alembic)
+
+    api.push(fresh, "errors", value=1)
+
+    assert run_alembic.call_count == 0
+
+
+def test_session_migrates_outdated_db(tmp_path):
+    db = DB(tmp_path / "tinyalert.db")
+    db.run_alembic("upgrade", "a89fc25c0947")
+
+    api.push(db, "errors", value=1)
+
+    assert db.current_revision() == HEAD_REVISION
+
+
+def test_migration_backfills_metrics_catalog(tmp_path):
+    db = DB(tmp_path / "tinyalert.db")
+    db.run_alembic("upgrade", "962fe3917799")
+    with db.engine.connect() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO points (time, metric_name, metric_value) VALUES "
+                "('2023-05-12 00:00:00.000000', 'warnings', 1), "
+                "('2023-05-12 00:00:00.000000', 'errors', 2), "
+                "('2023-05-13 00:00:00.000000', 'warnings', 3)"
+            )
+        )
+        conn.commit()
+
+    db.migrate()
+
+    assert list(db.iter_metric_names()) == ["errors", "warnings"]
+    assert [(p.time, p.metric_name, p.metric_value) for p in db.recent()] == [
+        (datetime.datetime(2023, 5, 13), "warnings", 3),
+        (datetime.datetime(2023, 5, 12), "errors", 2),
+        (datetime.datetime(2023, 5, 12), "warnings", 1),
+    ]
+    assert api.check_heads(db) == []
+
+
+def test_migration_backfills_point_tags(db):
+    api.push(db, "errors", value=1, tags={"branch": "main", "shard": 1})
+    api.push(db, "errors", value=2, tags={"branch": "dev", "nested": {"a": [1]}})
+
+    db.run_alembic("downgrade", "00e50b3b5265")
+    db.run_alembic("upgrade", "head")
+
+    with db.connection() as conn:
+        rows = conn.execute(
+            text("SELECT point_id, key, value FROM point_tags ORDER BY point_id, key")
+        ).all()
+    assert rows == [
+        (1, "branch", "main"),
+        (1, "shard", "1"),
+        (2, "branch", "dev"),
+        (2, "nested", '{"a":[1]}'),
+    ]
+
+
+def test_migration_moves_content_to_blobs(db):
+    api.push(db, "errors", value=1, measure_source="src", diffable_content="diff")
+    api.push(db, "errors", value=2, measure_source="src", diffable_content="src")
+    api.push(db, "errors", value=3)
+
+    db.run_alembic("downgrade", "f2461755f373")
+    db.run_alembic("upgrade", "head")
+
+    with db.connection() as conn:
+        assert conn.execute(text("SELECT content FROM blobs ORDER BY id")).all() == [
+            ("src",),
+            ("diff",),
+        ]
+    assert [
+        (p.measure_source, p.diffable_content) for p in db.recent(with_content=True)
+    ] == [
+        (None, None),
+        ("src", "src"),
+        ("src", "diff"),
+    ]
+
+
+def test_identical_content_is_stored_once(db):
+    def blob_count():
+        with db.connection() as conn:
+            return conn.execute(text("SELECT count(*) FROM blobs")).scalar()
+
+    api.push(db, "errors", value=1, measure_source="a", diffable_content="b")
+    db.add_many(
+        [
+            api.make_point("errors", value=2, measure_source="b"),
+            api.make_point("warnings", value=3, diffable_content="c"),
+        ]
+    )
+    assert blob_count() == 3
+    assert [
+        (p.measure_source, p.diffable_content) for p in db.recent(with_content=True)
+    ] == [
+        (None, "c"),
+        ("b", None),
+        ("a", "b"),
+    ]
+
+    db.prune(keep_last=1)
+    assert blob_count() == 2
+
+
+@pytest.mark.parametrize("compression", [Compression.zlib, Compression.lzma])
+def test_compressed_content(db, create_db, compression):
+    large = "line too long\n" * 1000
+    compressed = DB(db.db_path, compression=compression, compression_threshold=100)
+    api.push(compressed, "errors", value=1, measure_source="small")
+    api.push(compressed, "errors", value=2, measure_source=large)
+
+    with db.connection() as conn:
+        rows = conn.execute(
+            text("SELECT typeof(content), length(content) FROM blobs ORDER BY id")
+        ).all()
+    assert rows[0] == ("text", 5)
+    assert rows[1][0] == "blob" and rows[1][1] < len(large) / 10
+    assert [p.measure_source for p in db.recent(with_content=True)] == [large, "small"]
+
+    combined = create_db("combined.db")
+    api.combine(combined, [compressed])
+    assert [p.measure_source for p in combined.recent(with_content=True)] == [
+        large,
+        "small",
+    ]
+
+    db.run_alembic("downgrade", "f2461755f373")
+    with db.connection() as conn:
+        assert conn.execute(
+            text("SELECT measure_source FROM points ORDER BY id")
+        ).scalars().all() == ["small", large]
+
+
+def test_compression_is_stored_in_the_database(db):
+    assert db.compression == Compression.none
+    assert db.compression_threshold == db_module.DEFAULT_COMPRESSION_THRESHOLD
+
+    compressed = DB(db.db_path, compression=Compression.zlib, compression_threshold=10)
+    api.push(compressed, "errors", value=1, measure_source="x" * 100)
+    stored = DB(db.db_path)
+    assert (stored.compression, stored.compression_threshold) == (
+        Compression.zlib,
+        10,
+    )
+
+    # Overridden for a read-only run without being saved
+    read_only = DB(
+        db.db_path, profile=StorageProfile.readonly, compression=Compression.lzma
+    )
+    assert read_only.compression == Compression.lzma
+    assert read_only.compression_threshold == 10
+    assert DB(db.db_path).compression == Compression.zlib
+
+    # Saved again by a run that gives one
+    assert DB(db.db_path, compression=Compression.lzma).compression_threshold == 10
+    assert DB(db.db_path).compression == Compression.lzma
+
+
+def test_tag_filter_uses_index(db):
+    api.push(db, "errors", value=1, tags={"branch": "main"})
+    query = db_module._recent_query(None, 10, {"branch": "main"})
+    compiled = query.compile(db.engine, compile_kwargs={"literal_binds": True})
+
+    with db.connection() as conn:
+        plan = conn.execute(text(f"EXPLAIN QUERY PLAN {compiled}")).all()
+
+    details = " ".join(row[-1] for row in plan)
+    assert "ix_point_tags_key_value_point_id" in details
+    assert "SCAN" not in details
+
+
+def test_migration_backfills_metric_heads(db):
+    for i in range(15):
+        api.push(db, "errors", value=i, skipped=i % 4 != 0, epoch=i // 10)
+        api.push(db, "warnings", value=i, skipped=i > 5)
+    expected = api.gather_all_report_data(db)
+
+    db.run_alembic("downgrade", "962fe3917799")
+    db.run_alembic("upgrade", "head")
+
+    assert api.gather_all_report_data(db) == expected
+
+
+def test_history_replays_points_already_read(db):
+    for i in range(1, 4):
+        api.push(db, "errors", value=i)
+
+    with db.history("errors", fetch_size=1) as points:
+        assert [p.metric_value for p in itertools.islice(points, 2)] == [3, 2]
+        assert [p.metric_value for p in points] == [3, 2, 1]
+        assert [p.metric_value for p in points] == [3, 2, 1]
+
+    # The cursor is closed, so the database can be written to again
+    api.push(db, "errors", value=4)
+
+
+def test_history_defers_text_columns(db):
+    api.push(db, "errors", value=1, measure_source="source", diffable_content="diff")
+
+    with db.history("errors") as points:
+        point = next(iter(points))
+        assert {"measure_source", "diffable_content"} <= inspect(point).unloaded
+        assert point.diffable_content == "diff"
+
+
+def test_add_and_recent_use_plain_records(db):
+    record = db.add(api.make_point("errors", value=1, tags={"foo": "bar"}))
+
+    assert isinstance(record, PointRecord)
+    assert record.id == 1
+    assert list(db.recent()) == [record._replace(time=record.time.replace(tzinfo=None))]
+
+
+def test_migrate_enables_incremental_auto_vacuum(db):
+    with db.connection() as conn:
+        assert conn.execute(text("PRAGMA auto_vacuum")).scalar() == 2
+
+
+def test_incremental_vacuum(db):
+    for i in range(20):
+        api.push(db, "errors", value=i, measure_source=f"{i}" + "x" * 10_000)
+    db.prune(keep_last=1)
+
+    def freelist_count():
+        with db.connection() as conn:
+            return conn.execute(text("PRAGMA freelist_count")).scalar()
+
+    before = freelist_count()
+    db.incremental_vacuum(2)
+    assert freelist_count() == before - 2
+
+    db.incremental_vacuum()
+    assert freelist_count() == 0
+
+
+def test_time_is_stored_as_utc_microseconds(db):
+    tz = datetime.timezone(datetime.timedelta(hours=9))
+    point = api.make_point("errors", value=1).model_copy(
+        update=dict(time=datetime.datetime(2023, 5, 12, 9, 0, 0, 1, tzinfo=tz))
+    )
+    db.add(point)
+
+    with db.connection() as conn:
+        assert conn.execute(text("SELECT time FROM points")).scalar() == (
+            1683849600_000_001
+        )
+    assert next(db.recent()).time == datetime.datetime(2023, 5, 12, 0, 0, 0, 1)
+
+
+@pytest.mark.parametrize(
+    "profile,expected",
+    [
+        (StorageProfile.default, dict(journal_mode="delete", synchronous=2)),
+        (StorageProfile.durable, dict(journal_mode="wal", synchronous=2)),
+        (StorageProfile.ci_fast, dict(journal_mode="memory", synchronous=0)),
+    ],
+)
+def test_storage_profile_pragmas(db, profile, expected):
+    profiled = DB(db.db_path, profile=profile)
+    api.push(profiled, "errors", value=1)
+
+    with profiled.connection() as conn:
+        for name, value in expected.items():
+            assert conn.execute(text(f"PRAGMA {name}")).scalar() == value
+    assert [p.metric_value for p in profiled.recent()] == [1]
+
+
+def test_readonly_storage_profile_rejects_writes(db):
+    api.push(db, "errors", value=1)
+    readonly = DB(db.db_path, profile=StorageProfile.readonly)
+
+    assert [p.metric_value for p in readonly.recent()] == [1]
+    with pytest.raises(OperationalError, match="readonly"):
+        api.push(readonly, "errors", value=2)
+
+
+@pytest.mark.parametrize("profile", [StorageProfile.readonly, StorageProfile.immutable])
+def test_read_only_profile_neither_creates_nor_migrates(tmp_path, profile):
+    db_path = tmp_path / "cache" / "db.sqlite"
+    with pytest.raises(db_module.ReadOnlyDatabaseError, match="doesn't exist"):
+        list(DB(db_path, profile=profile).recent())
+    assert not db_path.parent.exists()
+
+    db_path.parent.mkdir()
+    DB(db_path).run_alembic("upgrade", "962fe3917799")
+    with pytest.raises(db_module.ReadOnlyDatabaseError, match="can't be migrated"):
+        list(DB(db_path, profile=profile).recent())
+    assert DB(db_path, profile=profile).current_revision() == "962fe3917799"
+
+
+def test_immutable_storage_profile_reads_without_locking(db):
+    api.push(db, "errors", value=1)
+    immutable = DB(db.db_path, profile=StorageProfile.immutable)
+
+    with db.connection() as conn:
+        conn.execute(text("BEGIN EXCLUSIVE"))
+        assert [p.metric_value for p in immutable.recent()] == [1]
+        conn.rollback()
+    with pytest.raises(OperationalError, match="readonly"):
+        api.push(immutable, "errors", value=2)
+
+
+def test_in_memory_writes_back_on_success(db):
+    api.push(db, "errors", value=1)
+
+    with db.in_memory():
+        api.push(db, "errors", value=2)
+        assert [p.metric_value for p in DB(db.db_path).recent()] == [1]
+
+    assert [p.metric_value for p in DB(db.db_path).recent()] == [2, 1]
+    assert [p.name for p in db.db_path.parent.iterdir()] == [db.db_path.name]
+
+
+def test_in_memory_discards_changes_on_error(db):
+    api.push(db, "errors", value=1)
+
+    with pytest.raises(RuntimeError):
+        with db.in_memory():
+            api.push(db, "errors", value=2)
+            raise RuntimeError()
+
+    assert [p.metric_value for p in db.recent()] == [1]
+
+
+def push_revisions(db, count):
+    # Contents that differ from the previous one by a line
+    lines = [f"finding {i}\n" for i in range(100)]
+    contents = []
+    for i in range(count):
+        lines[i] = f"fixed {i}\n"
+        contents.append("".join(lines))
+        api.push(db, "errors", value=i, diffable_content=contents[-1])
+    return contents
+
+
+def test_delta_encoded_diffable_content(db):
+    delta_db = DB(db.db_path, keyframe_interval=3)
+    contents = push_revisions(delta_db, 7)
+    api.push(delta_db, "warnings", value=1, measure_source=contents[-1])
+
+    with db.connection() as conn:
+        assert conn.execute(
+            text("SELECT base_hash IS NULL FROM blobs ORDER BY id")
+        ).scalars().all() == [0, 0, 1, 0, 0, 1, 1]
+    assert [
+        p.diffable_content for p in db.recent("errors", count=None, with_content=True)
+    ] == (contents[::-1])
+    assert next(db.recent("warnings", with_content=True)).measure_source == contents[-1]
+    with db.history("errors") as history:
+        assert [p.diffable_content for p in history] == contents[::-1]
+    report = api.gather_report_data(db, "errors")
+    assert report.latest_diffable_content == contents[-1]
+    assert report.previous_diffable_content == contents[-2]
+
+
+def test_prune_keeps_delta_bases(db, create_db):
+    delta_db = DB(db.db_path, keyframe_interval=4)
+    contents = push_revisions(delta_db, 7)
+
+    assert delta_db.prune(keep_last=2) == 5
+    assert [
+        p.diffable_content for p in db.recent(count=None, with_content=True)
+    ] == contents[:4:-1]
+
+    # The content of the first point is now a delta against the second one,
+    # which gets pruned
+    api.push(delta_db, "errors", value=7, diffable_content=contents[5])
+    api.push(delta_db, "errors", value=8, diffable_content="new")
+    assert delta_db.prune(keep_last=2) == 2
+    with db.connection() as conn:
+        assert (
+            conn.execute(
+                text("SELECT count(*) FROM blobs WHERE base_hash IS NULL")
+            ).scalar()
+            == 2
+        )
+    assert [p.diffable_content for p in db.recent(count=None, with_content=True)] == [
+        "new",
+        contents[5],
+    ]
+
+    combined = create_db("combined.db")
+    api.combine(combined, [db])
+    assert [
+        p.diffable_content for p in combined.recent(count=None, with_content=True)
+    ] == [
+        "new",
+        contents[5],
+    ]
+
+    db.run_alembic("downgrade", "f2461755f373")
+    with db.connection() as conn:
+        assert conn.execute(
+            text("SELECT diffable_content FROM points ORDER BY id DESC")
+        ).scalars().all() == ["new", contents[5]]
+
+
+def test_combine_copies_delta_bases_only_the_cache_refers_to(db, create_db):
+    delta_db = DB(db.db_path, keyframe_interval=5)
+    x, y = (f"{first}\n" + "common\n" * 100 for first in "xy")
+    api.push(delta_db, "errors", value=1, diffable_content=x)
+    api.push(delta_db, "errors", value=2, diffable_content=y)
+    entry = db_module.MeasureCacheEntry("errors", "key", 2, None, y)
+    delta_db.cache_measurements([entry])
+    # x is stored as a delta against y, which only the cache refers to after
+    # pruning
+    api.push(delta_db, "errors", value=3, diffable_content=x)
+    assert delta_db.prune(keep_last=1) == 2
+    with db.connection() as conn:
+        assert (
+            conn.execute(
+                text("SELECT count(*) FROM blobs WHERE base_hash IS NOT NULL")
+            ).scalar()
+            == 1
+        )
+
+    combined = create_db("combined.db")
+    api.combine(combined, [db])
+    assert [
+        p.diffable_content for p in combined.recent(count=None, with_content=True)
+    ] == [x]
+    assert api.gather_report_data(combined, "errors").latest_diffable_content == x
+
+
+def test_delta_without_base(db):
+    delta_db = DB(db.db_path, keyframe_interval=5)
+    x, y = (f"{first}\n" + "common\n" * 100 for first in "xy")
+    api.push(delta_db, "errors", value=1, diffable_content=x)
+    api.push(delta_db, "errors", value=2, diffable_content=y)
+    with db.connection() as conn:
+        conn.execute(text("DELETE FROM blobs WHERE base_hash IS NULL"))
+        conn.commit()
+
+    with pytest.raises(Exception, match="Base .* of delta-encoded content is missing"):
+        list(db.recent("errors", count=None, with_content=True))
+
+
+def test_cached_measurements(db):
+    api.push(db, "errors", value=1, measure_source="source", diffable_content="diff")
+    entry = db_module.MeasureCacheEntry("errors", "key", 1, "source", "diff")
+    assert db.cache_measurements([entry, entry._replace(metric_name="nope")]) == 1
+
+    assert db.cached_measurements({"errors": "key", "nope": "key"}) == {"errors": entry}
+    assert db.cached_measurements({"errors": "other"}) == {}
+
+    # The cache keeps its content after the points that had it are gone
+    api.push(db, "errors", value=2)
+    assert db.prune(keep_last=1) == 1
+    assert db.cached_measurements({"errors": "key"}) == {"errors": entry}
+
+    # and is gone along with the metric
+    api.push(db, "warnings", value=3)
+    db.rename("errors", "warnings")
+    with db.connection() as conn:
+        assert conn.execute(text("SELECT count(*) FROM measure_cache")).scalar() == 0